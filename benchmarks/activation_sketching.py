@@ -0,0 +1,101 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+Benchmark of the accuracy trade-off of the :class:`~ikkuna.utils.sketch.ActivationReducer`. The
+convolutional activations of a ResNet-18 are recorded for a fixed probe set before and after a few
+training steps. The SVCCA similarity of each layer is computed from the full activations and from
+the reduced ones, and the mean absolute error over the layers is reported together with the memory
+the reduced activations need. Most of the error comes from the deepest layers, whose small feature
+maps leave few rows for many channels once they are subsampled.
+'''
+from argparse import ArgumentParser
+import time
+
+import torch
+
+from ikkuna.models.resnet import resnet18
+from ikkuna.utils.cca import covariances, grouped_cca_similarities
+from ikkuna.utils.sketch import ActivationReducer
+
+CONFIGURATIONS = {
+    'full':             {},
+    'stride 2':         {'spatial_stride': 2},
+    'stride 4':         {'spatial_stride': 4},
+    '16 positions':     {'spatial_samples': 16},
+    'pool 4x4':         {'pool_size': 4},
+    'gaussian 64':      {'projection_dim': 64},
+    'sparse 64':        {'projection_dim': 64, 'projection': 'sparse'},
+    'stride 2, sparse 64': {'spatial_stride': 2, 'projection_dim': 64, 'projection': 'sparse'},
+}
+
+
+def record_activations(model, X):
+    '''Record the activations of all convolutional layers.'''
+    activations = {}
+
+    def hook(module, input_, output):
+        activations[module] = output.detach()
+
+    handles = [m.register_forward_hook(hook) for m in model.modules()
+               if isinstance(m, torch.nn.Conv2d)]
+    with torch.no_grad():
+        model(X)
+    for handle in handles:
+        handle.remove()
+    return activations
+
+
+def similarities(before, after):
+    '''Compute the SVCCA similarity of each layer from activations of shape ``(n, C, ...)``.'''
+    def datapoints(activations):
+        return activations.movedim(1, -1).reshape(-1, activations.size(1))
+    return grouped_cca_similarities({m: covariances(datapoints(before[m]), datapoints(after[m]))
+                                     for m in before})
+
+
+def get_parser():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--probe-size', type=int, default=128)
+    parser.add_argument('-s', '--steps', type=int, default=5,
+                        help='Number of training steps between the recordings')
+    parser.add_argument('--device', type=str, default='cpu')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    torch.manual_seed(0)
+
+    model     = resnet18().to(args.device)
+    loss_fn   = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    X         = torch.randn(args.probe_size, 3, 32, 32, device=args.device)
+    Y         = torch.randint(0, 10, (args.probe_size,), device=args.device)
+
+    model.eval()
+    before = record_activations(model, X)
+    model.train()
+    for _ in range(args.steps):
+        optimizer.zero_grad()
+        loss_fn(model(X), Y).backward()
+        optimizer.step()
+    model.eval()
+    after = record_activations(model, X)
+
+    exact = None
+    print(f'{"reduction":<22} {"memory [MB]":>12} {"time [s]":>10} {"mean abs. error":>16}')
+    for name, kwargs in CONFIGURATIONS.items():
+        reducer = ActivationReducer(**kwargs)
+        start   = time.perf_counter()
+        reduced = [{m: reducer(m, acts[m]) for m in acts} for acts in (before, after)]
+        result  = similarities(*reduced)
+        elapsed = time.perf_counter() - start
+        memory  = sum(a.numel() * a.element_size() for a in reduced[0].values()) / 2 ** 20
+        if exact is None:
+            exact = result
+        error   = sum(abs(result[m] - exact[m]).item() for m in exact) / len(exact)
+        print(f'{name:<22} {memory:>12.1f} {elapsed:>10.3f} {error:>16.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+Benchmark comparing the condition number estimate of
+:func:`~ikkuna.utils.linalg.extreme_singular_values` with the exact value and the cost of a
+pseudo-inverse for typical layer shapes. The warm-started estimate is computed on slightly perturbed
+weights, as happens between two training steps.
+
+The Lanczos iteration converges slowly if the smallest singular values are clustered, as for large
+random square matrices, so pass ``--exact-size 0`` to see where it pays off on a given machine.
+'''
+from argparse import ArgumentParser
+import time
+
+import torch
+
+from ikkuna.utils.linalg import extreme_singular_values
+
+SHAPES = [(64, 27), (128, 576), (256, 2304), (512, 4608), (2048, 4096)]
+
+
+def timed(fn, repeats):
+    '''Call a function repeatedly and return its last result and the mean time.'''
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeats
+
+
+def get_parser():
+    parser = ArgumentParser()
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    parser.add_argument('-k', type=int, default=64, help='Size of the Krylov subspace')
+    parser.add_argument('--exact-size', type=int, default=4096,
+                        help='Largest matrix side for which the exact solution is used. Pass 0 to '
+                             'always use the Lanczos iteration.')
+    parser.add_argument('--threads', type=int, default=None)
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    print(f'{"shape":<14} {"pinverse":>10} {"cold":>10} {"warm":>10} {"rel. error":>12}')
+    for shape in SHAPES:
+        # spread the row scales so the matrix is not too well conditioned
+        W     = torch.randn(*shape) * torch.linspace(0.1, 2, shape[0]).unsqueeze(1)
+        _, tp = timed(lambda: torch.pinverse(W), args.repeats)
+
+        def estimate(start=None):
+            return extreme_singular_values(W, start=start, k=args.k, exact_size=args.exact_size)
+
+        (_, _, start), tc   = timed(estimate, args.repeats)
+        W                   = W + 1e-3 * torch.randn_like(W)
+        (smax, smin, _), tw = timed(lambda: estimate(start), args.repeats)
+
+        s     = torch.linalg.svdvals(W.double())
+        exact = (s[0] / s[-1]).item()
+        error = abs((smax / smin).item() - exact) / exact
+        print(f'{str(shape):<14} {tp:>10.4f} {tc:>10.4f} {tw:>10.4f} {error:>12.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+Benchmark counting the tensor allocations per training step which are caused by the
+:class:`~ikkuna.export.Exporter` when someone subscribes to ``weights`` and ``weight_updates``.
+Each model is trained for a few warm-up steps and then profiled, once without any subscriber (so the
+Exporter attaches no hooks) and once with a subscriber for weights and updates. The difference is
+the Exporter's overhead.
+'''
+from argparse import ArgumentParser
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from ikkuna.export import Exporter
+from ikkuna.export.messages import MessageBus
+from ikkuna.export.subscriber import Subscriber, Subscription
+from ikkuna import models
+
+
+class DiscardingSubscriber(Subscriber):
+    '''Subscriber which receives messages and does nothing with them.'''
+
+    def __init__(self, kinds, message_bus):
+        super().__init__([Subscription(self, kinds)], message_bus)
+
+    def compute(self, message):
+        pass
+
+
+def make_model(name, exporter):
+    if name == 'ResNet':
+        return models.resnet18(num_classes=10, exporter=exporter)
+    elif name == 'DenseNet':
+        return models.DenseNet([32, 32, 3], block_config=(6, 6, 6), num_classes=10,
+                               exporter=exporter)
+    else:
+        raise ValueError(f'Unknown model {name}')
+
+
+def count_allocations(model_name, subscribe, steps, warmup, batch_size):
+    '''Train a model on random data and count the allocations per step.
+
+    Returns
+    -------
+    tuple(float, float)
+        Average number of allocations and allocated bytes per step
+    '''
+    bus      = MessageBus('benchmark')
+    exporter = Exporter(depth=-1, module_filter=[torch.nn.Conv2d], message_bus=bus)
+    model    = make_model(model_name, exporter)
+    if subscribe:
+        DiscardingSubscriber(['weights', 'weight_updates'], bus)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    loss_fn   = torch.nn.CrossEntropyLoss()
+    exporter.set_loss(loss_fn)
+    X = torch.randn(batch_size, 3, 32, 32)
+    Y = torch.randint(0, 10, (batch_size,))
+
+    def train_step():
+        optimizer.zero_grad()
+        loss_fn(model(X), Y).backward()
+        optimizer.step()
+
+    for _ in range(warmup):
+        train_step()
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        for _ in range(steps):
+            train_step()
+
+    allocations = [e.self_cpu_memory_usage for e in prof.events() if e.self_cpu_memory_usage > 0]
+    return len(allocations) / steps, sum(allocations) / steps
+
+
+def get_parser():
+    parser = ArgumentParser()
+    parser.add_argument('-m', '--models', nargs='+', default=['ResNet', 'DenseNet'])
+    parser.add_argument('-b', '--batch-size', type=int, default=8)
+    parser.add_argument('-s', '--steps', type=int, default=5)
+    parser.add_argument('-w', '--warmup', type=int, default=3)
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    print(f'{"model":<10} {"allocs/step":>12} {"MB/step":>10}   (exporter overhead)')
+    for model_name in args.models:
+        base_n, base_bytes = count_allocations(model_name, False, args.steps, args.warmup,
+                                               args.batch_size)
+        sub_n, sub_bytes   = count_allocations(model_name, True, args.steps, args.warmup,
+                                               args.batch_size)
+        print(f'{model_name:<10} {sub_n - base_n:>12.1f} {(sub_bytes - base_bytes) / 2**20:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+Benchmark comparing the top Hessian eigenvalues computed by the
+:class:`~ikkuna.export.subscriber.HessianEigenSubscriber`'s Lanczos iteration on Hessian-vector
+products with a long reference run and, if it is installed, with the deflated power iteration from
+``hessian_eigenthings`` which the subscriber used previously. The warm-started estimate is computed
+after one training step, as happens between two computations in the subscriber.
+'''
+from argparse import ArgumentParser
+import time
+
+import torch
+from torch.utils.data import TensorDataset, DataLoader
+
+from ikkuna import models
+from ikkuna.utils.hessian import HessianOperator
+from ikkuna.utils.linalg import lanczos, hutchinson_trace
+
+
+def timed(fn):
+    '''Call a function and return its result and the time it took.'''
+    start  = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def get_parser():
+    parser = ArgumentParser()
+    parser.add_argument('-b', '--batch-size', type=int, default=128,
+                        help='Number of samples in the probe set')
+    parser.add_argument('-k', '--num-eig', type=int, default=3)
+    parser.add_argument('-s', '--steps', type=int, default=20, help='Maximum number of Lanczos '
+                        'steps and number of power iteration steps')
+    parser.add_argument('--tol', type=float, default=1e-3)
+    parser.add_argument('--trace-samples', type=int, default=10)
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    torch.manual_seed(0)
+
+    model      = models.AlexNetMini([32, 32, 3], num_classes=10)
+    model.eval()
+    loss_fn    = torch.nn.CrossEntropyLoss()
+    X          = torch.randn(args.batch_size, 3, 32, 32)
+    Y          = torch.randint(0, 10, (args.batch_size,))
+    batches    = [(X, Y)]
+    parameters = [p for m in model.modules() if isinstance(m, torch.nn.Conv2d)
+                  for p in m.parameters()]
+
+    print(f'{"method":<20} {"time [s]":>10} {"HVPs":>6}  eigenvalues')
+    with HessianOperator(model, loss_fn, parameters, batches) as H:
+        (reference, _, n), t = timed(lambda: lanczos(H.matvec, H.random_vector(),
+                                                     num_eig=args.num_eig, n_steps=100, tol=None))
+        print(f'{"reference":<20} {t:>10.3f} {n:>6}  {reference.tolist()}')
+        (evals, evecs, n), t = timed(lambda: lanczos(H.matvec, H.random_vector(),
+                                                     num_eig=args.num_eig, n_steps=args.steps,
+                                                     tol=args.tol))
+        print(f'{"lanczos (cold)":<20} {t:>10.3f} {n:>6}  {evals.tolist()}')
+        trace, t = timed(lambda: hutchinson_trace(H.matvec, evals.new_zeros(H.size),
+                                                  args.trace_samples))
+        print(f'{"hutchinson trace":<20} {t:>10.3f} {args.trace_samples:>6}  {trace.item()}')
+
+    # one training step changes the Hessian a little
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    optimizer.zero_grad()
+    loss_fn(model(X), Y).backward()
+    optimizer.step()
+    with HessianOperator(model, loss_fn, parameters, batches) as H:
+        (evals, _, n), t = timed(lambda: lanczos(H.matvec, evecs.sum(1), num_eig=args.num_eig,
+                                                 n_steps=args.steps, tol=args.tol))
+        print(f'{"lanczos (warm)":<20} {t:>10.3f} {n:>6}  {evals.tolist()}')
+
+    try:
+        from hessian_eigenthings import compute_hessian_eigenthings
+    except ImportError:
+        print('hessian_eigenthings is not installed, skipping the power iteration.')
+        return
+    loader = DataLoader(TensorDataset(X, Y), batch_size=args.batch_size)
+    (evals, _), t = timed(lambda: compute_hessian_eigenthings(model, loader, loss_fn,
+                                                              num_eigenthings=args.num_eig,
+                                                              power_iter_steps=args.steps))
+    print(f'{"power iteration":<20} {t:>10.3f} {args.steps * args.num_eig:>6}  '
+          f'{sorted(evals, reverse=True)}')
+
+
+if __name__ == '__main__':
+    main()
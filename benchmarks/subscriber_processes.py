@@ -0,0 +1,117 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+Benchmark comparing the training throughput when an expensive subscriber is switched off, run
+inline on the :class:`~ikkuna.export.messages.MessageBus` and hosted in a separate process via
+:class:`~ikkuna.export.process.ProcessSubscriberProxy`. By default, the
+:class:`~ikkuna.export.subscriber.SVCCASubscriber` is used. The
+:class:`~ikkuna.export.subscriber.ConditionNumberSubscriber` can be used instead.
+'''
+from argparse import ArgumentParser
+import time
+
+import torch
+from torch.utils.data import TensorDataset
+
+from ikkuna.export import Exporter
+from ikkuna.export.messages import MessageBus
+from ikkuna.export.process import ProcessSubscriberProxy
+from ikkuna.utils import DatasetMeta
+from ikkuna import models
+
+# subscribers deregister their topics from the global topic list when they are collected, so keep
+# them alive for the whole benchmark
+_subscribers = []
+
+
+def make_subscriber(name, model, bus, probe_size, subsample):
+    '''Create the subscriber to benchmark.
+
+    Returns
+    -------
+    tuple(ikkuna.export.subscriber.Subscriber, list(str))
+        The subscriber and the kinds it must process in the main process
+    '''
+    if name == 'svcca':
+        from ikkuna.export.subscriber.svcca import SVCCASubscriber
+        X       = torch.randn(probe_size, 3, 32, 32)
+        Y       = torch.randint(0, 10, (probe_size,))
+        dataset = DatasetMeta(TensorDataset(X, Y), num_classes=10, shape=tuple(X.shape))
+        return (SVCCASubscriber(dataset, probe_size, model.forward, message_bus=bus,
+                                subsample=subsample, backend=None),
+                ['batch_finished'])
+    elif name == 'condition':
+        from ikkuna.export.subscriber.condition import ConditionNumberSubscriber
+        return (ConditionNumberSubscriber('weights', message_bus=bus, subsample=subsample,
+                                          backend=None),
+                [])
+    else:
+        raise ValueError(f'Unknown subscriber {name}')
+
+
+def measure(mode, args):
+    '''Train on random data and measure the throughput.
+
+    Returns
+    -------
+    float
+        Training steps per second
+    '''
+    torch.manual_seed(0)
+    bus      = MessageBus(f'benchmark-{mode}')
+    exporter = Exporter(depth=-1, module_filter=[torch.nn.Conv2d], message_bus=bus)
+    model    = models.AlexNetMini([32, 32, 3], num_classes=10, exporter=exporter)
+    proxy    = None
+    if mode != 'off':
+        subscriber, local_kinds = make_subscriber(args.subscriber, model, bus, args.probe_size,
+                                                  args.subsample)
+        _subscribers.append(subscriber)
+        if mode == 'process':
+            proxy = ProcessSubscriberProxy(subscriber, named_modules=exporter.named_modules,
+                                           local_kinds=local_kinds)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    loss_fn   = torch.nn.CrossEntropyLoss()
+    exporter.set_loss(loss_fn)
+    X = torch.randn(args.batch_size, 3, 32, 32)
+    Y = torch.randint(0, 10, (args.batch_size,))
+
+    def train_step():
+        optimizer.zero_grad()
+        loss_fn(model(X), Y).backward()
+        optimizer.step()
+
+    for _ in range(args.warmup):
+        train_step()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        train_step()
+    elapsed = time.perf_counter() - start
+    # the remaining work in the worker does not count against the training loop, but should not
+    # leak into the next measurement
+    if proxy is not None:
+        proxy.close()
+    return args.steps / elapsed
+
+
+def get_parser():
+    parser = ArgumentParser()
+    parser.add_argument('--subscriber', choices=['svcca', 'condition'], default='svcca')
+    parser.add_argument('-b', '--batch-size', type=int, default=64)
+    parser.add_argument('-s', '--steps', type=int, default=100)
+    parser.add_argument('-w', '--warmup', type=int, default=5)
+    parser.add_argument('-n', '--probe-size', type=int, default=500,
+                        help='Number of data points SVCCA is computed on')
+    parser.add_argument('--subsample', type=int, default=10,
+                        help='Number of steps between two computations of the metric')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    print(f'{"mode":<10} {"steps/s":>10}')
+    for mode in ['off', 'inline', 'process']:
+        print(f'{mode:<10} {measure(mode, args):>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
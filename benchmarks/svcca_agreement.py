@@ -0,0 +1,99 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+Validation of :mod:`ikkuna.utils.cca` against Google's ``svcca`` package, which the SVCCA
+subscribers used previously. Activations of all layers of an
+:class:`~ikkuna.models.AlexNetMini` are recorded for a fixed probe set before and after a few
+training steps and the mean canonical correlations of both recordings are computed with
+:func:`~ikkuna.utils.cca.grouped_cca_similarities` and, if ``svcca`` is installed, with
+``svcca.cca_core.robust_cca_similarity()``.
+'''
+from argparse import ArgumentParser
+import time
+
+import torch
+
+from ikkuna import models
+from ikkuna.utils.cca import covariances, grouped_cca_similarities
+
+
+def record_activations(model, X):
+    '''Record the activations of all convolutional and linear layers as matrices with one row per
+    datapoint and spatial location.'''
+    activations = {}
+
+    def hook(module, input_, output):
+        if output.ndimension() > 2:
+            output = output.movedim(1, -1).reshape(-1, output.size(1))
+        activations[module] = output.detach()
+
+    handles = [m.register_forward_hook(hook) for m in model.modules()
+               if isinstance(m, (torch.nn.Conv2d, torch.nn.Linear))]
+    with torch.no_grad():
+        model(X)
+    for handle in handles:
+        handle.remove()
+    return activations
+
+
+def get_parser():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--probe-size', type=int, default=64)
+    parser.add_argument('-s', '--steps', type=int, default=5,
+                        help='Number of training steps between the recordings')
+    parser.add_argument('--epsilon', type=float, default=1e-8)
+    parser.add_argument('--threshold', type=float, default=0.98)
+    parser.add_argument('--device', type=str, default='cpu')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    torch.manual_seed(0)
+
+    model     = models.AlexNetMini([32, 32, 3], num_classes=10).to(args.device)
+    loss_fn   = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.05)
+    X         = torch.randn(args.probe_size, 3, 32, 32, device=args.device)
+    Y         = torch.randint(0, 10, (args.probe_size,), device=args.device)
+
+    model.eval()
+    before = record_activations(model, X)
+    model.train()
+    for _ in range(args.steps):
+        optimizer.zero_grad()
+        loss_fn(model(X), Y).backward()
+        optimizer.step()
+    model.eval()
+    after = record_activations(model, X)
+
+    start        = time.perf_counter()
+    similarities = grouped_cca_similarities({m: covariances(before[m], after[m]) for m in before},
+                                            epsilon=args.epsilon, threshold=args.threshold)
+    elapsed      = time.perf_counter() - start
+    print(f'ikkuna.utils.cca: {elapsed:.4f}s for {len(similarities)} layers')
+
+    try:
+        from svcca import cca_core
+    except ImportError:
+        print('svcca is not installed, skipping the comparison.')
+        for module, similarity in similarities.items():
+            print(f'{module.__class__.__name__:<10} {similarity.item():>12.8f}')
+        return
+
+    print(f'{"layer":<10} {"shape":<14} {"ikkuna":>12} {"svcca":>12} {"abs. error":>12}')
+    for module, similarity in similarities.items():
+        x, y   = before[module], after[module]
+        # svcca expects neurons as rows
+        result = cca_core.robust_cca_similarity(x.t().cpu().numpy(), y.t().cpu().numpy(),
+                                                epsilon=args.epsilon, threshold=args.threshold,
+                                                compute_dirns=False, rescale=True)
+        mean   = result['mean'][0]
+        error  = abs(similarity.item() - mean)
+        name   = module.__class__.__name__
+        print(f'{name:<10} {str(tuple(x.shape)):<14} {similarity.item():>12.8f} {mean:>12.8f} '
+              f'{error:>12.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
+from collections import defaultdict
+from contextlib import contextmanager
 import torch
 
 from ikkuna.export.messages import get_default_bus
+from ikkuna.export.probe import ProbeScheduler
+from ikkuna.export.snapshot import SnapshotStore
 from ikkuna.utils import ModuleTree
 from ikkuna.utils import freeze_module
 
@@ -40,15 +44,23 @@ class Exporter(object):
         #. :meth:`~Exporter.epoch_finished()` should be called if any
            :class:`~ikkuna.export.subscriber.Subscriber`\ s rely on the ``'epoch_finished'`` message
 
+    Optionally, :meth:`~Exporter.set_optimizer()` can be called so that weight and bias updates are
+    taken directly around the optimizer's ``step()`` instead of from copies made during the forward
+    pass.
+
     Attributes
     ----------
     _modules    :   dict(torch.nn.Module, ikkuna.utils.NamedModule)
                     All tracked modules
-    _weight_cache   :   dict
-                        Cache for keeping the previous weights for computing differences
-    _bias_cache :   dict
+    _weight_cache   :   ikkuna.export.snapshot.SnapshotStore
+                        Cache for keeping the previous weights for computing differences. Only
+                        populated while someone subscribes to ``weights`` or ``weight_updates``
+    _bias_cache :   ikkuna.export.snapshot.SnapshotStore
                     see ``_weight_cache``
     _model          :   torch.nn.Module
+    _optimizer  :   torch.optim.Optimizer or None
+                    If set, the optimizer whose ``step()`` is hooked for publishing weights and
+                    updates
     _train_step :   int
                     Current batch index
     _global_step    :   int
@@ -62,13 +74,23 @@ class Exporter(object):
     _module_filter  :   list(torch.nn.Module)
                         Set of modules to capture when calling :meth:`add_modules()`. Everything not
                         in this list is ignored
+    _hooks  :   dict(torch.nn.Module, dict(str, list))
+                Handles of the hooks currently installed on each module. Hooks are only installed
+                while some subscriber on the :attr:`message_bus` needs the data they produce.
+    _suppress_hooks :   bool
+                        Set during evaluation passes whose tag no subscriber is interested in and
+                        inside :meth:`silenced()`. The hooks return immediately while this is set.
+    _probe_scheduler    :   ikkuna.export.probe.ProbeScheduler
+                            Scheduler for the probe passes requested by the subscribers, which is
+                            run at the end of each step
     '''
 
     def __init__(self, depth, module_filter=None, message_bus=get_default_bus()):
         self._modules           = {}
-        self._weight_cache      = {}
-        self._bias_cache        = {}
+        self._weight_cache      = SnapshotStore()
+        self._bias_cache        = SnapshotStore()
         self._model             = None
+        self._optimizer         = None
         self._epoch             = 0
         # for gradient and activation to have the same step number, we need to increase it before
         # propagation or after backpropagation. but we don't know when the backprop finishes, while
@@ -82,13 +104,52 @@ class Exporter(object):
         self._module_filter     = module_filter
         self._msg_bus           = message_bus
         self._current_publish_tag = 'default'
+        self._hooks             = defaultdict(dict)
+        self._suppress_hooks    = False
+        self._probe_scheduler   = ProbeScheduler(self)
 
         self._epoch_started_marker = False
 
+        # attach hooks only for topics someone has subscribed to and keep them up to date as
+        # subscribers come and go
+        self._msg_bus.register_route_listener(self._update_hooks)
+
     @property
     def message_bus(self):
         return self._msg_bus
 
+    @property
+    def probe_scheduler(self):
+        '''ikkuna.export.probe.ProbeScheduler: Scheduler through which subscribers can share probe
+        passes'''
+        return self._probe_scheduler
+
+    @property
+    def global_step(self):
+        '''int: Global step accross all epochs'''
+        return self._global_step
+
+    @property
+    def train_step(self):
+        '''int: Current batch index'''
+        return self._train_step
+
+    @property
+    def epoch(self):
+        '''int: Current epoch'''
+        return self._epoch
+
+    def needs_create_graph(self):
+        '''Check whether the backward pass of the current training step must build the graph of
+        the gradients because a subscriber asked for it. See
+        :meth:`ikkuna.export.subscriber.Subscriber.needs_create_graph()`.
+
+        Returns
+        -------
+        bool
+        '''
+        return self._msg_bus.needs_create_graph(self._global_step)
+
     @property
     def modules(self):
         '''list(torch.nn.Module) - Modules tracked by this :class:`Exporter`'''
@@ -108,28 +169,102 @@ class Exporter(object):
         '''
         module                = named_module.module
         self._modules[module] = named_module
-        module.register_forward_hook(self.new_activations)
+        self._configure_module(module)
 
-        # for a new module, immediately cache the weights and biases. This is necessary, because
-        # weights and updates need to be published in step() as only at the end of a batch (here the
-        # beginning of the next one) the updates can be computed. but since we call step before the
-        # forward pass, the new_activations() method has had no chance to cache the current weights
-        # before the first batch starts. so we do it here.
-        if hasattr(module, 'weight'):
-            self._weight_cache[module] = module.weight
+    def _wants(self, *kinds):
+        '''Check whether any subscriber on the bus listens to any of ``kinds`` (with any tag).'''
+        return any(self._msg_bus.has_subscribers(kind) for kind in kinds)
 
-        if hasattr(module, 'bias') and module.bias is not None:
-            self._bias_cache[module] = module.bias
+    def _update_hooks(self, message_bus):
+        '''Callback for changes in the set of subscribed topics. Attaches or removes hooks and
+        caches of all tracked modules as needed.'''
+        for module in self._modules:
+            self._configure_module(module)
+
+    def _toggle_hook(self, module, name, needed, register):
+        '''Install or remove a set of hooks on a module.
+
+        Parameters
+        ----------
+        module  :   torch.nn.Module
+        name    :   str
+                    Key under which the hook handles are stored
+        needed  :   bool
+                    Whether the hooks should be present
+        register    :   function
+                        Function installing the hooks and returning a list of removable handles
+        '''
+        hooks = self._hooks[module]
+        if needed and name not in hooks:
+            hooks[name] = register()
+        elif not needed and name in hooks:
+            for handle in hooks.pop(name):
+                handle.remove()
+
+    def _configure_module(self, module):
+        '''Attach only those hooks to a module which are needed for the currently subscribed
+        topics and drop caches which are no longer needed.
+
+        Parameters
+        ----------
+        module  :   torch.nn.Module
+        '''
+        has_weight    = hasattr(module, 'weight') and module.weight is not None
+        has_bias      = hasattr(module, 'bias') and module.bias is not None
+        cache_weights = has_weight and self._wants('weights', 'weight_updates')
+        cache_biases  = has_bias and self._wants('biases', 'bias_updates')
+
+        # for a new module (or a newly subscribed topic), immediately cache the weights and biases.
+        # This is necessary, because weights and updates need to be published in step() as only at
+        # the end of a batch (here the beginning of the next one) the updates can be computed. but
+        # since we call step before the forward pass, the new_activations() method has had no chance
+        # to cache the current weights before the first batch starts. so we do it here.
+        if cache_weights:
+            if module not in self._weight_cache:
+                self._weight_cache.snapshot(module, module.weight)
+        else:
+            self._weight_cache.pop(module)
+
+        if cache_biases:
+            if module not in self._bias_cache:
+                self._bias_cache.snapshot(module, module.bias)
+        else:
+            self._bias_cache.pop(module)
+
+        # when the optimizer is hooked, weights are cached around its step() and the forward pass
+        # need not see them
+        needs_forward = (((cache_weights or cache_biases) and self._optimizer is None)
+                         or self._wants('activations', 'epoch_started'))
+        self._toggle_hook(module, 'forward', needs_forward,
+                          lambda: [module.register_forward_hook(self.new_activations)])
 
         def layer_grad_hook(module, grad_in, grad_out):
+            if self._suppress_hooks:
+                return
             self.new_layer_gradients(module, grad_out)
 
-        module.register_backward_hook(layer_grad_hook)
+        self._toggle_hook(module, 'backward', self._wants('layer_gradients'),
+                          lambda: [module.register_backward_hook(layer_grad_hook)])
+
+        self._toggle_hook(module, 'parameters',
+                          (has_weight or has_bias)
+                          and self._wants('weight_gradients', 'bias_gradients'),
+                          lambda: self._register_parameter_hooks(self._modules[module]))
+
+    def _register_parameter_hooks(self, named_module):
+        '''Register hooks on the weight and bias of a module for publishing their gradients.
 
+        Parameters
+        ----------
+        named_module    :   ikkuna.utils.NamedModule
+
+        Returns
+        -------
+        list
+            Handles of the registered hooks
+        '''
+        module     = named_module.module
         has_bias   = hasattr(module, 'bias') and module.bias is not None
-        has_weight = hasattr(module, 'weight') and module.weight is not None
-        if not has_weight and not has_bias:
-            return
 
         # For some reason, registered tensor hooks are called twice in my setup. Maybe this means
         # that the gradient is computed twice, because the grad tensors are identical. Not sure why
@@ -143,6 +278,8 @@ class Exporter(object):
         # They also check whether we grads were already published at this train step and do nothing
         # in that case.
         def weight_hook(grad):
+            if self._suppress_hooks:
+                return
             if grad_cache['weight']:
                 raise RuntimeError(f'Already received weight gradients for {named_module.name}')
             grad_cache['weight'] = grad
@@ -151,6 +288,8 @@ class Exporter(object):
                 grad_cache['weight'] = grad_cache['bias'] = None
 
         def bias_hook(grad):
+            if self._suppress_hooks:
+                return
             if grad_cache['bias']:
                 raise RuntimeError(f'Already received bias gradients for {named_module.name}')
             grad_cache['bias'] = grad
@@ -158,9 +297,10 @@ class Exporter(object):
                 self.new_parameter_gradients(module, (grad_cache['weight'], grad_cache['bias']))
                 grad_cache['weight'] = grad_cache['bias'] = None
 
+        handles = [module.weight.register_hook(weight_hook)]
         if has_bias:
-            module.bias.register_hook(bias_hook)
-        module.weight.register_hook(weight_hook)
+            handles.append(module.bias.register_hook(bias_hook))
+        return handles
 
     def add_modules(self, module, recursive=True):
         '''Add modules to supervise. If the module has ``weight`` and/or ``bias`` members, updates
@@ -268,6 +408,9 @@ class Exporter(object):
         out_    :   torch.Tensor
                     The new activations
         '''
+        if self._suppress_hooks:
+            return
+
         if not self._epoch_started_marker:
             self._msg_bus.publish_network_message(self._global_step, self._train_step,
                                                   self._epoch, 'epoch_started',
@@ -275,12 +418,15 @@ class Exporter(object):
             self._epoch_started_marker = True
 
         # save weights and biases to publish just before current step ends (in step()). this ensures
-        # we can publish the proper updates
-        if hasattr(module, 'weight'):
-            self._weight_cache[module] = module.weight.clone()
+        # we can publish the proper updates. Only modules for which someone wants weights or updates
+        # are in the caches. The snapshots are copied into preallocated buffers. If the optimizer is
+        # hooked, the snapshots are instead taken right before its step.
+        if self._optimizer is None:
+            if module in self._weight_cache:
+                self._weight_cache.snapshot(module, module.weight)
 
-        if hasattr(module, 'bias') and module.bias is not None:   # bias can be present, but be None
-            self._bias_cache[module] = module.bias.clone()
+            if module in self._bias_cache:
+                self._bias_cache.snapshot(module, module.bias)
 
         self._msg_bus.publish_module_message(self._global_step, self._train_step, self._epoch,
                                              'activations', self._modules[module], out_,
@@ -359,31 +505,87 @@ class Exporter(object):
         #########################################################
         forward_fn = model.forward
 
-        def new_forward_fn(this, *args, should_train=True, tag=self._current_publish_tag):
+        def new_forward_fn(this, *args, should_train=True, tag=self._current_publish_tag,
+                           enable_grad=False):
             '''When subscribers need to push data through the net, they should be given access to
             model.forward() to control the Exporter's behaviour until their compute() method ends.
             The `should_train` parameter can be used to temporarily have the model in validation
             mode. The `tag` parameter can be used to temporarily have all messages be published with
-            a different tag.
+            a different tag (or several, see ikkuna.export.probe.ProbeScheduler). Validation passes
+            are run without autograd unless `enable_grad` is set, and the hooks do no work at all if
+            nobody subscribed to the tag.
             '''
-            previous_tag = self._current_publish_tag
+            previous_tag      = self._current_publish_tag
+            previous_suppress = self._suppress_hooks
             self._current_publish_tag = tag
             # In order for accuracy subscribers to not need the model access, we add a secret
             # parameter which they can use to temporarily set the training to False and have it
             # revert automatically. TODO: Check if this is inefficient
             was_training = this.training        # store old value
             this.train(should_train)            # disable/enable training
-            if this.training:
-                # we need to step before forward pass, else act and grads get different steps
-                self.step()
-                self.new_input_data(*args)               # do this after stepping
-            ret = forward_fn(*args)             # do forward pass w/o messages spawning
-
-            self._current_publish_tag = previous_tag
-            this.train(was_training)            # restore previous state
+            # fast path for evaluation passes nobody listens to
+            silent = not this.training and not self._msg_bus.has_subscribers(tag=tag)
+            try:
+                if this.training:
+                    # we need to step before forward pass, else act and grads get different steps
+                    self.step()
+                    self.new_input_data(*args)               # do this after stepping
+                if silent:
+                    self._suppress_hooks = True
+                if this.training:
+                    ret = forward_fn(*args)
+                else:
+                    with torch.set_grad_enabled(enable_grad):
+                        ret = forward_fn(*args)
+            finally:
+                self._suppress_hooks      = previous_suppress
+                self._current_publish_tag = previous_tag
+                this.train(was_training)            # restore previous state
             return ret
         model.forward = MethodType(new_forward_fn, model)
 
+    @contextmanager
+    def silenced(self):
+        '''Context manager in which none of the hooks publish anything. Subscribers which
+        differentiate through the model themselves (e.g. for Hessian-vector products) should
+        do so inside this context, since the parameter and module hooks also fire for
+        :func:`torch.autograd.grad()` and would publish the probe gradients as training data.'''
+        previous             = self._suppress_hooks
+        self._suppress_hooks = True
+        try:
+            yield
+        finally:
+            self._suppress_hooks = previous
+
+    def set_optimizer(self, optimizer):
+        '''Hook the optimizer's ``step()`` method for publishing weights and updates. The
+        parameters of the tracked modules are copied right before the step and ``weights``,
+        ``weight_updates``, ``biases`` and ``bias_updates`` are published right after it, with the
+        same step counters as the activations and gradients which led to the update. This avoids
+        copying the weights in every forward pass (including evaluation passes) and keeps the
+        updates exact if there are several forward passes per optimizer step.
+
+        Parameters
+        ----------
+        optimizer   :   torch.optim.Optimizer
+        '''
+        self._optimizer = optimizer
+        from types import MethodType
+        step_fn = optimizer.step
+
+        def new_step_fn(this, *args, **kwargs):
+            for module in self._weight_cache:
+                self._weight_cache.snapshot(module, module.weight)
+            for module in self._bias_cache:
+                self._bias_cache.snapshot(module, module.bias)
+            ret = step_fn(*args, **kwargs)
+            self._publish_parameters()
+            return ret
+        optimizer.step = MethodType(new_step_fn, optimizer)
+
+        # forward hooks may no longer be necessary
+        self._update_hooks(self._msg_bus)
+
     def set_loss(self, loss_function):
         '''Add hook to loss function to extract labels.
 
@@ -393,12 +595,50 @@ class Exporter(object):
         '''
 
         def hook(mod, output_and_labels, loss):
+            if self._suppress_hooks:
+                return
             network_output, labels = output_and_labels
             self.new_output_and_labels(network_output, labels)
             self.new_loss(loss)
 
         loss_function.register_forward_hook(hook)
 
+    def _publish_parameters(self):
+        '''Publish the cached weights and biases along with the difference between them and the
+        current parameters.'''
+        # don't compute differences no one will receive
+        tag            = self._current_publish_tag
+        weight_updates = self._msg_bus.has_subscribers('weight_updates', tag)
+        bias_updates   = self._msg_bus.has_subscribers('bias_updates', tag)
+
+        # the differences are written into reusable buffers by the caches. compute them before
+        # reading the snapshot, since this may move the snapshot to the parameter's device
+        for module in self._weight_cache:
+            if weight_updates:
+                self._msg_bus.publish_module_message(self._global_step, self._train_step,
+                                                     self._epoch, 'weight_updates',
+                                                     self._modules[module],
+                                                     self._weight_cache.difference(module,
+                                                                                   module.weight),
+                                                     tag=self._current_publish_tag)
+            self._msg_bus.publish_module_message(self._global_step, self._train_step, self._epoch,
+                                                 'weights', self._modules[module],
+                                                 self._weight_cache[module],
+                                                 tag=self._current_publish_tag)
+
+        for module in self._bias_cache:
+            if bias_updates:
+                self._msg_bus.publish_module_message(self._global_step, self._train_step,
+                                                     self._epoch, 'bias_updates',
+                                                     self._modules[module],
+                                                     self._bias_cache.difference(module,
+                                                                                 module.bias),
+                                                     tag=self._current_publish_tag)
+            self._msg_bus.publish_module_message(self._global_step, self._train_step, self._epoch,
+                                                 'biases', self._modules[module],
+                                                 self._bias_cache[module],
+                                                 tag=self._current_publish_tag)
+
     def step(self):
         '''Increase batch counter (per epoch) and the global step counter.'''
         # due to the fact that backprop happens after forward() was called, we need to step before
@@ -409,29 +649,15 @@ class Exporter(object):
             self._msg_bus.publish_network_message(self._global_step, self._train_step, self._epoch,
                                                   'batch_finished',
                                                   tag=self._current_publish_tag)
+            # serve the probe passes the subscribers requested for the finished step
+            self._probe_scheduler.run()
 
         self._train_step  += 1
         self._global_step += 1
 
-        for module, weight in self._weight_cache.items():
-            self._msg_bus.publish_module_message(self._global_step, self._train_step,
-                                                 self._epoch, 'weight_updates',
-                                                 self._modules[module],
-                                                 module.weight - weight,
-                                                 tag=self._current_publish_tag)
-            self._msg_bus.publish_module_message(self._global_step, self._train_step, self._epoch,
-                                                 'weights', self._modules[module], weight,
-                                                 tag=self._current_publish_tag)
-
-        for module, bias in self._bias_cache.items():
-            self._msg_bus.publish_module_message(self._global_step, self._train_step,
-                                                 self._epoch, 'bias_updates',
-                                                 self._modules[module],
-                                                 module.bias - bias,
-                                                 tag=self._current_publish_tag)
-            self._msg_bus.publish_module_message(self._global_step, self._train_step, self._epoch,
-                                                 'biases', self._modules[module], bias,
-                                                 tag=self._current_publish_tag)
+        # with a hooked optimizer, these are published after the optimizer step
+        if self._optimizer is None:
+            self._publish_parameters()
 
         self._msg_bus.publish_network_message(self._global_step, self._train_step, self._epoch,
                                               'batch_started',
@@ -0,0 +1,227 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains the :class:`RepresentationHistory`, an on-disk store of the activations of
+several modules at many checkpoints, for comparing the current representations with those of any
+earlier checkpoint without propagating the data again.
+'''
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+
+class RepresentationHistory(object):
+    '''A ring of ``capacity`` slots on disk, each holding the activations of all modules for one
+    checkpoint. The activations are stored with reduced precision (they can be sketched with an
+    :class:`~ikkuna.utils.sketch.ActivationReducer` before), in files which are mapped into memory.
+    The files of a slot are reused when the slot is recycled, so the disk usage is bounded by
+    ``capacity`` times the size of one checkpoint. Checkpoints are looked up in constant time by
+    their global step.
+
+    When a new checkpoint is added to a full history, one unpinned checkpoint is evicted according
+    to the ``policy``:
+
+    * ``'fifo'`` evicts the oldest checkpoint, so the history covers the most recent ones.
+    * ``'logarithmic'`` evicts the checkpoint whose removal leaves the smallest gap relative to its
+      age, so that older checkpoints are thinned out and the spacing grows with the distance from
+      the present.
+
+    .. code-block:: python
+
+        history = RepresentationHistory(capacity=16, policy='logarithmic')
+        history.add(global_step, module, activations)
+        history.pin(global_step)        # e.g. the state after epoch 5
+        ...
+        reference = history.get(history.steps[0], module)
+
+    Attributes
+    ----------
+    _slots  :   dict(int, int)
+                Slot index of each global step
+    _files  :   list(dict(object, torch.Tensor))
+                Mapped buffers of each slot, per module
+    _written    :   list(set(object))
+                    Modules whose buffers hold data of the slot's current checkpoint
+    _pinned :   set(int)
+                Global steps which are never evicted
+    _tempdir    :   tempfile.TemporaryDirectory or None
+                    Directory holding the files if none was given
+    '''
+
+    POLICIES = ('fifo', 'logarithmic')
+
+    def __init__(self, capacity=10, policy='fifo', keep_first=True, dtype=torch.float16,
+                 directory=None):
+        '''
+        Parameters
+        ----------
+        capacity    :   int
+                        Maximum number of checkpoints to keep
+        policy  :   str
+                    ``'fifo'`` or ``'logarithmic'``
+        keep_first  :   bool
+                        Pin the first checkpoint, e.g. the initial weights
+        dtype   :   torch.dtype
+                    Data type to store the activations with. Values outside its range are clipped.
+        directory   :   str or None
+                        Directory for the files. A temporary directory is created and removed with
+                        the history if none is given.
+
+        Raises
+        ------
+        ValueError
+            If the policy is unknown or the capacity is too small for the first checkpoint to be
+            pinned
+        '''
+        if policy not in RepresentationHistory.POLICIES:
+            raise ValueError(f'Unknown eviction policy "{policy}"')
+        if capacity < 1 + keep_first:
+            raise ValueError(f'Capacity must be at least {1 + keep_first}.')
+
+        if directory is None:
+            self._tempdir = tempfile.TemporaryDirectory(prefix='ikkuna_history_')
+            directory     = self._tempdir.name
+        else:
+            self._tempdir = None
+            os.makedirs(directory, exist_ok=True)
+
+        self._capacity   = capacity
+        self._policy     = policy
+        self._keep_first = keep_first
+        self._dtype      = dtype
+        self._directory  = directory
+        self._slots      = dict()
+        self._free       = list(range(capacity - 1, -1, -1))
+        self._files      = [dict() for _ in range(capacity)]
+        self._written    = [set() for _ in range(capacity)]
+        self._module_ids = dict()
+        self._pinned     = set()
+
+    @property
+    def steps(self):
+        '''list(int): Global steps of the stored checkpoints in ascending order'''
+        return sorted(self._slots)
+
+    def __contains__(self, global_step):
+        return global_step in self._slots
+
+    def __len__(self):
+        return len(self._slots)
+
+    def pin(self, global_step):
+        '''Protect a checkpoint from eviction. Steps can be pinned before they are added.
+
+        Parameters
+        ----------
+        global_step :   int
+        '''
+        self._pinned.add(global_step)
+
+    def unpin(self, global_step):
+        '''Allow a checkpoint to be evicted again.
+
+        Parameters
+        ----------
+        global_step :   int
+        '''
+        self._pinned.discard(global_step)
+
+    def bytesize(self):
+        '''Compute the bytes of all files, including the ones of free slots which will be reused.
+
+        Returns
+        -------
+        int
+        '''
+        return sum(buffer.numel() * buffer.element_size()
+                   for files in self._files for buffer in files.values())
+
+    def _choose_victim(self):
+        '''Select the checkpoint to evict according to the policy.'''
+        steps      = self.steps
+        candidates = [i for i, step in enumerate(steps) if step not in self._pinned]
+        if not candidates:
+            raise RuntimeError('All checkpoints in the history are pinned.')
+        if self._policy == 'fifo' or len(steps) < 3:
+            return steps[candidates[0]]
+
+        latest = steps[-1]
+
+        def relative_gap(i):
+            # the last one is always kept and the first one only compared to the present
+            if i == len(steps) - 1:
+                return np.inf
+            previous = steps[i - 1] if i > 0 else steps[i]
+            return (steps[i + 1] - previous) / (latest - previous + 1)
+
+        return steps[min(candidates, key=relative_gap)]
+
+    def _slot_for(self, global_step):
+        '''Get the slot of a checkpoint, evicting another one if it is new and the ring is full.'''
+        if global_step not in self._slots:
+            if self._keep_first and not self._slots:
+                self._pinned.add(global_step)
+            if not self._free:
+                self._free.append(self._slots.pop(self._choose_victim()))
+            slot = self._free.pop()
+            self._written[slot].clear()
+            self._slots[global_step] = slot
+        return self._slots[global_step]
+
+    def _buffer(self, slot, module, shape):
+        '''Get the mapped buffer of a module in a slot, (re)allocating it if the shape changed.'''
+        files  = self._files[slot]
+        buffer = files.get(module)
+        if buffer is None or buffer.shape != shape:
+            module_id = self._module_ids.setdefault(module, len(self._module_ids))
+            path      = os.path.join(self._directory, f'slot{slot}_module{module_id}.bin')
+            # truncate, so a smaller buffer does not leave the old contents behind
+            open(path, 'wb').close()
+            buffer    = torch.from_file(path, shared=True, size=int(np.prod(shape)),
+                                        dtype=self._dtype).view(shape)
+            files[module] = buffer
+        return buffer
+
+    def add(self, global_step, module, activations):
+        '''Store a module's activations for the probe set at a checkpoint.
+
+        Parameters
+        ----------
+        global_step :   int
+                        Step of the checkpoint. Adding the first module of a new step may evict
+                        another checkpoint.
+        module  :   torch.nn.Module or str
+                    Some unique key for the module
+        activations :   torch.Tensor
+                        Activations of shape ``(n, ...)``
+        '''
+        with torch.no_grad():
+            slot   = self._slot_for(global_step)
+            buffer = self._buffer(slot, module, activations.shape)
+            if activations.is_floating_point():
+                finfo       = torch.finfo(self._dtype)
+                activations = activations.clamp(finfo.min, finfo.max)
+            buffer.copy_(activations)
+            self._written[slot].add(module)
+
+    def get(self, global_step, module):
+        '''Get a module's stored activations at a checkpoint.
+
+        Parameters
+        ----------
+        global_step :   int
+        module  :   torch.nn.Module or str
+
+        Returns
+        -------
+        torch.Tensor or None
+            The memory-mapped activations with the history's dtype, or ``None`` if the checkpoint
+            or module is not stored. The buffer is overwritten once the checkpoint is evicted, so
+            copy it to keep it longer.
+        '''
+        slot = self._slots.get(global_step)
+        if slot is None or module not in self._written[slot]:
+            return None
+        return self._files[slot][module]
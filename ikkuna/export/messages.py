@@ -2,11 +2,16 @@
 
 '''
 import abc
+import copy
+import threading
+from collections import deque
+
+import torch
 
 
 META_KINDS = {
     'batch_started', 'batch_finished', 'epoch_started', 'epoch_finished', 'input_data', 'loss',
-    'input_labels', 'network_output'
+    'input_labels', 'network_output', 'probe_finished'
 }
 '''Message kinds which are not tied to any specific module. These topics is just what comes with
 the library, others can be added to a specific :class:`MessageBus`'''
@@ -314,7 +319,25 @@ class MessageBundle(object):
 
 class MessageBus(object):
     '''A class which receives messages, registers subscribers and relays the former to the
-    latter.'''
+    latter.
+
+    Subscribers are not simply notified of every message. Instead, the bus keeps a routing table
+    which maps each kind and tag to the set of subscribers interested in them, so that publishing a
+    message only touches those subscribers. Messages for which no one has subscribed are not even
+    created.
+
+    Messages can be published with a tuple of tags, e.g. for a probe pass shared by several
+    subscribers (see :class:`~ikkuna.export.probe.ProbeScheduler`). One message is then created for
+    each tag and handed to the subscribers of that tag, all sharing the same data.
+
+    Attributes
+    ----------
+    _subscribers    :   set(ikkuna.export.subscriber.Subscriber)
+                        All registered subscribers
+    _routes :   dict(str, dict(str, set(ikkuna.export.subscriber.Subscriber)))
+                Routing table mapping kind and tag to the interested subscribers. Rebuilt whenever a
+                subscriber is registered or deregistered.
+    '''
 
     def __init__(self, name):
         '''
@@ -325,6 +348,8 @@ class MessageBus(object):
         '''
         self._name = name
         self._subscribers = set()
+        self._routes = {}
+        self._route_listeners = []
         self._meta_kinds = META_KINDS
         self._data_kinds = DATA_KINDS
 
@@ -353,6 +378,74 @@ class MessageBus(object):
         '''str: The name of this bus'''
         return self._name
 
+    @property
+    def subscribed_kinds(self):
+        '''set(str): All kinds for which at least one subscriber is registered, regardless of
+        tag'''
+        return set(self._routes.keys())
+
+    def has_subscribers(self, kind=None, tag=None):
+        '''Check whether any subscriber is interested in a kind and/or tag.
+
+        Parameters
+        ----------
+        kind    :   str or None
+                    Message kind. ``None`` matches any kind.
+        tag :   str or tuple(str) or None
+                Message tag or several tags, any of which must match. ``None`` matches any tag.
+
+        Returns
+        -------
+        bool
+        '''
+        if isinstance(tag, tuple):
+            return any(self.has_subscribers(kind, t) for t in tag)
+        if kind is not None:
+            tags = self._routes.get(kind, {})
+            return bool(tags) if tag is None else tag in tags
+        if tag is None:
+            return bool(self._routes)
+        return any(tag in tags for tags in self._routes.values())
+
+    def needs_create_graph(self, global_step):
+        '''Check whether any subscriber needs a differentiable graph of the gradients at some step.
+        See :meth:`ikkuna.export.subscriber.Subscriber.needs_create_graph()`.
+
+        Parameters
+        ----------
+        global_step :   int
+
+        Returns
+        -------
+        bool
+        '''
+        return any(sub.needs_create_graph(global_step) for sub in self._subscribers)
+
+    def register_route_listener(self, callback):
+        '''Register a function to be called whenever the routing table changes, i.e. when
+        subscribers are added or removed. This allows publishers to only produce data which is
+        actually requested.
+
+        Parameters
+        ----------
+        callback    :   function
+                        Called with this bus as the only argument
+        '''
+        self._route_listeners.append(callback)
+        callback(self)
+
+    def _rebuild_routes(self):
+        '''Recompute the routing table from the subscriptions of all registered subscribers and
+        notify all route listeners.'''
+        routes = {}
+        for sub in self._subscribers:
+            for kind, subscription in sub.subscriptions.items():
+                routes.setdefault(kind, {}).setdefault(subscription.tag, set()).add(sub)
+        self._routes = routes
+
+        for callback in self._route_listeners:
+            callback(self)
+
     def register_subscriber(self, sub):
         '''Add a new subscriber to the set. Adding subscribers mutliple times will still only call
         them once per message.
@@ -371,11 +464,51 @@ class MessageBus(object):
             if kind not in known_kinds:
                 raise ValueError(f'"{kind}" was not registered.')
         self._subscribers.add(sub)
+        self._rebuild_routes()
+
+    def deregister_subscriber(self, sub):
+        '''Remove a subscriber so it does not receive any further messages. Removing a subscriber
+        which was never registered is a no-op.
+
+        Parameters
+        ----------
+        sub :   ikkuna.export.subscriber.Subscriber
+        '''
+        self._subscribers.discard(sub)
+        self._rebuild_routes()
+
+    def _routes_for(self, kind, tag):
+        '''Find the subscribers of a kind for one or several tags.
+
+        Parameters
+        ----------
+        kind    :   str
+        tag :   str or tuple(str)
+
+        Returns
+        -------
+        list(tuple(str, set(ikkuna.export.subscriber.Subscriber)))
+            The tags which have subscribers along with them
+        '''
+        routes = self._routes.get(kind, {})
+        tags   = tag if isinstance(tag, tuple) else (tag,)
+        return [(t, routes[t]) for t in tags if routes.get(t)]
+
+    def _dispatch(self, message, subscribers):
+        '''Hand a message to the subscribers interested in it.
+
+        Parameters
+        ----------
+        message :   Message
+        subscribers :   set(ikkuna.export.subscriber.Subscriber)
+        '''
+        for sub in subscribers:
+            sub.receive_message(message)
 
     def publish_network_message(self, global_step, train_step, epoch, kind, data=None,
                                 tag='default'):
         '''Publish an update of type :class:`~ikkuna.export.messages.NetworkMessage` to all
-        registered subscribers.
+        subscribers interested in ``kind`` and ``tag``.
 
         Parameters
         ----------
@@ -389,20 +522,22 @@ class MessageBus(object):
                     Kind of message
         data    :   torch.Tensor or None
                     Payload, if necessary
+        tag :   str or tuple(str)
+                Tag of the message. For several tags, one message is published for each.
         '''
         if kind not in self._meta_kinds:
             raise ValueError(f'Unknown META kind "{kind}". '
                              'Check spelling and kind of your publications.')
 
-        msg = NetworkMessage(global_step=global_step, tag=tag, kind=kind, train_step=train_step,
-                             epoch=epoch, data=data)
-        for sub in self._subscribers:
-            sub.receive_message(msg)
+        for tag, subscribers in self._routes_for(kind, tag):
+            msg = NetworkMessage(global_step=global_step, tag=tag, kind=kind,
+                                 train_step=train_step, epoch=epoch, data=data)
+            self._dispatch(msg, subscribers)
 
     def publish_module_message(self, global_step, train_step, epoch, kind, named_module, data,
                                tag='default'):
         '''Publish an update of type :class:`~ikkuna.export.messages.ModuleMessage` to all
-        registered subscribers.
+        subscribers interested in ``kind`` and ``tag``.
 
         Parameters
         ----------
@@ -418,15 +553,376 @@ class MessageBus(object):
                     The module in question
         data    :   torch.Tensor
                     Payload
+        tag :   str or tuple(str)
+                Tag of the message. For several tags, one message is published for each.
         '''
         if kind not in self._data_kinds:
             raise ValueError(f'Unknown DATA kind "{kind}". '
                              'Check spelling and kind of your publications.')
-        msg = ModuleMessage(global_step=global_step, tag=tag, kind=kind, named_module=named_module,
-                            train_step=train_step, epoch=epoch, data=data)
 
-        for sub in self._subscribers:
-            sub.receive_message(msg)
+        for tag, subscribers in self._routes_for(kind, tag):
+            msg = ModuleMessage(global_step=global_step, tag=tag, kind=kind,
+                                named_module=named_module, train_step=train_step, epoch=epoch,
+                                data=data)
+            self._dispatch(msg, subscribers)
+
+
+class _DispatchWorker(threading.Thread):
+    '''Background thread of an :class:`AsyncMessageBus`, delivering queued messages to the
+    subscribers assigned to it in the order in which they were enqueued.
+
+    Attributes
+    ----------
+    _bus    :   AsyncMessageBus
+    _items  :   collections.deque
+                Pending pairs of handoff and subscribers
+    _maxsize    :   int
+                    Bound on the number of pending items for messages published from outside the
+                    workers. ``0`` means unbounded.
+    _unfinished :   int
+                    Number of items enqueued but not yet delivered
+    stale   :   int
+                Number of messages whose tensors were modified before delivery
+    '''
+
+    def __init__(self, bus, index, maxsize):
+        super().__init__(name=f'{bus.name}-dispatch-{index}', daemon=True)
+        self._bus        = bus
+        self._items      = deque()
+        self._maxsize    = maxsize
+        self._cond       = threading.Condition()
+        self._unfinished = 0
+        self._closed     = False
+        self.stale       = 0
+
+    @property
+    def depth(self):
+        '''int: Number of pending items'''
+        return len(self._items)
+
+    def put(self, item, block=True, bounded=True):
+        '''Enqueue an item.
+
+        Parameters
+        ----------
+        item    :   tuple
+        block   :   bool
+                    Wait for space if the queue is full. Otherwise, the item is discarded.
+        bounded :   bool
+                    Whether to respect the queue bound at all. Messages published by other workers
+                    are never bounded, since two workers waiting on each other would deadlock.
+
+        Returns
+        -------
+        bool
+            ``False`` if the item was discarded
+        '''
+        with self._cond:
+            if bounded and self._maxsize > 0:
+                if not block and len(self._items) >= self._maxsize:
+                    return False
+                while len(self._items) >= self._maxsize and self.is_alive():
+                    self._cond.wait()
+            self._items.append(item)
+            self._unfinished += 1
+            self._cond.notify_all()
+        return True
+
+    def join_queue(self):
+        '''Block until all enqueued items have been delivered.'''
+        with self._cond:
+            while self._unfinished > 0 and self.is_alive():
+                self._cond.wait()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def run(self):
+        self._bus._local.worker = self
+        while True:
+            with self._cond:
+                while not self._items and not self._closed:
+                    self._cond.wait()
+                if not self._items:
+                    return
+                handoff, subscribers = self._items.popleft()
+                self._cond.notify_all()
+            try:
+                message = self._bus._receive_handoff(handoff, self)
+                if message is not None:
+                    for sub in subscribers:
+                        sub.receive_message(message)
+            except Exception as e:
+                self._bus._worker_failed(e)
+            finally:
+                with self._cond:
+                    self._unfinished -= 1
+                    self._cond.notify_all()
+
+
+class AsyncMessageBus(MessageBus):
+    '''A :class:`MessageBus` which delivers messages on background threads, so that training can
+    continue while the subscribers compute their metrics. It can be used in place of a
+    :class:`MessageBus` anywhere.
+
+    Each subscriber is assigned to exactly one worker thread (round-robin, unless
+    :meth:`pin_subscriber()` is used), and each worker delivers messages in the order in which they
+    were published. Every subscriber thus sees the same sequence of messages as on a synchronous
+    bus, which is what :class:`~ikkuna.export.subscriber.SynchronizedSubscription` relies on.
+    Messages which a subscriber publishes are delivered immediately to subscribers on the same
+    worker and enqueued for all others.
+
+    Subscribers which set ``requires_main_thread`` (e.g. because they run the model) or which are
+    pinned to ``None`` are called synchronously in the publishing thread. Messages published for
+    them from a worker are delivered the next time the main thread publishes or
+    :meth:`flush()`\ es.
+
+    Since the exporter reuses buffers and the optimizer modifies the weights in place, the tensors
+    in a message must be protected until a worker has processed it. With
+    ``snapshot='copy'``, they are copied on their device before enqueueing. For CUDA tensors, an
+    event is recorded after the copy and the worker's stream waits for it before the message is
+    delivered. With ``snapshot='version'``, no copy is made and the tensors' version counters are
+    checked before delivery instead. Messages whose tensors were modified in the meantime are not
+    delivered and counted in :attr:`stale`. ``snapshot=None`` disables any protection.
+
+    .. warning::
+        Dropping messages (``block=False`` or ``snapshot='version'``) can leave
+        :class:`~ikkuna.export.subscriber.SynchronizedSubscription` bundles incomplete. Subscribers
+        plotting with the matplotlib backend should be pinned to a single worker or to the main
+        thread.
+
+    Attributes
+    ----------
+    _workers    :   list(_DispatchWorker)
+    _assignments    :   dict(ikkuna.export.subscriber.Subscriber, _DispatchWorker or None)
+                        Worker for each subscriber, ``None`` for synchronous ones
+    _snapshot   :   str or None
+                    ``'copy'``, ``'version'`` or ``None``
+    _block  :   bool
+                Whether publishing waits for a full queue or drops the message
+    _main_inbox :   collections.deque
+                    Messages for synchronous subscribers which were published from a worker
+    _dropped    :   int
+                    Number of messages dropped because a queue was full
+    _errors :   list(Exception)
+                Exceptions raised in the workers which have not been re-raised yet
+    '''
+
+    def __init__(self, name, num_workers=1, maxsize=64, block=True, snapshot='copy'):
+        '''
+        Parameters
+        ----------
+        name    :   str
+                    Identifier for this bus
+        num_workers :   int
+                        Number of worker threads
+        maxsize :   int
+                    Maximum number of pending messages per worker. ``0`` means unbounded.
+        block   :   bool
+                    If ``True``, publishing blocks while a worker's queue is full. Otherwise, the
+                    message is dropped for that worker.
+        snapshot    :   str or None
+                        How to protect tensors until they are processed (see class docs)
+
+        Raises
+        ------
+        ValueError
+            If ``num_workers`` is smaller than one or ``snapshot`` is unknown
+        '''
+        if num_workers < 1:
+            raise ValueError(f'Need at least one worker, got {num_workers}')
+        if snapshot not in ('copy', 'version', None):
+            raise ValueError(f'Unknown snapshot mode "{snapshot}"')
+        super().__init__(name)
+        self._local       = threading.local()
+        self._assignments = {}
+        self._next_worker = 0
+        self._snapshot    = snapshot
+        self._block       = block
+        self._main_inbox  = deque()
+        self._dropped     = 0
+        self._errors      = []
+        self._error_lock  = threading.Lock()
+        self._workers     = [_DispatchWorker(self, i, maxsize) for i in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def queue_depth(self):
+        '''list(int): Number of messages pending in each worker's queue'''
+        return [worker.depth for worker in self._workers]
+
+    @property
+    def dropped(self):
+        '''int: Number of messages dropped because a queue was full'''
+        return self._dropped
+
+    @property
+    def stale(self):
+        '''int: Number of messages not delivered because their tensors changed before
+        processing'''
+        return sum(worker.stale for worker in self._workers)
+
+    def register_subscriber(self, sub):
+        if sub not in self._assignments:
+            if getattr(sub, 'requires_main_thread', False):
+                self._assignments[sub] = None
+            else:
+                self._assignments[sub] = self._workers[self._next_worker]
+                self._next_worker = (self._next_worker + 1) % len(self._workers)
+        super().register_subscriber(sub)
+
+    def deregister_subscriber(self, sub):
+        super().deregister_subscriber(sub)
+        self._assignments.pop(sub, None)
+
+    def pin_subscriber(self, sub, worker):
+        '''Assign a subscriber to a specific worker. Pending messages are delivered first so the
+        subscriber does not see them out of order.
+
+        Parameters
+        ----------
+        sub :   ikkuna.export.subscriber.Subscriber
+        worker  :   int or None
+                    Index of the worker or ``None`` for running the subscriber synchronously
+        '''
+        self.flush()
+        self._assignments[sub] = None if worker is None else self._workers[worker]
+
+    def _worker_failed(self, exception):
+        with self._error_lock:
+            self._errors.append(exception)
+
+    def _raise_errors(self):
+        '''Re-raise the first exception which occurred in a worker.'''
+        if self._errors:
+            with self._error_lock:
+                errors, self._errors = self._errors, []
+            raise RuntimeError(f'{len(errors)} error(s) in subscriber worker') from errors[0]
+
+    def _drain_main_inbox(self):
+        while self._main_inbox:
+            message, subscribers = self._main_inbox.popleft()
+            for sub in subscribers:
+                sub.receive_message(message)
+
+    @staticmethod
+    def _tensors(data):
+        if isinstance(data, torch.Tensor):
+            return [data]
+        elif isinstance(data, (tuple, list)):
+            return [t for t in data if isinstance(t, torch.Tensor)]
+        else:
+            return []
+
+    @staticmethod
+    def _copy_data(data):
+        if isinstance(data, torch.Tensor):
+            return data.detach().clone()
+        elif isinstance(data, (tuple, list)):
+            return type(data)(AsyncMessageBus._copy_data(d) for d in data)
+        else:
+            return data
+
+    def _make_handoff(self, message):
+        '''Protect the message's tensors according to the snapshot mode.
+
+        Returns
+        -------
+        tuple
+            The message to enqueue, an optional CUDA event to wait for and an optional list of
+            tensors and their versions
+        '''
+        tensors = self._tensors(message.data)
+        if not tensors or self._snapshot is None:
+            return message, None, None
+        elif self._snapshot == 'version':
+            return message, None, [(t, t._version) for t in tensors]
+        else:
+            message = copy.copy(message)
+            message._data = self._copy_data(message.data)
+            event = None
+            if any(t.is_cuda for t in tensors):
+                event = torch.cuda.Event()
+                event.record()
+            return message, event, None
+
+    def _receive_handoff(self, handoff, worker):
+        '''Unpack a handoff in a worker.
+
+        Returns
+        -------
+        Message or None
+            ``None`` if the message is stale
+        '''
+        message, event, versions = handoff
+        if event is not None:
+            torch.cuda.current_stream().wait_event(event)
+        if versions is not None and any(t._version != v for t, v in versions):
+            worker.stale += 1
+            return None
+        return message
+
+    def _dispatch(self, message, subscribers):
+        current = getattr(self._local, 'worker', None)
+        if current is None:
+            self._raise_errors()
+            self._drain_main_inbox()
+
+        synchronous = []
+        by_worker   = {}
+        for sub in subscribers:
+            worker = self._assignments.get(sub)
+            if worker is None:
+                synchronous.append(sub)
+            else:
+                by_worker.setdefault(worker, []).append(sub)
+
+        if synchronous:
+            if current is None:
+                for sub in synchronous:
+                    sub.receive_message(message)
+            else:
+                self._main_inbox.append((message, synchronous))
+
+        if current in by_worker:
+            for sub in by_worker.pop(current):
+                sub.receive_message(message)
+
+        if by_worker:
+            handoff = self._make_handoff(message)
+            for worker, subs in by_worker.items():
+                if not worker.put((handoff, subs), block=self._block, bounded=current is None):
+                    self._dropped += 1
+
+    def flush(self):
+        '''Wait until all pending messages have been delivered and re-raise any exception from
+        the workers.
+
+        Raises
+        ------
+        RuntimeError
+            If a subscriber raised an exception in a worker thread
+        '''
+        while True:
+            for worker in self._workers:
+                worker.join_queue()
+            self._drain_main_inbox()
+            if not self._main_inbox and not any(worker._unfinished for worker in self._workers):
+                break
+        self._raise_errors()
+
+    def close(self):
+        '''Deliver all pending messages and stop the workers.'''
+        try:
+            self.flush()
+        finally:
+            for worker in self._workers:
+                worker.close()
+            for worker in self._workers:
+                worker.join()
 
 
 __default_bus = MessageBus('default')
@@ -0,0 +1,124 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains the :class:`ProbeScheduler`, which lets several subscribers share the forward
+passes of a probe set through the model.
+'''
+import numpy as np
+from torch.utils.data import Subset
+
+from ikkuna.utils.probe_set import CachedProbeSet
+
+
+class ProbeScheduler(object):
+    '''Collects requests for propagating probe sets through the model and serves all requests for
+    the same probe set with a single forward pass. Each :class:`~ikkuna.export.Exporter` owns one,
+    which runs right after ``batch_finished`` has been published, i.e. after every subscriber has
+    had the chance to place its requests for the step which just finished.
+
+    During the pass, all messages are published with the tuple of the requesting subscribers' tags,
+    so every subscriber receives the ``activations`` (and anything else the hooks publish) under its
+    own tag. In addition, the ``network_output`` and ``input_labels`` of every batch and a final
+    ``probe_finished`` message are published, all with the step counters of the finished step.
+
+    .. code-block:: python
+
+        scheduler = exporter.probe_scheduler
+        probe_set = scheduler.probe_set(dataset, batch_size=256)
+        # in compute(), on 'batch_finished'
+        scheduler.request(probe_set, 'my_tag')
+        # then handle 'activations', 'network_output', 'input_labels' and 'probe_finished' with
+        # tag 'my_tag'
+
+    Since requests are keyed by the probe set, subscribers only share a pass if they use the same
+    one. :meth:`probe_set()` hands out the same one for the same dataset and batch size.
+
+    Attributes
+    ----------
+    _pending    :   dict(object, list(str))
+                    Tags requesting each probe set, in the order the probe sets were requested
+    _probe_sets :   dict(tuple, ikkuna.utils.probe_set.CachedProbeSet)
+                    Probe sets handed out by :meth:`probe_set()`
+    _subsets    :   dict(tuple, torch.utils.data.Subset)
+                    Random subsets handed out by :meth:`probe_set()`
+    '''
+
+    def __init__(self, exporter):
+        '''
+        Parameters
+        ----------
+        exporter    :   ikkuna.export.Exporter
+                        Exporter whose model is used for the passes
+        '''
+        self._exporter = exporter
+        self._pending  = dict()
+        self._probe_sets = dict()
+        self._subsets    = dict()
+
+    def probe_set(self, dataset, batch_size, n=None):
+        '''Get a probe set cached on the device which can be shared with other subscribers.
+
+        Parameters
+        ----------
+        dataset :   torch.utils.data.Dataset
+        batch_size  :   int
+        n   :   int or None
+                Number of datapoints to randomly sample from the dataset. Subscribers asking for the
+                same number get the same sample.
+
+        Returns
+        -------
+        ikkuna.utils.probe_set.CachedProbeSet
+        '''
+        if n is not None:
+            if (dataset, n) not in self._subsets:
+                indices = np.random.randint(0, len(dataset), size=n)
+                self._subsets[(dataset, n)] = Subset(dataset, indices)
+            dataset = self._subsets[(dataset, n)]
+        if (dataset, batch_size) not in self._probe_sets:
+            # keep the data with the model if it is already known
+            model  = self._exporter._model
+            device = None if model is None else next(model.parameters()).device
+            self._probe_sets[(dataset, batch_size)] = CachedProbeSet(dataset, batch_size,
+                                                                     device=device)
+        return self._probe_sets[(dataset, batch_size)]
+
+    def request(self, probe_set, tag):
+        '''Request a pass of a probe set for the current step. Requesting the same probe set with
+        the same tag several times results in only one pass.
+
+        Parameters
+        ----------
+        probe_set   :   iterable
+                        Batches of inputs and labels
+        tag :   str
+                Tag the messages of the pass are published with for this request
+        '''
+        tags = self._pending.setdefault(probe_set, [])
+        if tag not in tags:
+            tags.append(tag)
+
+    @property
+    def pending(self):
+        '''bool: Whether there are requests which have not been served yet'''
+        return bool(self._pending)
+
+    def run(self):
+        '''Serve all pending requests with one pass per probe set.'''
+        pending, self._pending = self._pending, dict()
+        if not pending:
+            return
+
+        exporter = self._exporter
+        model    = exporter._model
+        bus      = exporter.message_bus
+        device   = next(model.parameters()).device
+        counters = (exporter.global_step, exporter.train_step, exporter.epoch)
+        for probe_set, tags in pending.items():
+            tags = tuple(tags)
+            for X, labels in probe_set:
+                X       = X.to(device, non_blocking=True)
+                outputs = model.forward(X, should_train=False, tag=tags)
+                bus.publish_network_message(*counters, 'network_output', outputs, tag=tags)
+                bus.publish_network_message(*counters, 'input_labels', labels, tag=tags)
+            bus.publish_network_message(*counters, 'probe_finished', tag=tags)
@@ -0,0 +1,310 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains the :class:`ProcessSubscriberProxy` which runs a
+:class:`~ikkuna.export.subscriber.Subscriber` in a separate process, so that expensive metrics do
+not compete with the training loop for the interpreter lock.
+'''
+import os
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from ikkuna.export.messages import NetworkMessage, ModuleMessage
+from ikkuna.export.subscriber import Subscriber
+from ikkuna.utils import NamedModule
+
+
+def _to_transport(data):
+    '''Copy tensors in ``data`` to the CPU so they can be moved into shared memory without touching
+    the original storage.'''
+    if isinstance(data, torch.Tensor):
+        return data.detach().to('cpu', copy=True)
+    elif isinstance(data, (tuple, list)):
+        return type(data)(_to_transport(d) for d in data)
+    else:
+        return data
+
+
+class _ForwardingBus(object):
+    '''Stand-in for the :class:`~ikkuna.export.messages.MessageBus` in the worker process. All
+    publications are sent back to the main process.'''
+
+    def __init__(self, name, results):
+        self._name    = name
+        self._results = results
+
+    @property
+    def name(self):
+        return self._name
+
+    def publish_network_message(self, global_step, train_step, epoch, kind, data=None,
+                                tag='default'):
+        self._results.put(('network', (global_step, train_step, epoch, kind,
+                                       _to_transport(data), tag)))
+
+    def publish_module_message(self, global_step, train_step, epoch, kind, named_module, data,
+                               tag='default'):
+        self._results.put(('module', (global_step, train_step, epoch, kind, named_module.name,
+                                      _to_transport(data), tag)))
+
+    def register_subscriber(self, sub):
+        pass
+
+    def deregister_subscriber(self, sub):
+        pass
+
+    def register_data_topic(self, kind):
+        self._results.put(('topic', ('DATA', kind)))
+
+    def register_meta_topic(self, kind):
+        self._results.put(('topic', ('META', kind)))
+
+    def deregister_data_topic(self, kind):
+        pass
+
+    def deregister_meta_topic(self, kind):
+        pass
+
+
+class _ForwardingBackend(object):
+    '''Stand-in for the subscriber's :class:`~ikkuna.visualization.Backend` in the worker process.
+    All plotting calls are sent back to the main process.'''
+
+    def __init__(self, title, results):
+        self._title   = title
+        self._results = results
+
+    @property
+    def title(self):
+        return self._title
+
+    def add_data(self, module_name, datum, step, **kwargs):
+        self._results.put(('backend', ('add_data', (module_name, _to_transport(datum), step),
+                                       kwargs)))
+
+    def add_histogram(self, module_name, datum, step, **kwargs):
+        self._results.put(('backend', ('add_histogram',
+                                       (module_name, _to_transport(datum), step), kwargs)))
+
+
+def _worker_loop(subscriber, modules, messages, results, num_threads):
+    '''Main function of the worker process. Receives serialized messages, hands them to the
+    subscriber and reports errors.
+
+    Parameters
+    ----------
+    subscriber  :   ikkuna.export.subscriber.Subscriber
+                    The worker's copy of the subscriber
+    modules :   dict(str, ikkuna.utils.NamedModule)
+                The worker's copies of the tracked modules
+    messages    :   torch.multiprocessing.Queue
+                    Incoming messages
+    results :   torch.multiprocessing.Queue
+                  Outgoing publications
+    num_threads :   int or None
+                    Number of threads torch may use in the worker
+    '''
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    subscriber._msg_bus = _ForwardingBus(subscriber.message_bus.name, results)
+    if hasattr(subscriber, '_backend'):
+        subscriber._backend = _ForwardingBackend(subscriber.backend.title, results)
+    # the accumulator is only flushed in the main process
+    if hasattr(subscriber, '_accumulator'):
+        subscriber._accumulator = None
+
+    while True:
+        item = messages.get()
+        if item is None:
+            break
+        elif item == 'flush':
+            results.put(('flushed', None))
+            continue
+
+        module_name, args = item
+        try:
+            if module_name is None:
+                message = NetworkMessage(*args)
+            else:
+                if module_name not in modules:
+                    modules[module_name] = NamedModule(None, module_name)
+                message = ModuleMessage(*args[:5], modules[module_name], args[5])
+            subscriber.receive_message(message)
+        except Exception:
+            results.put(('error', traceback.format_exc()))
+
+    # shared tensors are served by this process until the main process has received them, so wait
+    # for its permission to exit
+    results.put(('closed', None))
+    messages.get()
+    results.close()
+    results.join_thread()
+    # skip the exit handlers inherited from the main process (e.g. flushing its summary writers)
+    os._exit(0)
+
+
+class ProcessSubscriberProxy(Subscriber):
+    '''A :class:`~ikkuna.export.subscriber.Subscriber` which runs another subscriber in a separate
+    process. The proxy takes the subscriber's place on the
+    :class:`~ikkuna.export.messages.MessageBus` and forwards all messages to the worker process. The
+    tensors are copied to the CPU and transferred via shared memory. Everything the subscriber
+    publishes or plots in the worker is sent back and published on the original bus and the
+    subscriber's original backend, whenever the proxy receives a message or is :meth:`flush()`\ ed.
+
+    The worker process is forked when the proxy is created, so it inherits the subscriber's state at
+    that time. Messages of the ``local_kinds`` are processed by the original subscriber in the main
+    process instead, which is necessary e.g. for subscribers which run the model in reaction to
+    some message.
+
+    .. warning::
+        Changes the worker makes to modules (e.g. freezing them) do not reach the main process, and
+        the worker can not use CUDA. All tensors it receives are on the CPU.
+
+    Attributes
+    ----------
+    _subscriber :   ikkuna.export.subscriber.Subscriber
+                    The hosted subscriber
+    _local_kinds    :   set(str)
+                        Kinds which are processed in the main process
+    _modules    :   dict(str, ikkuna.utils.NamedModule)
+                    Modules by name, for translating the worker's publications
+    _messages   :   torch.multiprocessing.Queue
+                    Queue to the worker
+    _results    :   torch.multiprocessing.Queue
+                    Queue from the worker
+    _process    :   torch.multiprocessing.Process
+    '''
+
+    def __init__(self, subscriber, named_modules=(), local_kinds=(), num_threads=1):
+        '''
+        Parameters
+        ----------
+        subscriber  :   ikkuna.export.subscriber.Subscriber
+                        The subscriber to host. It is removed from its message bus.
+        named_modules   :   list(ikkuna.utils.NamedModule)
+                            Modules for which messages may arrive, usually
+                            :attr:`ikkuna.export.Exporter.named_modules`. The worker uses its copies
+                            of these for the messages. Modules not in this list are replaced by
+                            ``NamedModule(None, name)``.
+        local_kinds :   list(str)
+                        Kinds to process in the main process
+        num_threads :   int or None
+                        Number of threads torch may use in the worker. ``None`` keeps the default.
+        '''
+        self._subscriber   = subscriber
+        self._local_kinds  = set(local_kinds)
+        self._modules      = {named_module.name: named_module for named_module in named_modules}
+        self.requires_main_thread = subscriber.requires_main_thread
+
+        bus = subscriber.message_bus
+        bus.deregister_subscriber(subscriber)
+
+        context        = mp.get_context('fork')
+        self._messages = context.Queue()
+        self._results  = context.Queue()
+        self._process  = context.Process(target=_worker_loop,
+                                         args=(subscriber, dict(self._modules), self._messages,
+                                               self._results, num_threads),
+                                         daemon=True)
+        self._process.start()
+
+        super().__init__(list(set(subscriber.subscriptions.values())), bus)
+
+    @property
+    def subscriber(self):
+        '''ikkuna.export.subscriber.Subscriber: The hosted subscriber'''
+        return self._subscriber
+
+    def needs_create_graph(self, global_step):
+        return self._subscriber.needs_create_graph(global_step)
+
+    def compute(self, message_or_bundle):
+        # messages are passed on in receive_message() before any subscription sees them
+        pass
+
+    def receive_message(self, message):
+        self._drain()
+        if message.kind in self._local_kinds:
+            self._subscriber.receive_message(message)
+            return
+
+        args = [message.tag, message.global_step, message.train_step, message.epoch, message.kind]
+        if isinstance(message, ModuleMessage):
+            self._modules.setdefault(message.module.name, message.module)
+            item = (message.module.name, args + [_to_transport(message.data)])
+        else:
+            item = (None, args + [_to_transport(message.data)])
+        self._messages.put(item)
+
+    def _replay(self, what, payload):
+        '''Repeat something the worker did in the main process.
+
+        Raises
+        ------
+        RuntimeError
+            If the subscriber raised an exception in the worker
+        '''
+        if what == 'network':
+            global_step, train_step, epoch, kind, data, tag = payload
+            self._msg_bus.publish_network_message(global_step, train_step, epoch, kind, data,
+                                                  tag=tag)
+        elif what == 'module':
+            global_step, train_step, epoch, kind, name, data, tag = payload
+            named_module = self._modules.get(name, NamedModule(None, name))
+            self._msg_bus.publish_module_message(global_step, train_step, epoch, kind,
+                                                 named_module, data, tag=tag)
+        elif what == 'backend':
+            method, args, kwargs = payload
+            getattr(self._subscriber.backend, method)(*args, **kwargs)
+        elif what == 'topic':
+            type, kind = payload
+            if type == 'DATA':
+                self._msg_bus.register_data_topic(kind)
+            else:
+                self._msg_bus.register_meta_topic(kind)
+        elif what == 'error':
+            raise RuntimeError(f'Error in subscriber process:\n{payload}')
+
+    def _drain(self, until=None):
+        '''Replay everything the worker has sent so far.
+
+        Parameters
+        ----------
+        until   :   str or None
+                    If given, block until a result of this type arrives
+        '''
+        while True:
+            try:
+                what, payload = self._results.get(block=until is not None, timeout=1)
+            except queue.Empty:
+                if until is None:
+                    return
+                elif not self._process.is_alive():
+                    raise RuntimeError('Subscriber process died unexpectedly')
+                continue
+            if what == until:
+                return
+            self._replay(what, payload)
+
+    def flush(self):
+        '''Wait until the worker has processed all messages and replay its results.'''
+        if self._process.is_alive():
+            self._messages.put('flush')
+            self._drain(until='flushed')
+
+    def close(self):
+        '''Process all pending messages and stop the worker.'''
+        if self._process.is_alive():
+            self._msg_bus.deregister_subscriber(self)
+            self._messages.put(None)
+            try:
+                self._drain(until='closed')
+            except Exception:
+                self._process.terminate()
+                raise
+            self._messages.put(None)
+            self._process.join()
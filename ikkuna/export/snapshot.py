@@ -0,0 +1,308 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains the :class:`SnapshotStore` which the :class:`~ikkuna.export.Exporter` uses for
+remembering parameter values between training steps without allocating new tensors in every step,
+the :class:`StateSnapshot` for temporarily evaluating a model with an earlier state and the
+:class:`ShadowModel` for evaluating an earlier state while the model continues training.
+'''
+from contextlib import contextmanager
+import copy
+import types
+
+import torch
+
+
+class SnapshotStore(object):
+    '''A dictionary-like store of tensor snapshots. For each key, two persistent buffers are kept
+    which are alternately overwritten in place, so that the most recent snapshot stays valid while
+    the next one is taken. Differences between a tensor and its snapshot are written into a third
+    reusable buffer. After the first snapshot of each key, no further memory is allocated unless the
+    shape, dtype or device of the tensor changes (e.g. because the model was moved to the GPU).
+
+    .. warning::
+        The tensors returned from :meth:`__getitem__` and :meth:`difference` are the store's own
+        buffers and will be overwritten by later calls. Copy them if you need to hold on to them for
+        longer than a training step.
+
+    Attributes
+    ----------
+    _buffers    :   dict(object, list(torch.Tensor))
+                    Pair of snapshot buffers for each key
+    _front  :   dict(object, int)
+                Index of the buffer holding the most recent snapshot
+    _differences    :   dict(object, torch.Tensor)
+                        Reusable output buffer for :meth:`difference`
+    '''
+
+    def __init__(self):
+        self._buffers     = {}
+        self._front       = {}
+        self._differences = {}
+
+    @staticmethod
+    def _compatible(buffer, tensor):
+        '''Check whether ``tensor`` can be copied into ``buffer`` without reallocation.'''
+        return (buffer.shape == tensor.shape and buffer.dtype == tensor.dtype
+                and buffer.device == tensor.device)
+
+    def _buffers_for(self, key, tensor):
+        '''Get the snapshot buffers for ``key``, allocating them like ``tensor`` if they do not
+        exist or don't match it. If a previous snapshot exists, it is carried over into the new
+        buffers.
+
+        Returns
+        -------
+        list(torch.Tensor)
+        '''
+        buffers = self._buffers.get(key)
+        if buffers is None or not self._compatible(buffers[0], tensor):
+            new_buffers = [torch.empty_like(tensor, memory_format=torch.contiguous_format)
+                           for _ in range(2)]
+            front = self._front.get(key, 0)
+            if buffers is not None and buffers[front].shape == tensor.shape:
+                with torch.no_grad():
+                    new_buffers[front].copy_(buffers[front])
+            self._buffers[key] = buffers = new_buffers
+            self._front[key]   = front
+            self._differences.pop(key, None)
+        return buffers
+
+    def snapshot(self, key, tensor):
+        '''Record the current value of ``tensor`` under ``key``. The previous snapshot remains
+        untouched until the next call.
+
+        Parameters
+        ----------
+        key :   object
+        tensor  :   torch.Tensor
+
+        Returns
+        -------
+        torch.Tensor
+            The snapshot
+        '''
+        buffers = self._buffers_for(key, tensor)
+        back    = 1 - self._front[key]
+        with torch.no_grad():
+            buffers[back].copy_(tensor)
+        self._front[key] = back
+        return buffers[back]
+
+    def difference(self, key, tensor):
+        '''Compute ``tensor - snapshot`` into a reusable buffer.
+
+        Parameters
+        ----------
+        key :   object
+        tensor  :   torch.Tensor
+
+        Returns
+        -------
+        torch.Tensor
+        '''
+        snapshot = self._buffers_for(key, tensor)[self._front[key]]
+        out      = self._differences.get(key)
+        if out is None:
+            out = self._differences[key] = torch.empty_like(snapshot)
+        with torch.no_grad():
+            torch.sub(tensor, snapshot, out=out)
+        return out
+
+    def pop(self, key, default=None):
+        '''Remove a key and free its buffers.
+
+        Returns
+        -------
+        torch.Tensor
+            The most recent snapshot or ``default`` if there is none
+        '''
+        if key not in self._buffers:
+            return default
+        snapshot = self[key]
+        del self._buffers[key]
+        del self._front[key]
+        self._differences.pop(key, None)
+        return snapshot
+
+    def clear(self):
+        '''Remove all snapshots.'''
+        self._buffers.clear()
+        self._front.clear()
+        self._differences.clear()
+
+    def keys(self):
+        return self._buffers.keys()
+
+    def items(self):
+        '''Iterate over pairs of key and most recent snapshot.'''
+        for key in list(self._buffers.keys()):
+            yield key, self[key]
+
+    def __getitem__(self, key):
+        '''Get the most recent snapshot for ``key``.'''
+        return self._buffers[key][self._front[key]]
+
+    def __contains__(self, key):
+        return key in self._buffers
+
+    def __iter__(self):
+        return iter(list(self._buffers.keys()))
+
+    def __len__(self):
+        return len(self._buffers)
+
+
+class StateSnapshot(object):
+    '''A copy of all parameters and buffers of a model, which can be swapped into the model
+    temporarily. This allows evaluating the model as it was at some earlier step, e.g. for comparing
+    the activations of two checkpoints on the same inputs. Swapping only exchanges the tensors'
+    storage, so it does not copy any data.
+
+    .. code-block:: python
+
+        snapshot = StateSnapshot(model)
+        snapshot.capture()
+        # train for a while
+        with snapshot.swapped_in():
+            old_output = model(X)
+
+    Attributes
+    ----------
+    _model  :   torch.nn.Module
+    _state  :   dict(str, torch.Tensor)
+                The captured tensors by name
+    '''
+
+    def __init__(self, model):
+        '''
+        Parameters
+        ----------
+        model   :   torch.nn.Module
+        '''
+        self._model = model
+        self._state = {}
+
+    def _tensors(self):
+        yield from self._model.named_parameters()
+        yield from self._model.named_buffers()
+
+    @property
+    def captured(self):
+        '''bool: Whether a state has been captured'''
+        return bool(self._state)
+
+    def capture(self):
+        '''Copy the model's current state, reusing the buffers of the previous capture.'''
+        with torch.no_grad():
+            for name, tensor in self._tensors():
+                buffer = self._state.get(name)
+                if buffer is None or not SnapshotStore._compatible(buffer, tensor):
+                    self._state[name] = tensor.detach().clone()
+                else:
+                    buffer.copy_(tensor)
+
+    def _swap(self):
+        for name, tensor in self._tensors():
+            self._state[name], tensor.data = tensor.data, self._state[name]
+
+    @contextmanager
+    def swapped_in(self):
+        '''Context manager in which the model has the captured state. The model's own state is
+        restored when leaving it.
+
+        Raises
+        ------
+        RuntimeError
+            If no state was captured
+        '''
+        if not self.captured:
+            raise RuntimeError('No state captured yet.')
+        self._swap()
+        try:
+            yield
+        finally:
+            self._swap()
+
+
+def _detached_copy(model):
+    '''Deep-copy a model without its hooks and without methods patched onto the instance (e.g. by
+    the :class:`~ikkuna.export.Exporter`), which would otherwise be copied along with everything
+    they reference.'''
+    memo    = {}
+    patched = []
+    for module in model.modules():
+        for name, value in vars(module).items():
+            if name.endswith('_hooks') and isinstance(value, dict):
+                memo[id(value)] = type(value)()
+            elif isinstance(value, types.MethodType):
+                memo[id(value)] = None
+                patched.append(name)
+    shadow = copy.deepcopy(model, memo)
+    for module in shadow.modules():
+        for name in patched:
+            vars(module).pop(name, None)
+    return shadow
+
+
+class ShadowModel(object):
+    '''A second instance of a model, without any hooks, into which the model's parameters and
+    buffers are copied by :meth:`capture()`. The shadow can then be evaluated, e.g. on a background
+    thread, while the model continues training. It is always in evaluation mode and does not
+    require gradients. The copy is made on the model's device and reuses the shadow's tensors, so
+    capturing costs no more than a device-side copy of the state.
+
+    For CUDA models, an event is recorded after the copy. Work on other streams must wait for it
+    with :meth:`wait()` before using the shadow.
+
+    The shadow can also be kept on a different device, e.g. on the CPU in shared memory, so that
+    worker processes forked afterwards see every capture without the state being sent to them.
+
+    Attributes
+    ----------
+    _model  :   torch.nn.Module
+    _shadow :   torch.nn.Module
+    _event  :   torch.cuda.Event or None
+                Event recorded after the last capture
+    '''
+
+    def __init__(self, model, device=None, shared=False):
+        '''
+        Parameters
+        ----------
+        model   :   torch.nn.Module
+        device  :   torch.device or str or None
+                    Device to keep the shadow on. Defaults to the one of the model.
+        shared  :   bool
+                    Move the shadow's tensors to shared memory (only on the CPU)
+        '''
+        self._model  = model
+        self._shadow = _detached_copy(model).eval().requires_grad_(False)
+        if device is not None:
+            self._shadow.to(device)
+        if shared:
+            self._shadow.share_memory()
+        self._event  = None
+
+    @property
+    def module(self):
+        '''torch.nn.Module: The shadow instance'''
+        return self._shadow
+
+    def _pairs(self):
+        yield from zip(self._shadow.parameters(), self._model.parameters())
+        yield from zip(self._shadow.buffers(), self._model.buffers())
+
+    def capture(self):
+        '''Copy the model's current state into the shadow.'''
+        with torch.no_grad():
+            for shadow_tensor, tensor in self._pairs():
+                shadow_tensor.copy_(tensor, non_blocking=True)
+        if next(self._shadow.parameters()).is_cuda:
+            self._event = torch.cuda.Event()
+            self._event.record()
+
+    def wait(self):
+        '''Make the current stream wait until the last capture is complete.'''
+        if self._event is not None:
+            torch.cuda.current_stream().wait_event(self._event)
@@ -2,10 +2,10 @@ import importlib
 import pkg_resources
 
 from .subscriber import (Subscriber, Subscription, SynchronizedSubscription, PlotSubscriber,
-                         CallbackSubscriber)
+                         CallbackSubscriber, MetricAccumulator, BatchedMixin)
 
 __all__ = ['Subscriber', 'Subscription', 'SynchronizedSubscription', 'PlotSubscriber',
-           'CallbackSubscriber']
+           'CallbackSubscriber', 'MetricAccumulator', 'BatchedMixin']
 
 ####################################################################################################
 #                                             PLUGINS                                              #
@@ -0,0 +1,61 @@
+from ikkuna.export.subscriber.svcca import StreamingSVCCASubscriber
+from ikkuna.export.messages import get_default_bus
+from ikkuna.utils.cka import CKAAccumulator
+
+
+class CKASubscriber(StreamingSVCCASubscriber):
+    '''A subscriber which computes the linear CKA similarity between every layer's representation at
+    the previous checkpoint and the current one, as a cheaper replacement for
+    :class:`~ikkuna.export.subscriber.StreamingSVCCASubscriber` on large models. The probe set is
+    propagated in the same way, but instead of covariances over channels, the minibatch estimator
+    averages the unbiased HSIC of the linear kernel matrices of each batch. Only three scalars are
+    kept per layer, the memory needed for a batch is quadratic in the batch size, and no
+    decomposition is computed.
+
+    The whole activation of a datapoint, including all spatial locations, is its representation.
+    Batches of fewer than four datapoints are ignored, so ``n`` should be a multiple of
+    ``batch_size`` or leave a large enough remainder.
+
+    The same ``self_similarity`` topic as for the SVCCA subscribers is published and layers are
+    frozen in the same way.
+    '''
+
+    # tag of the probe passes, which must not be picked up by the SVCCA subscribers
+    _probe_tag = 'cka_testing'
+
+    def __init__(self, dataset_meta, n, model, freeze_at=10, batch_size=256,
+                 message_bus=get_default_bus(), tag='default', subsample=1, ylims=None,
+                 backend='tb', reducer=None):
+        '''
+        Parameters
+        ----------
+        dataset_meta    :   ikkuna.utils.DatasetMeta
+                            Dataset to load data from for retrieving activations
+        n   :   int
+                Number of datapoints to randomly sample
+        model   :   torch.nn.Module
+                    The model, whose (patched) ``forward()`` is used for the probe passes and whose
+                    state is captured at every checkpoint
+        freeze_at   :   float
+                        Similarity threshold after which a layer is frozen. Values >= 1 will turn
+                        off freezing
+        batch_size  :   int
+                        Batch size to use for forward passes. Larger batches reduce the variance of
+                        the estimate.
+        reducer :   ikkuna.utils.sketch.ActivationReducer or None
+                    Reduction applied to the activations on their device before their kernel
+                    matrices are computed
+        '''
+        super().__init__(dataset_meta, n, model, freeze_at=freeze_at, batch_size=batch_size,
+                         message_bus=message_bus, tag=tag, subsample=subsample, ylims=ylims,
+                         backend=backend, reducer=reducer)
+
+    def _new_accumulator(self):
+        return CKAAccumulator()
+
+    def _representation(self, activations):
+        return activations
+
+    def _similarities(self):
+        return {module: accumulator.similarity()
+                for module, accumulator in self._accumulators.items() if accumulator.n > 0}
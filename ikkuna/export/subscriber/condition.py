@@ -1,16 +1,26 @@
-import torch
-from torch.nn.functional import normalize
-
 from ikkuna.export.subscriber import PlotSubscriber, Subscription
 from ikkuna.export.messages import get_default_bus
+from ikkuna.utils.linalg import as_matrix, extreme_singular_values
 
 
 class ConditionNumberSubscriber(PlotSubscriber):
     '''A Subscriber which computes the condition number of a matrix. Not sure what this is useful
-    for, but maybe for Linear layers.'''
+    for, but maybe for Linear layers.
+
+    The condition number is the ratio of the largest and smallest singular values. Both are found
+    from the smaller Gram matrix of the reshaped weights, exactly for most layers and by restarted
+    Lanczos iteration for very large ones. This is much cheaper than a pseudo-inverse or full SVD.
+    The Ritz vectors of each module are kept for warm-starting at the next step, when the weights
+    have changed only a little.
+
+    Attributes
+    ----------
+    _start  :   dict(str, torch.Tensor)
+                Start vectors for the next iteration, per module
+    '''
 
     def __init__(self, kind, message_bus=get_default_bus(), tag='default', subsample=1, ylims=None,
-                 backend='tb'):
+                 backend='tb', k=64, n_restarts=20, tol=1e-6, exact_size=4096):
         '''
         Parameters
         ----------
@@ -18,7 +28,15 @@ class ConditionNumberSubscriber(PlotSubscriber):
                     Message kind to compute condition number norm on. Not sure if it makes sense
                     for non-2d matrices, which have to be reshaped to 2-d
                     non-matrix type.
-
+        k   :   int
+                Size of the Krylov subspace per restart
+        n_restarts  :   int
+                        Maximum number of restarts of the iteration
+        tol :   float
+                Relative change of the squared smallest singular value below which the iteration
+                stops
+        exact_size  :   int
+                        Layers with at most this many rows or columns are handled exactly
 
         For other parameters, see :class:`~ikkuna.export.subscriber.PlotSubscriber`
         '''
@@ -39,8 +57,11 @@ class ConditionNumberSubscriber(PlotSubscriber):
                           'ylabel': ylabel},
                          backend=backend)
         self._add_publication(f'{kind}_condition_number', type='DATA')
-        self.u = dict()
-        self.u_inv = dict()
+        self._k          = k
+        self._n_restarts = n_restarts
+        self._tol        = tol
+        self._exact_size = exact_size
+        self._start      = dict()
 
     def compute(self, message):
         '''A :class:`~ikkuna.export.messages.ModuleMessage`
@@ -48,32 +69,15 @@ class ConditionNumberSubscriber(PlotSubscriber):
 
         module, module_name = message.key
         # get and reshape the weight tensor to 2d
-        weights             = message.data
-        height              = weights.size(0)
-        weights2d           = weights.reshape(height, -1)
-        width               = weights2d.size(1)
-        weights2d_inv       = torch.pinverse(weights2d)
-
-        # buffer for power iteration (don't know what the mahematical purpose is)
-        if module_name not in self.u:
-            self.u[module_name] = normalize(weights2d.new_empty(height).normal_(0, 1), dim=0)
-            self.u_inv[module_name] = normalize(weights2d_inv.new_empty(width).normal_(0, 1), dim=0)
-
-        # estimate singular values
-        with torch.no_grad():
-            for _ in range(3):      # TODO: Make niter parameter
-                v = normalize(torch.matmul(weights2d.t(), self.u[module_name]), dim=0)
-                self.u[module_name] = normalize(torch.matmul(weights2d, v), dim=0)
-
-                v_inv = normalize(torch.matmul(weights2d_inv.t(), self.u_inv[module_name]), dim=0)
-                self.u_inv[module_name] = normalize(torch.matmul(weights2d_inv, v_inv), dim=0)
-
-        norm = torch.dot(self.u[module_name], torch.matmul(weights2d, v)).item()
-        norm_inv = torch.dot(self.u_inv[module_name], torch.matmul(weights2d_inv, v_inv)).item()
+        weights2d = as_matrix(message.data)
 
-        condition = norm / norm_inv
+        sigma_max, sigma_min, self._start[module_name] = extreme_singular_values(
+            weights2d, start=self._start.get(module_name), k=self._k, n_restarts=self._n_restarts,
+            tol=self._tol, exact_size=self._exact_size
+        )
+        condition = (sigma_max / sigma_min).to(weights2d.dtype)
 
-        self._backend.add_data(module_name, condition, message.global_step)
+        self._add_scalar(module_name, condition, message.global_step)
 
         kind = f'{message.kind}_condition_number'
         self.message_bus.publish_module_message(message.global_step,
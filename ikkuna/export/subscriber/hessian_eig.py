@@ -1,30 +1,41 @@
+from contextlib import ExitStack
+
 from ikkuna.export.subscriber import PlotSubscriber, Subscription
 from ikkuna.export.messages import get_default_bus
-
-from hessian_eigenthings import compute_hessian_eigenthings
+from ikkuna.utils.hessian import HessianOperator
+from ikkuna.utils.linalg import lanczos, hutchinson_trace
 
 
 class HessianEigenSubscriber(PlotSubscriber):
     '''
-    .. note::
-        This subscriber is only installed if `hessian_eigenthings` can be imported at install-time.
-        See `https://github.com/noahgolmant/pytorch-hessian-eigenthings/`.
+    A subscriber to compute the top-k eigenvalues of the hessian of the loss w.r.t. the weights and
+    an estimate of its trace. The eigenvalues are found with the Lanczos iteration on
+    Hessian-vector products, which are computed with double backpropagation through the model. This
+    operation is _very_ expensive, since it involves differentiating twice. Since the weights must
+    be fixed, gradients from training cannot be reused. The products are computed in a separate
+    probe pass, so the training backward pass never needs to build a second-order graph.
 
-    A subscriber to compute the top-k eigenvalues of the hessian of the loss w.r.t. the weights.
-    This is done by using defalted power iteration from Noah Golmant's ``hessian_eigenthings``
-    module, which has to be installed. This operation is _very_ expensive, since it involves
-    differentiating twice over a subset of the training data. Since the weights must be fixed,
-    gradients from training cannot be reused.
+    To make the estimates comparable between steps, the Hessian is always computed over the same
+    probe set of ``batch_size`` samples, which is taken from the data loader once and kept on the
+    model's device. The iteration is warm-started from the eigenvectors of the previous
+    computation, which usually converges in far fewer steps than a random start.
 
-    .. warning::
-        In my experiments, the power iteration from ``hessian_eigenthings`` does not really work;
-        the estimates do not converge to a single value when increasing the number of steps, but
-        rather are all over the place. Investigation needed.
+    Attributes
+    ----------
+    _parameters :   list(torch.nn.Parameter) or None
+                    Parameters of the tracked modules, collected on first use
+    _batches    :   list(tuple(torch.Tensor, torch.Tensor)) or None
+                    The cached probe set
+    _eigenvectors   :   torch.Tensor or None
+                        Eigenvectors from the last computation, of shape ``(N, num_eig)``
     '''
 
+    # runs the model itself
+    requires_main_thread = True
+
     def __init__(self, forward_fn, loss_fn, data_loader, batch_size, frequency=1, num_eig=1,
-                 power_steps=20, tag='default', message_bus=get_default_bus(), ylims=None,
-                 backend='tb'):
+                 lanczos_steps=20, tol=1e-3, trace_samples=10, exporter=None, tag='default',
+                 message_bus=get_default_bus(), ylims=None, backend='tb'):
         '''
         Parameters
         ----------
@@ -34,23 +45,33 @@ class HessianEigenSubscriber(PlotSubscriber):
         loss_fn     :   torch.nn.Module
                         Loss function (such as :class:`torch.nn.CrossEntropyLoss`)
         data_loader :   torch.utils.data.DataLoader
-                        Loader for the dataset to compute gradients over
-        batch_finished  :   int
-                            Number of samples to compute gradients for in one step of power iteration
-                            More should lead to a better estimate
+                        Loader for the dataset to take the probe set from
+        batch_size  :   int
+                        Number of samples in the probe set. More should lead to a better estimate,
+                        but all of them are kept on the device and the graphs of their gradients
+                        must fit into memory at once.
         frequency   :   int
                         How often to compute the eigenvalues (after every nth batch)
         num_eig :   int
                     Number of top eigenvalues to compute
-        power_iter_steps    :   int
-                                Number of steps in the power iteration for computing a singular value.
-                                The total number of batches read is then ``power_iter_steps * num_eig``
-                                More steps should lead to a better estimate.
+        lanczos_steps   :   int
+                            Maximum number of Lanczos steps, each of which costs one
+                            Hessian-vector product over the probe set
+        tol :   float or None
+                Relative change of the eigenvalues below which the iteration stops early
+        trace_samples   :   int
+                            Number of random vectors for estimating the trace. ``0`` disables the
+                            estimate.
+        exporter    :   ikkuna.export.Exporter or None
+                        Exporter of the model. If given, the Hessian is taken w.r.t. the parameters
+                        of its tracked modules and its hooks are silenced while differentiating.
+                        Otherwise, all parameters of the model ``forward_fn`` is bound to are used
+                        and the probe gradients are published like the ones from training.
         '''
         title  = f'Top hessian Eigenvalues'
-        ylabel = 'tbd'
+        ylabel = 'Eigenvalue'
         xlabel = 'Train step'
-        subscription = Subscription(self, ['batch_finished', 'activations'], tag=tag)
+        subscription = Subscription(self, ['batch_finished'], tag=tag)
         super().__init__([subscription],
                          message_bus,
                          {'title': title,
@@ -59,26 +80,83 @@ class HessianEigenSubscriber(PlotSubscriber):
                           'xlabel': xlabel},
                          backend=backend)
 
-        self._forward_fn = forward_fn
-        self._loss_fn = loss_fn
-        self._power_steps = power_steps
-        self._dataloader = data_loader
-        self._parameters = set()
-        self._num_eig = num_eig
-        self._frequency = frequency
+        self._forward_fn    = forward_fn
+        self._loss_fn       = loss_fn
+        self._dataloader    = data_loader
+        self._batch_size    = batch_size
+        self._parameters    = None
+        self._num_eig       = num_eig
+        self._frequency     = frequency
+        self._lanczos_steps = lanczos_steps
+        self._tol           = tol
+        self._trace_samples = trace_samples
+        self._exporter      = exporter
+        self._batches       = None
+        self._eigenvectors  = None
+
+        self._add_publication('hessian_eigenvalues', type='META')
+        if trace_samples > 0:
+            self._add_publication('hessian_trace', type='META')
+
+    def _probe_batches(self):
+        '''Take the probe set from the data loader and move it to the device on first use.'''
+        if self._batches is None:
+            device        = self._module_parameters()[0].device
+            self._batches = []
+            n_samples     = 0
+            for X, Y in self._dataloader:
+                X, Y = X[:self._batch_size - n_samples], Y[:self._batch_size - n_samples]
+                self._batches.append((X.to(device, non_blocking=True),
+                                      Y.to(device, non_blocking=True)))
+                n_samples += X.shape[0]
+                if n_samples >= self._batch_size:
+                    break
+        return self._batches
+
+    def _module_parameters(self):
+        '''Collect the parameters to differentiate w.r.t. on first use.'''
+        if self._parameters is None:
+            if self._exporter is not None:
+                parameters = dict()
+                for module in self._exporter.modules:
+                    for p in module.parameters():
+                        parameters.setdefault(id(p), p)
+                self._parameters = list(parameters.values())
+            else:
+                self._parameters = list(self._forward_fn.__self__.parameters())
+        return self._parameters
+
+    def _predict(self, X):
+        # an evaluation pass nobody subscribed to, but with autograd
+        return self._forward_fn(X, should_train=False, tag='hessian', enable_grad=True)
 
     def compute(self, message):
-        if message.kind == 'activations':
-            module = message.key.module
-            for p in module.parameters():
-                self._parameters.add(p)
-        else:
-            if self.subscriptions['batch_finished'].counter['batch_finished'] % self._frequency == 0:
-                evals, evecs = compute_hessian_eigenthings(self._forward_fn,
-                                                           self._parameters,
-                                                           self._dataloader,
-                                                           self._loss_fn,
-                                                           power_iter_steps=self._power_steps,
-                                                           num_eigenthings=self._num_eig)
-                for i, val in enumerate(sorted(evals)):
-                    self.backend.add_data(f'Eigenvalue {i}', evals[i], message.global_step)
+        '''The eigenvalues are published as a :class:`~ikkuna.export.messages.NetworkMessage` with
+        the identifier ``hessian_eigenvalues``, the trace estimate as ``hessian_trace``.'''
+        if self.subscriptions['batch_finished'].counter['batch_finished'] % self._frequency == 0:
+            parameters = self._module_parameters()
+            with ExitStack() as stack:
+                if self._exporter is not None:
+                    stack.enter_context(self._exporter.silenced())
+                H = stack.enter_context(HessianOperator(self._predict, self._loss_fn, parameters,
+                                                        self._probe_batches()))
+
+                if self._eigenvectors is not None and self._eigenvectors.size(0) == H.size:
+                    start = self._eigenvectors.sum(1)
+                else:
+                    start = H.random_vector()
+                evals, self._eigenvectors, _ = lanczos(H.matvec, start, num_eig=self._num_eig,
+                                                       n_steps=self._lanczos_steps, tol=self._tol)
+                if self._trace_samples > 0:
+                    trace = hutchinson_trace(H.matvec, start, n_samples=self._trace_samples)
+
+            for i, val in enumerate(evals):
+                self._add_scalar(f'Eigenvalue {i}', val, message.global_step)
+            self.message_bus.publish_network_message(message.global_step, message.train_step,
+                                                     message.epoch, 'hessian_eigenvalues',
+                                                     data=evals)
+            if self._trace_samples > 0:
+                self._add_scalar('Trace', trace, message.global_step)
+                self.message_bus.publish_network_message(message.global_step, message.train_step,
+                                                         message.epoch, 'hessian_trace',
+                                                         data=trace)
@@ -1,14 +1,32 @@
 from ikkuna.export.subscriber import PlotSubscriber, Subscription
 from ikkuna.export.messages import get_default_bus
+from ikkuna.utils.histogram import HistogramBinner
 
 
 class HistogramSubscriber(PlotSubscriber):
 
     '''A :class:`~ikkuna.export.subscriber.Subscriber` which subsamples training artifacts and
     computes histograms per epoch.  Histograms are non-normalized.
+
+    The histograms are computed with a fixed number of bins on the device the data lives on, and
+    only the bin counts are handed to the backend.
+
+    Attributes
+    ----------
+    _binner :   ikkuna.utils.histogram.HistogramBinner
     '''
 
-    def __init__(self, kind, message_bus=get_default_bus(), tag='default', subsample=1, backend='tb'):
+    def __init__(self, kind, message_bus=get_default_bus(), tag='default', subsample=1,
+                 backend='tb', bins=50, range=None):
+        '''
+        Parameters
+        ----------
+        bins    :   int
+                    Number of bins
+        range   :   tuple(float, float) or None
+                    Range of the bins. Values outside of it are counted in the outermost bins.
+                    ``None`` adapts the range to the values seen for each module so far.
+        '''
 
         if not isinstance(kind, str):
             raise ValueError('HistogramSubscriber only accepts 1 kind')
@@ -16,17 +34,18 @@ class HistogramSubscriber(PlotSubscriber):
         subscription = Subscription(self, [kind], tag=tag, subsample=subsample)
         title        = f'{kind}_histogram'
         ylabel       = 'Frequency'
-        super().__init__([subscription], message_bus, {'title': title, 'ylabel': ylabel},
+        super().__init__([subscription], message_bus,
+                         {'title': title, 'ylabel': ylabel, 'bins': bins, 'range': range},
                          backend=backend)
+        self._binner = HistogramBinner(bins, range)
 
     def compute(self, message):
         '''
         .. note::
-            Since the histogram is computed by the visualization backend (there's no practical way
-            around it), this subscriber does *not* publish a
-            :class:`~ikkuna.export.messages.ModuleMessage`
+            The histogram is handed to the visualization backend directly, so this subscriber does
+            *not* publish a :class:`~ikkuna.export.messages.ModuleMessage`
         '''
 
         module, name = message.key
-        data         = message.data
-        self._backend.add_histogram(name, data, message.global_step)
+        histogram    = self._binner(name, message.data)
+        self._backend.add_histogram(name, histogram, message.global_step)
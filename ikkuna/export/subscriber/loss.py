@@ -21,4 +21,4 @@ class LossSubscriber(PlotSubscriber):
 
     def compute(self, message):
         data = message.data
-        self._backend.add_data('loss', data, message.global_step)
+        self._add_scalar('loss', data, message.global_step)
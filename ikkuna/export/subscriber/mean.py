@@ -1,11 +1,23 @@
-from ikkuna.export.subscriber import PlotSubscriber, Subscription
+from ikkuna.export.subscriber import PlotSubscriber, Subscription, BatchedMixin
 from ikkuna.export.messages import get_default_bus
+from ikkuna.utils.batched import means
 
 
-class MeanSubscriber(PlotSubscriber):
+class MeanSubscriber(BatchedMixin, PlotSubscriber):
+    '''A :class:`~ikkuna.export.subscriber.Subscriber` which computes the average of a quantity and
+    publishes it as ``{kind}_mean``.'''
+
+    _suffix = 'mean'
 
     def __init__(self, kind, message_bus=get_default_bus(), tag='default', subsample=1, ylims=None,
-                 backend='tb'):
+                 backend='tb', batched=False):
+        '''
+        Parameters
+        ----------
+        batched :   bool
+                    Compute the means of each step at once (see
+                    :class:`~ikkuna.export.subscriber.BatchedMixin`)
+        '''
 
         if not isinstance(kind, str):
             raise ValueError('MeanSubscriber only accepts 1 kind')
@@ -13,7 +25,8 @@ class MeanSubscriber(PlotSubscriber):
         title        = f'{kind}_mean'
         ylabel       = 'Mean'
         xlabel       = 'Train step'
-        subscription = Subscription(self, [kind], tag=tag, subsample=subsample)
+        kinds        = self._batched_kinds(kind, batched)
+        subscription = Subscription(self, kinds, tag=tag, subsample=subsample)
         super().__init__([subscription], message_bus,
                          {'title': title,
                           'ylabel': ylabel,
@@ -22,18 +35,8 @@ class MeanSubscriber(PlotSubscriber):
                          backend=backend)
         self._add_publication(f'{kind}_mean', type='DATA')
 
-    def compute(self, message):
-        '''Compute the average of a quantity. A :class:`~ikkuna.export.messages.ModuleMessage`
-        with the identifier ``{kind}_mean`` is published. '''
-
-        module, module_name  = message.key
-
-        data = message.data
-        mean = data.mean()
-        self._backend.add_data(module_name, mean, message.global_step)
+    def _statistic(self, tensor):
+        return tensor.mean()
 
-        kind = f'{message.kind}_mean'
-        self.message_bus.publish_module_message(message.global_step,
-                                                message.train_step,
-                                                message.epoch, kind,
-                                                message.key, mean)
+    def _statistics(self, tensors):
+        return means(tensors)
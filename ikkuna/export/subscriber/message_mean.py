@@ -35,7 +35,7 @@ class MessageMeanSubscriber(PlotSubscriber):
             for kind, values in self._buffer.items():
                 mean = sum(values) / len(values)
                 topic = f'{kind}_message_mean'
-                self._backend.add_data(topic, mean, message.global_step)
+                self._add_scalar(topic, mean, message.global_step)
 
                 self.message_bus.publish_network_message(message.global_step,
                                                          message.train_step,
@@ -1,11 +1,21 @@
-from ikkuna.export.subscriber import PlotSubscriber, Subscription
+from ikkuna.export.subscriber import PlotSubscriber, Subscription, BatchedMixin
 from ikkuna.export.messages import get_default_bus
+from ikkuna.utils.batched import norms
 
 
-class NormSubscriber(PlotSubscriber):
+class NormSubscriber(BatchedMixin, PlotSubscriber):
+    '''A :class:`~ikkuna.export.subscriber.Subscriber` which computes the norm of a quantity and
+    publishes it as ``{kind}_norm{order}``.'''
 
     def __init__(self, kind, message_bus=get_default_bus(), tag='default', subsample=1, ylims=None,
-                 backend='tb', order=2):
+                 backend='tb', order=2, batched=False):
+        '''
+        Parameters
+        ----------
+        batched :   bool
+                    Compute the norms of each step at once (see
+                    :class:`~ikkuna.export.subscriber.BatchedMixin`)
+        '''
 
         if not isinstance(kind, str):
             raise ValueError('NormSubscriber only accepts 1 kind')
@@ -13,7 +23,8 @@ class NormSubscriber(PlotSubscriber):
         title        = f'{kind}_norm{order}'
         ylabel       = f'L{order} Norm'
         xlabel       = 'Train step'
-        subscription = Subscription(self, [kind], tag=tag, subsample=subsample)
+        kinds        = self._batched_kinds(kind, batched)
+        subscription = Subscription(self, kinds, tag=tag, subsample=subsample)
         super().__init__([subscription], message_bus,
                          {'title': title,
                           'ylabel': ylabel,
@@ -21,20 +32,11 @@ class NormSubscriber(PlotSubscriber):
                           'xlabel': xlabel},
                          backend=backend)
         self._order  = order
+        self._suffix = f'norm{order}'
         self._add_publication(f'{kind}_norm{order}', type='DATA')
 
-    def compute(self, message):
-        '''Compute the norm of a quantity. A :class:`~ikkuna.export.messages.ModuleMessage`
-        with the identifier ``{kind}_norm{order}`` is published. '''
+    def _statistic(self, tensor):
+        return tensor.norm(p=self._order)
 
-        module, module_name  = message.key
-
-        data = message.data
-        norm = data.norm(p=self._order)
-        self._backend.add_data(module_name, norm, message.global_step)
-
-        kind = f'{message.kind}_norm{self._order}'
-        self.message_bus.publish_module_message(message.global_step,
-                                                message.train_step,
-                                                message.epoch, kind,
-                                                message.key, norm)
+    def _statistics(self, tensors):
+        return norms(tensors, p=self._order)
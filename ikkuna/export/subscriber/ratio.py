@@ -54,9 +54,9 @@ class RatioSubscriber(PlotSubscriber):
 
         scale1              = dividend.norm()
         scale2              = divisor.norm()
-        ratio               = (scale1 / scale2).item()
+        ratio               = scale1 / scale2
 
-        self._backend.add_data(module_name, ratio, message_bundle.global_step)
+        self._add_scalar(module_name, ratio, message_bundle.global_step)
 
         kind = f'{message_bundle.kinds[0]}_{message_bundle.kinds[1]}_ratio'
         self.message_bus.publish_module_message(message_bundle.global_step,
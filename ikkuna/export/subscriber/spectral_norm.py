@@ -1,20 +1,50 @@
+from collections import defaultdict
+
 import torch
 from torch.nn.functional import normalize
 
 from ikkuna.export.subscriber import PlotSubscriber, Subscription
 from ikkuna.export.messages import get_default_bus
+from ikkuna.utils.linalg import as_matrix, power_iteration, top_singular
 
 
 class SpectralNormSubscriber(PlotSubscriber):
+    '''A Subscriber which estimates the spectral norm (largest singular value) of matrix-valued
+    messages by power iteration. The left singular vector of each module is kept between steps, so
+    that the iteration is warm-started and usually converges after a single iteration. Convergence
+    is checked for all modules iterated together at once, so this costs one device synchronisation
+    per group of modules and step.
+
+    Attributes
+    ----------
+    u   :   dict(str, torch.Tensor)
+            Current estimate of the left singular vector for each module
+    _sigma  :   dict(str, torch.Tensor)
+                Current estimate of the spectral norm for each module
+    _n_messages :   dict(str, int)
+                    Number of messages processed for each module, for scheduling exact SVDs
+    '''
 
     def __init__(self, kind, message_bus=get_default_bus(), tag='default', subsample=1, ylims=None,
-                 backend='tb'):
+                 backend='tb', n_iter=20, tol=1e-4, svd_every=None, batched=False):
         '''
         Parameters
         ----------
         kind    :   str
                     Message kind to compute spectral norm on. Doesn't make sense with kinds of
                     non-matrix type.
+        n_iter  :   int
+                    Maximum number of power iterations per message
+        tol :   float or None
+                Relative change of the estimate below which the iteration stops. ``None`` always
+                runs ``n_iter`` iterations without synchronising with the device.
+        svd_every   :   int or None
+                        Compute the exact value by SVD for every ``svd_every``-th message of a
+                        module to correct any drift of the estimate. ``None`` never does.
+        batched :   bool
+                    Collect the messages of each step and run the iteration for all modules with
+                    weights of the same shape at once when ``batch_finished`` arrives. Messages
+                    still pending are also processed on ``epoch_finished`` and by :meth:`close()`.
 
 
         For other parameters, see :class:`~ikkuna.export.subscriber.PlotSubscriber`
@@ -23,7 +53,8 @@ class SpectralNormSubscriber(PlotSubscriber):
         if not isinstance(kind, str):
             raise ValueError('SpectralNormSubscriber only accepts 1 kind')
 
-        subscription = Subscription(self, [kind], tag, subsample)
+        kinds        = [kind, 'batch_finished', 'epoch_finished'] if batched else [kind]
+        subscription = Subscription(self, kinds, tag, subsample)
 
         title = f'{kind}_spectral_norm'
         xlabel = 'Step'
@@ -35,7 +66,14 @@ class SpectralNormSubscriber(PlotSubscriber):
                           'ylims': ylims,
                           'ylabel': ylabel},
                          backend=backend)
-        self.u = dict()
+        self.u           = dict()
+        self._sigma      = dict()
+        self._n_messages = defaultdict(int)
+        self._n_iter     = n_iter
+        self._tol        = tol
+        self._svd_every  = svd_every
+        self._batched    = batched
+        self._buffer     = []
         self._add_publication(f'{kind}_spectral_norm', type='DATA')
 
     def compute(self, message):
@@ -47,25 +85,77 @@ class SpectralNormSubscriber(PlotSubscriber):
         A :class:`~ikkuna.export.messages.ModuleMessage`
         with the identifier ``{kind}_spectral_norm`` is published. '''
 
-        module, module_name = message.key
-        # get and reshape the weight tensor to 2d
-        weights             = message.data
-        height              = weights.size(0)
-        weights2d           = weights.reshape(height, -1)
-
-        # buffer for power iteration (don't know what the mahematical purpose is)
-        if module_name not in self.u:
-            self.u[module_name] = normalize(weights2d.new_empty(height).normal_(0, 1), dim=0)
-
-        # estimate singular values
-        with torch.no_grad():
-            for _ in range(3):      # TODO: Make niter parameter
-                v = normalize(torch.matmul(weights2d.t(), self.u[module_name]), dim=0)
-                self.u[module_name] = normalize(torch.matmul(weights2d, v), dim=0)
-
-        norm = torch.dot(self.u[module_name], torch.matmul(weights2d, v)).item()
+        if message.kind in ('batch_finished', 'epoch_finished'):
+            messages, self._buffer = self._buffer, []
+        elif self._batched:
+            self._buffer.append(message)
+            return
+        else:
+            messages = [message]
+        self._compute_messages(messages)
+
+    def close(self):
+        '''Publish the spectral norms of the messages still pending in batched mode.'''
+        messages, self._buffer = self._buffer, []
+        self._compute_messages(messages)
+
+    def _compute_messages(self, messages):
+        '''Compute and publish the spectral norms for a list of messages.'''
+        # modules with weights of the same shape are iterated together
+        groups = defaultdict(list)
+        for msg in messages:
+            weights2d = as_matrix(msg.data)
+            groups[(weights2d.shape, weights2d.device, weights2d.dtype)].append((msg, weights2d))
+
+        for group in groups.values():
+            names    = [msg.key.name for msg, _ in group]
+            matrices = torch.stack([weights2d for _, weights2d in group])
+            norms    = self._spectral_norms(names, matrices)
+            for (msg, _), norm in zip(group, norms.unbind()):
+                self._publish(msg, norm)
+
+    def _spectral_norms(self, names, matrices):
+        '''Estimate the spectral norms of a batch of matrices and update the persisted vectors.
 
-        self._backend.add_data(module_name, norm, message.global_step)
+        Parameters
+        ----------
+        names   :   list(str)
+                    Module name for each matrix
+        matrices    :   torch.Tensor
+                        Batch of matrices of shape ``(B, m, n)``
+
+        Returns
+        -------
+        torch.Tensor
+            Spectral norms of shape ``(B,)``
+        '''
+        for name in names:
+            self._n_messages[name] += 1
+
+        if self._svd_every and any(self._n_messages[name] % self._svd_every == 0
+                                   for name in names):
+            sigma, u = top_singular(matrices)
+        else:
+            # buffer for power iteration (don't know what the mahematical purpose is)
+            for name, matrix in zip(names, matrices):
+                if name not in self.u:
+                    self.u[name] = normalize(matrix.new_empty(matrix.size(0)).normal_(0, 1),
+                                             dim=0)
+            u = torch.stack([self.u[name] for name in names])
+            if all(name in self._sigma for name in names):
+                previous = torch.stack([self._sigma[name] for name in names])
+            else:
+                previous = None
+            sigma, u, _ = power_iteration(matrices, u, self._n_iter, self._tol, sigma=previous)
+
+        for name, u_i, sigma_i in zip(names, u.unbind(), sigma.unbind()):
+            self.u[name]      = u_i
+            self._sigma[name] = sigma_i
+        return sigma
+
+    def _publish(self, message, norm):
+        module, module_name = message.key
+        self._add_scalar(module_name, norm, message.global_step)
 
         kind = f'{message.kind}_spectral_norm'
         self.message_bus.publish_module_message(message.global_step,
@@ -6,7 +6,9 @@ This module contains the base definition for subscriber functionality. The
 
 '''
 import abc
+import threading
 from collections import defaultdict
+import torch
 import ikkuna.visualization
 from ikkuna.export.messages import MessageBundle, ModuleMessage, get_default_bus
 
@@ -69,6 +71,11 @@ class Subscription(object):
     def kinds(self):
         return self._kinds
 
+    @property
+    def tag(self):
+        '''str: Tag of the messages this subscription accepts'''
+        return self._tag
+
     def _handle_message(self, message):
         '''Process a newly arrived message. Subclasses should override this method for any special
         treatment.
@@ -158,7 +165,18 @@ class SynchronizedSubscription(Subscription):
 
 class Subscriber(abc.ABC):
     '''Base class for receiving and processing activations, gradients and other stuff into
-    insightful metrics.'''
+    insightful metrics.
+
+    Attributes
+    ----------
+    requires_main_thread    :   bool
+                                Class attribute which subclasses set if they must not be run on
+                                a background thread of an
+                                :class:`~ikkuna.export.messages.AsyncMessageBus`, e.g. because
+                                they run the model themselves
+    '''
+
+    requires_main_thread = False
 
     def __init__(self, subscriptions, message_bus):
         '''
@@ -235,6 +253,24 @@ class Subscriber(abc.ABC):
         '''
         pass
 
+    def needs_create_graph(self, global_step):
+        '''Declare whether the training step ``global_step`` should build the graph of its
+        gradients, so that this subscriber can differentiate through them (e.g. for
+        Hessian-vector products on the training batch). This doubles the cost of the backward pass,
+        so it is only done on steps at which some subscriber asks for it. Subscribers which run
+        their own probe pass with :func:`torch.autograd.grad()` do not need this.
+
+        Parameters
+        ----------
+        global_step :   int
+                        The step about to be backpropagated
+
+        Returns
+        -------
+        bool
+        '''
+        return False
+
     def receive_message(self, message):
         '''Process a single message received from an :class:`~ikkuna.export.messages.MessageBus`.'''
 
@@ -267,6 +303,109 @@ class Subscriber(abc.ABC):
         self.compute(message_or_bundle)
 
 
+class MetricAccumulator(Subscriber):
+    '''Subscriber which collects the scalar metrics of all
+    :class:`~ikkuna.export.subscriber.PlotSubscriber`\ s on a bus as tensors on their device and
+    hands them to the backends in bulk. Reading each scalar individually would force a device
+    synchronisation and a tiny transfer per module and step. Instead, all pending values on the same
+    device are stacked and copied to the host at once every :attr:`flush_every` steps (when
+    ``batch_finished`` arrives) and at the end of each epoch.
+
+    There is one accumulator per :class:`~ikkuna.export.messages.MessageBus`, obtained via
+    :meth:`for_bus()`. It is kept on the bus itself, so it lives exactly as long as the bus.
+
+    Attributes
+    ----------
+    _pending    :   dict(tuple(ikkuna.visualization.Backend, str, int), torch.Tensor or float)
+                    Values waiting to be plotted, keyed by backend (i.e. topic), module name and
+                    step
+    _last_flush :   int
+                    Global step of the last flush
+    '''
+
+    def __init__(self, message_bus, flush_every=1):
+        '''
+        Parameters
+        ----------
+        message_bus :   ikkuna.export.messages.MessageBus
+        flush_every :   int
+                        Number of steps between flushes
+        '''
+        self._pending     = {}
+        self._lock        = threading.Lock()
+        self._last_flush  = -1
+        self.flush_every  = flush_every
+        super().__init__([Subscription(self, ['batch_finished', 'epoch_finished'])], message_bus)
+
+    @classmethod
+    def for_bus(cls, message_bus, flush_every=None):
+        '''Get the accumulator for a message bus, creating it if necessary. Flushing less often
+        saves device synchronisations, but the plots lag behind training by up to ``flush_every``
+        steps.
+
+        Parameters
+        ----------
+        message_bus :   ikkuna.export.messages.MessageBus
+        flush_every :   int or None
+                        Number of steps between flushes. ``None`` keeps the current setting of an
+                        existing accumulator and flushes every step for a new one.
+
+        Returns
+        -------
+        MetricAccumulator
+        '''
+        accumulator = getattr(message_bus, '_metric_accumulator', None)
+        if accumulator is None:
+            accumulator = cls(message_bus, 1 if flush_every is None else flush_every)
+            message_bus._metric_accumulator = accumulator
+        elif flush_every is not None:
+            accumulator.flush_every = flush_every
+        return accumulator
+
+    def add(self, backend, module_name, datum, step):
+        '''Record a value for plotting with the next flush. Values which are not tensors are
+        recorded as they are.
+
+        Parameters
+        ----------
+        backend :   ikkuna.visualization.Backend
+        module_name :   str
+        datum   :   torch.Tensor or float
+                    Scalar value
+        step    :   int
+        '''
+        if isinstance(datum, torch.Tensor):
+            datum = datum.detach()
+        with self._lock:
+            self._pending[(backend, module_name, step)] = datum
+
+    def flush(self):
+        '''Transfer all pending values to the host and plot them.'''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        # group tensors so that each group can be stacked and transferred at once
+        groups = defaultdict(list)
+        values = {}
+        for key, datum in pending.items():
+            if isinstance(datum, torch.Tensor):
+                groups[(datum.device, datum.dtype)].append(key)
+            else:
+                values[key] = datum
+        for keys in groups.values():
+            stacked = torch.stack([pending[key].reshape(()) for key in keys])
+            values.update(zip(keys, stacked.tolist()))
+
+        for (backend, module_name, step), value in sorted(values.items(), key=lambda kv: kv[0][2]):
+            backend.add_data(module_name, value, step)
+
+    def compute(self, message):
+        if (message.kind == 'epoch_finished'
+                or message.global_step - self._last_flush >= self.flush_every):
+            self._last_flush = message.global_step
+            self.flush()
+
+
 class PlotSubscriber(Subscriber):
     '''Base class for subscribers that output scalar or histogram values per time and module
 
@@ -274,6 +413,9 @@ class PlotSubscriber(Subscriber):
     ----------
     _backend    :   ikkuna.visualization.Backend
                     Plotting backend
+    _accumulator    :   MetricAccumulator or None
+                        Accumulator for scalar metrics on the same bus. If ``None``, scalars are
+                        plotted directly.
     '''
 
     def __init__(self, subscriptions, message_bus, plot_config, backend='tb'):
@@ -289,18 +431,116 @@ class PlotSubscriber(Subscriber):
         '''
         super().__init__(subscriptions, message_bus)
 
-        self._backend = ikkuna.visualization.get_backend(backend, plot_config)
+        self._backend     = ikkuna.visualization.get_backend(backend, plot_config)
+        self._accumulator = MetricAccumulator.for_bus(message_bus)
 
     @property
     def backend(self):
         '''ikkuna.visualization.Backend: The backend to use for plotting'''
         return self._backend
 
+    def _add_scalar(self, module_name, datum, step):
+        '''Plot a scalar. Tensors are not read immediately, but collected in the
+        :class:`MetricAccumulator` and transferred to the host in bulk, so that computing the metric
+        does not force a device synchronisation.
+
+        Parameters
+        ----------
+        module_name :   str
+        datum   :   torch.Tensor or float
+        step    :   int
+        '''
+        if self._accumulator is None:
+            self._backend.add_data(module_name, datum, step)
+        else:
+            self._accumulator.add(self._backend, module_name, datum, step)
+
     @abc.abstractmethod
     def compute(self, message_or_bundle):
         pass
 
 
+class BatchedMixin(abc.ABC):
+    '''Mixin for :class:`~ikkuna.export.subscriber.PlotSubscriber`\ s which compute one scalar
+    statistic per module message, plot it and publish it as ``{kind}_{suffix}``.
+
+    In batched mode, the messages of each step are collected and the statistic is computed for all
+    modules at once when ``batch_finished`` arrives, with the functions in
+    :mod:`ikkuna.utils.batched`. This needs far fewer kernel launches for deep models. The messages
+    still pending are also processed on ``epoch_finished`` and by :meth:`close()`, so that the final
+    step is not lost.
+
+    Subclasses set :attr:`_suffix` and implement :meth:`_statistic()` and
+    :meth:`_statistics()`, and obtain the kinds to subscribe to from :meth:`_batched_kinds()`.
+
+    Attributes
+    ----------
+    _batched    :   bool
+                    Whether to compute the statistic for all messages of a step at once
+    _buffer :   list(ikkuna.export.messages.ModuleMessage)
+                Messages of the current step in batched mode
+    '''
+
+    _suffix = None
+
+    def _batched_kinds(self, kind, batched):
+        '''Set up batched mode and get the kinds to subscribe to.
+
+        Parameters
+        ----------
+        kind    :   str
+                    Kind to compute the statistic of
+        batched :   bool
+
+        Returns
+        -------
+        list(str)
+        '''
+        self._batched = batched
+        self._buffer  = []
+        return [kind, 'batch_finished', 'epoch_finished'] if batched else [kind]
+
+    @abc.abstractmethod
+    def _statistic(self, tensor):
+        '''Compute the statistic of a single tensor.'''
+        pass
+
+    @abc.abstractmethod
+    def _statistics(self, tensors):
+        '''Compute the statistic of each of a list of tensors at once.'''
+        pass
+
+    def compute(self, message):
+        '''Compute the statistic of a quantity. A :class:`~ikkuna.export.messages.ModuleMessage`
+        with the identifier ``{kind}_{suffix}`` is published.'''
+        if message.kind in ('batch_finished', 'epoch_finished'):
+            self._compute_batched()
+        elif self._batched:
+            self._buffer.append(message)
+        else:
+            self._publish(message, self._statistic(message.data))
+
+    def _compute_batched(self):
+        '''Compute the statistic for all pending messages at once.'''
+        messages, self._buffer = self._buffer, []
+        if messages:
+            values = self._statistics([message.data for message in messages])
+            for message, value in zip(messages, values):
+                self._publish(message, value)
+
+    def close(self):
+        '''Publish the statistics of the messages still pending.'''
+        self._compute_batched()
+
+    def _publish(self, message, value):
+        module, module_name = message.key
+        self._add_scalar(module_name, value, message.global_step)
+        self.message_bus.publish_module_message(message.global_step,
+                                                message.train_step,
+                                                message.epoch, f'{message.kind}_{self._suffix}',
+                                                message.key, value)
+
+
 class CallbackSubscriber(Subscriber):
     '''Subscriber class for subscribing to :class:`~ikkuna.export.messages.ModuleMessage`\ s and
     running a callback with them.'''
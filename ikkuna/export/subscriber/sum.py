@@ -1,17 +1,30 @@
-from ikkuna.export.subscriber import PlotSubscriber, Subscription
+from ikkuna.export.subscriber import PlotSubscriber, Subscription, BatchedMixin
 from ikkuna.export.messages import get_default_bus
+from ikkuna.utils.batched import sums
 
 
-class SumSubscriber(PlotSubscriber):
+class SumSubscriber(BatchedMixin, PlotSubscriber):
+    '''A :class:`~ikkuna.export.subscriber.Subscriber` which computes the sum of a quantity and
+    publishes it as ``{kind}_sum``.'''
+
+    _suffix = 'sum'
 
     def __init__(self, kind, message_bus=get_default_bus(), tag='default', subsample=1, ylims=None,
-                 backend='tb'):
+                 backend='tb', batched=False):
+        '''
+        Parameters
+        ----------
+        batched :   bool
+                    Compute the sums of each step at once (see
+                    :class:`~ikkuna.export.subscriber.BatchedMixin`)
+        '''
         if not isinstance(kind, str):
             raise ValueError('SumSubscriber only accepts 1 kind')
         title        = f'{kind}_sum'
         ylabel       = 'Sum'
         xlabel       = 'Train step'
-        subscription = Subscription(self, [kind], tag=tag, subsample=subsample)
+        kinds        = self._batched_kinds(kind, batched)
+        subscription = Subscription(self, kinds, tag=tag, subsample=subsample)
         super().__init__([subscription], message_bus,
                          {'title': title,
                           'ylabel': ylabel,
@@ -20,18 +33,8 @@ class SumSubscriber(PlotSubscriber):
                          backend=backend)
         self._add_publication(f'{kind}_sum', type='DATA')
 
-    def compute(self, message):
-        '''Compute the sum of a quantity. A :class:`~ikkuna.export.messages.ModuleMessage`
-        with the identifier ``{kind}_sum`` is published. '''
-
-        module, module_name  = message.key
-
-        data = message.data
-        sum = data.sum()
-        self._backend.add_data(module_name, sum, message.global_step)
+    def _statistic(self, tensor):
+        return tensor.sum()
 
-        kind = f'{message.kind}_sum'
-        self.message_bus.publish_module_message(message.global_step,
-                                                message.train_step,
-                                                message.epoch, kind,
-                                                message.key, sum)
+    def _statistics(self, tensors):
+        return sums(tensors)
@@ -1,35 +1,91 @@
+import abc
 from collections import defaultdict
+import os
+import tempfile
 import numpy as np
 import torch
-from torch.utils.data import Subset, DataLoader
-import svcca
+from torch.utils.data import Subset
 
 from ikkuna.export.subscriber import PlotSubscriber, Subscription
 from ikkuna.export.messages import get_default_bus
+from ikkuna.export.snapshot import StateSnapshot
+from ikkuna.export.history import RepresentationHistory
 from ikkuna.utils import freeze_module
+from ikkuna.utils.cca import CovarianceAccumulator, covariances, grouped_cca_similarities
+from ikkuna.utils.probe_set import CachedProbeSet
+
+
+def _as_datapoints(activations):
+    '''Reshape activations into a matrix with one row per datapoint and spatial location and one
+    column per channel.'''
+    if activations.ndimension() > 2:
+        c = activations.shape[1]  # channel dim
+        return activations.movedim(1, -1).reshape(-1, c)
+    return activations
 
 
 class ChunkedDict(object):
     '''A dictionary-like class that can be used to incrementally fill tensors of predetermined size
     by accumulating data. The dictionary keeps track of what has already been received and kan thus
     be asked if all data for some module was received.  This can be used e.g. for stitching together
-    an activation matrix of (n_neurons, n_datapoints) when the activations arrive in batches.'''
+    an activation matrix of (n_neurons, n_datapoints) when the activations arrive in batches.
+    Appended data can be shrunk on its device by an :class:`~ikkuna.utils.sketch.ActivationReducer`
+    before it is stored.
+
+    The buffers can be kept on the device the data arrives on, in pinned host memory or in
+    memory-mapped files, so that large probe sets do not take up device memory. Data is copied into
+    host buffers asynchronously and the copies are only waited for when the data is read.
+
+    Attributes
+    ----------
+    _events :   dict(object, torch.cuda.Event)
+                Event recorded after the last asynchronous copy into each host buffer
+    '''
+
+    STORAGES = ('device', 'pinned', 'disk')
 
-    def __init__(self, expected_n):
+    def __init__(self, expected_n, reducer=None, storage='device', directory=None):
         '''
         Parameters
         ----------
         expected_n  :   int
                         The number of datapoints to expect for all modules
+        reducer :   ikkuna.utils.sketch.ActivationReducer or None
+                    Reduction to apply to all appended data
+        storage :   str
+                    Where to keep the buffers. ``'device'`` for the device of the data,
+                    ``'pinned'`` for page-locked host memory (regular host memory if CUDA is not
+                    available) or ``'disk'`` for files which are mapped into memory.
+        directory   :   str or None
+                        Directory for the files of the ``'disk'`` storage. Defaults to the system's
+                        temporary directory. The files are unlinked right away and disappear once
+                        their buffers are freed.
+
+        Raises
+        ------
+        ValueError
+            If the storage is unknown
         '''
+        if storage not in ChunkedDict.STORAGES:
+            raise ValueError(f'Unknown storage "{storage}"')
         self._expected_n = expected_n
         self._received_n = defaultdict(int)
         self._data = dict()
+        self._reducer = reducer
+        self._storage = storage
+        self._directory = directory
+        self._events = dict()
+
+    @property
+    def storage(self):
+        '''str: Where the buffers are kept'''
+        return self._storage
 
     def clear(self):
         '''Remove all entries.'''
         self._received_n.clear()
         self._data.clear()
+        self._events.clear()
 
     def append(self, module, data):
         '''Add data for a module. Creates new record if one is not already open for this module.
@@ -39,15 +95,40 @@ class ChunkedDict(object):
         module  :   torch.nn.Module or str
                     Some unique key for this module
         data    :   torch.Tensor
-                    Data tensor to append
+                    Data tensor to append. It is reduced first if the dict has a reducer.
         '''
+        if self._reducer is not None:
+            data = self._reducer(module, data)
+        self._append(module, data)
+
+    def _allocate(self, shape, dtype, device):
+        '''Allocate an uninitialised buffer according to the storage policy.'''
+        if self._storage == 'device':
+            return torch.empty(shape, dtype=dtype, device=device)
+        elif self._storage == 'pinned':
+            return torch.empty(shape, dtype=dtype, pin_memory=torch.cuda.is_available())
+        else:
+            fd, path = tempfile.mkstemp(dir=self._directory, suffix='.chunked')
+            try:
+                buffer = torch.from_file(path, shared=True, size=int(np.prod(shape)), dtype=dtype)
+            finally:
+                os.close(fd)
+                os.unlink(path)
+            return buffer.view(shape)
+
+    def _append(self, module, data):
         if module not in self._data:
-            self._data[module] = torch.zeros(self._expected_n, *data.shape[1:], device=data.device)
+            shape = (self._expected_n, *data.shape[1:])
+            self._data[module] = self._allocate(shape, data.dtype, data.device)
 
         n = data.shape[0]
         received = self._received_n[module]
-        self._data[module][received:received + n, ...] = data
+        self._data[module][received:received + n, ...].copy_(data, non_blocking=True)
         self._received_n[module] += n
+        if data.is_cuda and self._storage != 'device':
+            event = torch.cuda.Event()
+            event.record()
+            self._events[module] = event
 
     def keys(self):
         '''Get all known modules, completed or otherwise.
@@ -67,17 +148,14 @@ class ChunkedDict(object):
         int
             Bytes consumed by all the tensors
         '''
-        size = 0
-        for module in self._data:
-            size += self._data[module].numel() * 4
-        return size
+        return sum(data.numel() * data.element_size() for data in self._data.values())
 
     def __setitem__(self, module, data):
-        '''Set the data for a module, overwriting any previous data.'''
-        if module in self._data:
-            del self._data[module]
-            del self._received_n[module]
-        self.append(module, data)
+        '''Set the data for a module, overwriting any previous data. The data is neither reduced
+        nor copied, so it should be taken from another dict with the same reducer and storage.'''
+        self._data[module]       = data
+        self._received_n[module] = data.shape[0]
+        self._events.pop(module, None)
 
     def __getitem__(self, key):
         '''Get data for a module.
@@ -93,6 +171,8 @@ class ChunkedDict(object):
         '''
         if not self.complete(key):
             raise KeyError(f'Data for {key} not yet complete.')
+        if key in self._events:
+            self._events.pop(key).synchronize()
         return self._data[key]
 
     def __contains__(self, module):
@@ -115,69 +195,191 @@ class ChunkedDict(object):
         return data
 
 
-class BatchedSVCCASubscriber(PlotSubscriber):
+class _SimilaritySubscriber(PlotSubscriber):
+    '''Base class for the subscribers which compare every layer's activations on a probe set between
+    checkpoints. It plots and publishes the similarities as ``self_similarity`` and freezes the
+    layers whose similarity exceeds a threshold.
+
+    Attributes
+    ----------
+    _named_modules  :   dict(torch.nn.Module, ikkuna.utils.NamedModule)
+                        Named module of each module seen in the probe passes
+    _ignore_modules :   set(torch.nn.Module)
+                        Frozen modules
+    '''
+
+    # runs the model itself
+    requires_main_thread = True
+    # tag of the probe passes
+    _probe_tag = None
+
+    def __init__(self, probe_kinds, freeze_at, message_bus, tag, subsample, ylims, backend):
+        '''
+        Parameters
+        ----------
+        probe_kinds :   list(str)
+                        Kinds to subscribe to for the probe passes
+        freeze_at   :   float
+                        Similarity threshold after which a layer is frozen. Values >= 1 will turn
+                        off freezing
+
+        See :class:`~ikkuna.export.subscriber.PlotSubscriber` for the other parameters.
+        '''
+        self._named_modules  = {}
+        self._freeze_at      = freeze_at if isinstance(freeze_at, float) else 10.
+        self._ignore_modules = set()
+
+        subscription1 = Subscription(self, ['batch_finished'], tag=tag, subsample=subsample)
+        subscription2 = Subscription(self, probe_kinds, tag=self._probe_tag, subsample=1)
+        super().__init__([subscription1, subscription2],
+                         message_bus,
+                         {'title': 'self_similarity',
+                          'ylabel': 'Similarity',
+                          'ylims': ylims,
+                          'xlabel': 'Train step'},
+                         backend=backend)
+        self._add_publication('self_similarity', type='DATA')
+
+    @abc.abstractmethod
+    def _similarities(self):
+        '''Compute the similarities of all modules whose data for the current checkpoint is
+        complete.
+
+        Returns
+        -------
+        dict(torch.nn.Module, torch.Tensor)
+        '''
+        pass
+
+    @abc.abstractmethod
+    def _discard(self, module):
+        '''Drop all data kept for a module.'''
+        pass
+
+    def _publish_similarity(self, message, module, mean, kind='self_similarity', name=None):
+        '''Plot and publish the similarity of a module.
+
+        Parameters
+        ----------
+        message :   ikkuna.export.messages.Message
+                    Message whose steps to publish at
+        module  :   torch.nn.Module
+        mean    :   torch.Tensor
+        kind    :   str
+        name    :   str or None
+                    Name to plot under. Defaults to the module's name.
+        '''
+        named_module = self._named_modules[module]
+        self._add_scalar(named_module.name if name is None else name, mean, message.global_step)
+        self.message_bus.publish_module_message(message.global_step,
+                                                message.train_step,
+                                                message.epoch,
+                                                kind,
+                                                named_module,
+                                                data=mean)
+
+    def _publish_similarities(self, message):
+        '''Compute and publish the similarities of all modules completed since the last
+        checkpoint.'''
+        for module, mean in self._similarities().items():
+            self._publish_similarity(message, module, mean)
+            if mean > self._freeze_at:
+                self._freeze_module(module)
+
+    def _freeze_module(self, module):
+        print(f'Freezing {module}')
+        freeze_module(module)
+        self._ignore_modules.add(module)
+        self._discard(module)
+
+
+class BatchedSVCCASubscriber(_SimilaritySubscriber):
     '''A subscriber which at some interval halts training, propagates some dataset through the net,
     records activations for all modules and stores them. At the next checkpoint, SVCCA similarity
     is computed between every layer at time step t and the same layer at t-1.
 
-    .. note::
-        It seems that despite the fact that SVCCA runs at least twice as fast on the GPU, this
-        subscriber is not faster than on the CPU. I'm not sure why that is, since I'm even caching
-        input data to avoid repeatedly copying to the GPU
-
-    .. warning::
-        Currently, this subscriber uses Numpy for SVCAA. For some reason, the activations produced
-        by networks lead to highly ill-conditioned covariance matrices and PyTorch's SVD handles
-        them differently than Numpy does. SVD does not converge in that case, and
-        ``robust_cca_similarity`` must be used, which defeats the whole idea of speeding up the
-        process.
+    The similarity is computed on the activations' device with :mod:`ikkuna.utils.cca`. The
+    activations often lead to highly ill-conditioned covariance matrices, so they are computed in
+    double precision and whitened via their eigendecomposition with all eigenvalues floored at
+    ``epsilon``, which always converges. The similarities of all modules with the same number of
+    channels are computed in one batch once the forward pass is done.
+
+    Attributes
+    ----------
+    _pending    :   dict(torch.nn.Module, tuple(torch.Tensor))
+                    Covariances of each module whose activations for both checkpoints are
+                    complete
     '''
 
+    _probe_tag = 'svcca_testing'
+
     def __init__(self, dataset_meta, n, forward_fn, freeze_at=10, batch_size=256,
                  message_bus=get_default_bus(), tag='default', subsample=1, ylims=None,
-                 backend='tb'):
+                 backend='tb', epsilon=1e-8, threshold=0.98, reducer=None, storage='device',
+                 directory=None, probe_scheduler=None):
         '''
         Parameters
         ----------
         dataset_meta    :   ikkuna.utils.DatasetMeta
                             Dataset to load data from for retrieving activations
-        n   :   int
-                Number of datapoints to randomly sample
+        n   :   int or None
+                Number of datapoints to randomly sample. ``None`` uses the whole dataset.
         freeze_at   :   float
                         Similarity threshold after which a layer is frozen. Values >= 1 will turn
                         off freezing
         batch_size  :   int
                         Batch size to use for forward passes. Can be set to some value if the entire
                         data at once would be too larger. Otherwise use :class:`SVCCASubscriber`
+        epsilon :   float
+                    Regularisation of the covariances and threshold for removing dead neurons
+        threshold   :   float
+                        Fraction of the sum of canonical correlations to average over
+        reducer :   ikkuna.utils.sketch.ActivationReducer or None
+                    Reduction applied to the activations on their device before they are stored.
+                    See there for the trade-offs.
+        storage :   str
+                    Where to keep the activations between checkpoints, see :class:`ChunkedDict`.
+                    With host storage, they are moved back to the device batch by batch to
+                    compute the covariances.
+        directory   :   str or None
+                        Directory for the ``'disk'`` storage
+        probe_scheduler :   ikkuna.export.probe.ProbeScheduler or None
+                            If given (e.g. :attr:`ikkuna.export.Exporter.probe_scheduler`), the
+                            probe passes are requested from it and shared with other subscribers
+                            requesting ``n`` datapoints from the same dataset with the same batch
+                            size. With ``n=None``, this includes the passes of a
+                            :class:`~ikkuna.export.subscriber.TestAccuracySubscriber` on the same
+                            dataset. Otherwise, they are run by this subscriber.
         '''
+        whole_dataset = n is None
+        if whole_dataset:
+            n = dataset_meta.size
 
         self._forward_fn     = forward_fn
-        self._previous_acts  = ChunkedDict(n)
-        self._current_acts   = ChunkedDict(n)
-        indices              = np.random.randint(0, dataset_meta.size, size=n)
-        dataset              = Subset(dataset_meta.dataset, indices)
-        self._loader         = DataLoader(dataset, batch_size=batch_size, shuffle=False,
-                                          pin_memory=True)
-        # cache tensors so we don't repeatedly deserialize and copy
-        self._input_cache    = []
+        self._reducer        = reducer
+        self._previous_acts  = ChunkedDict(n, reducer=reducer, storage=storage,
+                                           directory=directory)
+        self._current_acts   = ChunkedDict(n, reducer=reducer, storage=storage,
+                                           directory=directory)
+        self._batch_size     = batch_size
+        self._device         = None
+        self._scheduler      = probe_scheduler
+        if probe_scheduler is not None:
+            self._probe_set  = probe_scheduler.probe_set(dataset_meta.dataset, batch_size,
+                                                         n=None if whole_dataset else n)
+        elif whole_dataset:
+            self._probe_set  = CachedProbeSet(dataset_meta.dataset, batch_size)
+        else:
+            indices          = np.random.randint(0, dataset_meta.size, size=n)
+            dataset          = Subset(dataset_meta.dataset, indices)
+            self._probe_set  = CachedProbeSet(dataset, batch_size)
+        self._pending        = {}
+        self._epsilon        = epsilon
+        self._threshold      = threshold
 
-        self._freeze_at      = freeze_at if isinstance(freeze_at, float) else 10.
-        self._ignore_modules = set()
-
-        title        = f'self_similarity'
-        ylabel       = 'Similarity'
-        xlabel       = 'Train step'
-        subscription1 = Subscription(self, ['batch_finished'], tag=tag, subsample=subsample)
-        subscription2 = Subscription(self, ['activations'], tag='svcca_testing',
-                                     subsample=1)
-        super().__init__([subscription1, subscription2],
-                         message_bus,
-                         {'title': title,
-                          'ylabel': ylabel,
-                          'ylims': ylims,
-                          'xlabel': xlabel},
-                         backend=backend)
-        self._add_publication(f'self_similarity', type='DATA')
+        probe_kinds  = ['activations'] if probe_scheduler is None else ['activations',
+                                                                        'probe_finished']
+        super().__init__(probe_kinds, freeze_at, message_bus, tag, subsample, ylims, backend)
 
     def _module_complete_previous(self, module):
         '''Check if activations for module are completely buffered from the previous step.'''
@@ -198,89 +400,83 @@ class BatchedSVCCASubscriber(PlotSubscriber):
         self._current_acts.append(module, data)
 
     def _do_forward_pass(self):
-        # cache inputs initially
-        if not self._input_cache:
-            loader = iter(self._loader)
-        else:
-            loader = iter(self._input_cache)
-
-        for i, (X, labels) in enumerate(loader):
-            X = X.cuda()
-            if len(self._input_cache) < i + 1:
-                self._input_cache.append((X, labels))
-            self._forward_fn(X, should_train=False, tag='svcca_testing')
+        for X, _ in self._probe_set:
+            self._forward_fn(X, should_train=False, tag=self._probe_tag)
 
-    def _compute_similarity(self, name):
+    def _compute_covariances(self, name):
+        '''Compute the covariances of a module's activations at both checkpoints and keep the
+        current ones for the next checkpoint.'''
         # now both current and previous acts are complete and we can compute
-        # print(f'Computing similarity for {name}')
         previous_acts = self._previous_acts.pop(name)
         current_acts = self._current_acts.pop(name)
 
         self._previous_acts[name] = current_acts
-
-        if previous_acts.ndimension() > 2:
-            c = previous_acts.shape[1]  # channel dim
-            previous_acts = previous_acts.permute([0, 2, 3, 1]).reshape(-1, c)
-
-        if current_acts.ndimension() > 2:
-            c = current_acts.shape[1]  # channel dim
-            current_acts = current_acts.permute([0, 2, 3, 1]).reshape(-1, c)
-
-        previous_acts = previous_acts.detach().cpu().numpy()
-        current_acts = current_acts.detach().cpu().numpy()
-        result_dict = svcca.cca_core.robust_cca_similarity(previous_acts.T,
-                                                           current_acts.T,
-                                                           epsilon=1e-8,
-                                                           threshold=0.98,
-                                                           verbose=False,
-                                                           compute_dirns=False,
-                                                           rescale=True)
-        return result_dict['mean'][0]
-
-    def _freeze_module(self, module):
-        print(f'Freezing {module}')
-        freeze_module(module)
-        self._ignore_modules.add(module)
+        return self._covariances(previous_acts, current_acts)
+
+    def _covariances(self, previous_acts, current_acts):
+        '''Compute the covariances of two sets of activations on the device. Activations on the host
+        are moved there batch by batch.'''
+        if previous_acts.device == current_acts.device == self._device:
+            return covariances(_as_datapoints(previous_acts), _as_datapoints(current_acts))
+
+        accumulator = CovarianceAccumulator()
+        for previous_batch, current_batch in zip(previous_acts.split(self._batch_size),
+                                                 current_acts.split(self._batch_size)):
+            accumulator.add(_as_datapoints(previous_batch.to(self._device, non_blocking=True)),
+                            _as_datapoints(current_batch.to(self._device, non_blocking=True)))
+        return accumulator.covariances()
+
+    def _similarities(self):
+        '''Compute the similarities of all modules completed during the last forward pass.'''
+        pending, self._pending = self._pending, {}
+        return grouped_cca_similarities(pending, epsilon=self._epsilon, threshold=self._threshold)
+
+    def _discard(self, module):
         if module in self._previous_acts:
             self._previous_acts.pop(module)
         if module in self._current_acts:
             self._current_acts.pop(module)
 
+    def _new_activations(self, message):
+        '''Record a module's activations from the probe pass and compute the covariances once
+        they are complete for both checkpoints.'''
+        module = message.key.module
+        if not self._module_complete_previous(module):
+            self._record_activations_previous(module, message.data)
+        elif not self._module_complete_current(module):
+            self._record_activations_current(module, message.data)
+
+        if self._module_complete_current(module) and self._module_complete_previous(module):
+            self._pending[module] = self._compute_covariances(module)
+
     def compute(self, message):
         '''A :class:`~ikkuna.export.messages.NetworkMessage` with the identifier ``self_similarity``
         will be published.'''
 
         if message.tag == 'default' and message.kind == 'batch_finished':
-            self._do_forward_pass()
+            if self._scheduler is None:
+                self._do_forward_pass()
+                self._publish_similarities(message)
+            else:
+                self._scheduler.request(self._probe_set, self._probe_tag)
 
-        elif message.tag == 'svcca_testing':
+        elif message.tag == self._probe_tag and message.kind == 'probe_finished':
+            self._publish_similarities(message)
+
+        elif message.tag == self._probe_tag:
             module, name = message.key
             if module in self._ignore_modules:
                 return
-
-            if not self._module_complete_previous(module):
-                self._record_activations_previous(module, message.data)
-            elif not self._module_complete_current(module):
-                self._record_activations_current(module, message.data)
-
-            if self._module_complete_current(module) and self._module_complete_previous(module):
-                mean = self._compute_similarity(module)
-                self._backend.add_data(name, mean, message.global_step)
-                self.message_bus.publish_module_message(message.global_step,
-                                                        message.train_step,
-                                                        message.epoch,
-                                                        'self_similarity',
-                                                        message.key,
-                                                        data=mean)
-
-                if mean > self._freeze_at:
-                    self._freeze_module(module)
+            self._device                = message.data.device
+            self._named_modules[module] = message.key
+            self._new_activations(message)
 
 
 class SVCCASubscriber(BatchedSVCCASubscriber):
     '''Simplified :class:`BatchedSVCCASubscriber` subclass which does not use a
     ``ChunkedDict`` but instead regular dicts and thus assumes that the entire test data can be
-    propagated through the model in one go and batching is unnecessary.'''
+    propagated through the model in one go and batching is unnecessary. The activations are
+    always kept on their device.'''
 
     def __init__(self, dataset_meta, n,  *args, **kwargs):
         super().__init__(dataset_meta, n, *args, **kwargs, batch_size=n)
@@ -293,8 +489,250 @@ class SVCCASubscriber(BatchedSVCCASubscriber):
     def _module_complete_current(self, module):
         return module in self._current_acts
 
+    def _reduce(self, module, data):
+        return data if self._reducer is None else self._reducer(module, data)
+
     def _record_activations_previous(self, module, data):
-        self._previous_acts[module] = data
+        self._previous_acts[module] = self._reduce(module, data)
 
     def _record_activations_current(self, module, data):
-        self._current_acts[module] = data
+        self._current_acts[module] = self._reduce(module, data)
+
+
+class ReferenceSVCCASubscriber(BatchedSVCCASubscriber):
+    '''A subscriber which tracks how far the representations drift from those at earlier
+    checkpoints. At every checkpoint, the probe set is propagated once and every layer's activations
+    are compared with the ones stored in a :class:`~ikkuna.export.history.RepresentationHistory` for
+    each reference, before they are added to the history themselves. References can be the first
+    checkpoint, the previous one or any global step, e.g. the state after epoch 5. Compressing the
+    activations with a ``reducer`` keeps the history small.
+
+    The similarity to the ``'previous'`` checkpoint is published as ``self_similarity`` and layers
+    are frozen based on it as in :class:`BatchedSVCCASubscriber`. The similarity to other references
+    is published as ``similarity_to_first`` or ``similarity_to_<step>``.
+
+    Attributes
+    ----------
+    _history    :   ikkuna.export.history.RepresentationHistory
+    _references :   list(str or int)
+    _step   :   int
+                Global step of the current checkpoint
+    '''
+
+    _probe_tag = 'svcca_reference_testing'
+
+    def __init__(self, dataset_meta, n, forward_fn, references=('first', 'previous'), history=None,
+                 freeze_at=10, batch_size=256, message_bus=get_default_bus(), tag='default',
+                 subsample=1, ylims=None, backend='tb', epsilon=1e-8, threshold=0.98,
+                 reducer=None, storage='device', directory=None, probe_scheduler=None):
+        '''
+        Parameters
+        ----------
+        references  :   iterable
+                        ``'first'``, ``'previous'`` or global steps of checkpoints to compare with.
+                        The given steps are pinned in the history.
+        history :   ikkuna.export.history.RepresentationHistory or None
+                    Where to store the activations of all checkpoints. Defaults to one keeping 10
+                    checkpoints with logarithmic spacing.
+
+        See :class:`BatchedSVCCASubscriber` for the other parameters.
+        '''
+        super().__init__(dataset_meta, n, forward_fn, freeze_at=freeze_at, batch_size=batch_size,
+                         message_bus=message_bus, tag=tag, subsample=subsample, ylims=ylims,
+                         backend=backend, epsilon=epsilon, threshold=threshold, reducer=reducer,
+                         storage=storage, directory=directory, probe_scheduler=probe_scheduler)
+        if history is None:
+            history = RepresentationHistory(policy='logarithmic')
+        self._history    = history
+        self._references = list(references)
+        self._step       = None
+        for reference in self._references:
+            if reference not in ('first', 'previous'):
+                self._history.pin(reference)
+                self._add_publication(f'similarity_to_{reference}', type='DATA')
+            elif reference == 'first':
+                self._add_publication('similarity_to_first', type='DATA')
+
+    @property
+    def history(self):
+        '''ikkuna.export.history.RepresentationHistory: The stored activations'''
+        return self._history
+
+    def _reference_steps(self):
+        '''Find the stored checkpoint of each reference.
+
+        Returns
+        -------
+        dict(str or int, int)
+        '''
+        earlier = [step for step in self._history.steps if step < self._step]
+        steps   = {}
+        for reference in self._references:
+            if reference == 'first' and earlier:
+                steps[reference] = earlier[0]
+            elif reference == 'previous' and earlier:
+                steps[reference] = earlier[-1]
+            elif reference in earlier:
+                steps[reference] = reference
+        return steps
+
+    def _publish_similarities(self, message):
+        for (module, reference), mean in self._similarities().items():
+            name = f'{self._named_modules[module].name} vs {reference}'
+            kind = 'self_similarity' if reference == 'previous' else f'similarity_to_{reference}'
+            self._publish_similarity(message, module, mean, kind=kind, name=name)
+
+            if reference == 'previous' and mean > self._freeze_at:
+                self._freeze_module(module)
+
+    def _new_activations(self, message):
+        '''Record a module's activations from the probe pass and, once they are complete, compute
+        the covariances with each reference and add them to the history.'''
+        module = message.key.module
+        self._record_activations_current(module, message.data)
+        if self._module_complete_current(module):
+            current_acts = self._current_acts.pop(module)
+            for reference, step in self._reference_steps().items():
+                reference_acts = self._history.get(step, module)
+                if reference_acts is not None:
+                    self._pending[(module, reference)] = self._covariances(reference_acts,
+                                                                           current_acts)
+            self._history.add(self._step, module, current_acts)
+
+    def compute(self, message):
+        '''Module messages with the similarities to all references found in the history will be
+        published.'''
+        if message.tag == 'default' and message.kind == 'batch_finished':
+            self._step = message.global_step
+        super().compute(message)
+
+
+class StreamingSVCCASubscriber(_SimilaritySubscriber):
+    '''A subscriber which computes the same similarity as :class:`BatchedSVCCASubscriber`, but
+    without keeping any activations. At every checkpoint, each batch of the probe set is propagated
+    twice, once with the model state of the previous checkpoint swapped in and once with the current
+    one. Only the means and the auto- and cross-covariances of the neurons are accumulated, so the
+    memory needed is independent of the number of datapoints and the spatial size of convolutional
+    activations, at the price of a second forward pass.
+
+    Attributes
+    ----------
+    _snapshot   :   ikkuna.export.snapshot.StateSnapshot
+                    Model state at the previous checkpoint
+    _accumulators   :   dict(torch.nn.Module, ikkuna.utils.cca.CovarianceAccumulator)
+                        Statistics of the current checkpoint
+    _previous_batch :   dict(torch.nn.Module, torch.Tensor)
+                        Activations of the current batch from the pass with the previous state
+    _pass   :   str or None
+                ``'previous'`` or ``'current'`` while propagating the probe set
+    '''
+
+    _probe_tag = 'svcca_streaming_testing'
+
+    def __init__(self, dataset_meta, n, model, freeze_at=10, batch_size=256, epsilon=1e-8,
+                 threshold=0.98, message_bus=get_default_bus(), tag='default', subsample=1,
+                 ylims=None, backend='tb', reducer=None):
+        '''
+        Parameters
+        ----------
+        dataset_meta    :   ikkuna.utils.DatasetMeta
+                            Dataset to load data from for retrieving activations
+        n   :   int
+                Number of datapoints to randomly sample
+        model   :   torch.nn.Module
+                    The model, whose (patched) ``forward()`` is used for the probe passes and whose
+                    state is captured at every checkpoint
+        freeze_at   :   float
+                        Similarity threshold after which a layer is frozen. Values >= 1 will turn
+                        off freezing
+        batch_size  :   int
+                        Batch size to use for forward passes
+        epsilon :   float
+                    Regularisation of the covariances and threshold for removing dead neurons
+        threshold   :   float
+                        Fraction of the sum of canonical correlations to average over
+        reducer :   ikkuna.utils.sketch.ActivationReducer or None
+                    Reduction applied to the activations on their device before they are stored.
+                    See there for the trade-offs.
+        '''
+        self._model          = model
+        self._snapshot       = StateSnapshot(model)
+        indices              = np.random.randint(0, dataset_meta.size, size=n)
+        self._probe_dataset  = Subset(dataset_meta.dataset, indices)
+        self._batch_size     = batch_size
+        self._probe_set      = None
+        self._accumulators   = defaultdict(self._new_accumulator)
+        self._previous_batch = {}
+        self._pass           = None
+        self._epsilon        = epsilon
+        self._threshold      = threshold
+        self._reducer        = reducer
+
+        super().__init__(['activations'], freeze_at, message_bus, tag, subsample, ylims, backend)
+
+    def _do_forward_pass(self):
+        # cache the probe set on the device the model has by the first checkpoint
+        if self._probe_set is None:
+            device          = next(self._model.parameters()).device
+            self._probe_set = CachedProbeSet(self._probe_dataset, self._batch_size, device=device)
+        for X, _ in self._probe_set:
+            self._pass = 'previous'
+            with self._snapshot.swapped_in():
+                self._model.forward(X, should_train=False, tag=self._probe_tag)
+            self._pass = 'current'
+            self._model.forward(X, should_train=False, tag=self._probe_tag)
+        self._pass = None
+
+    def _discard(self, module):
+        self._accumulators.pop(module, None)
+
+    def compute(self, message):
+        '''A :class:`~ikkuna.export.messages.ModuleMessage` with the identifier
+        ``self_similarity`` will be published for each module at every checkpoint but the first.'''
+
+        if message.tag == 'default' and message.kind == 'batch_finished':
+            # there is nothing to compare to at the first checkpoint
+            if self._snapshot.captured:
+                self._do_forward_pass()
+                self._publish_similarities(message)
+            self._snapshot.capture()
+
+        elif message.tag == self._probe_tag and self._pass is not None:
+            module, name = message.key
+            if module in self._ignore_modules:
+                return
+
+            activations = message.data
+            if self._reducer is not None:
+                activations = self._reducer(module, activations)
+            activations = self._representation(activations)
+            if self._pass == 'previous':
+                self._previous_batch[module] = activations
+            else:
+                self._named_modules[module] = message.key
+                self._accumulators[module].add(self._previous_batch.pop(module), activations)
+
+    def _new_accumulator(self):
+        '''Create the accumulator for a newly seen module.'''
+        return CovarianceAccumulator()
+
+    def _representation(self, activations):
+        '''Turn a module's activations into the datapoints to accumulate.'''
+        return _as_datapoints(activations)
+
+    def _similarities(self):
+        '''Compute the similarities of all modules with enough data from their accumulators.
+
+        Returns
+        -------
+        dict(torch.nn.Module, torch.Tensor)
+        '''
+        return grouped_cca_similarities({module: accumulator.covariances()
+                                         for module, accumulator in self._accumulators.items()
+                                         if accumulator.n > 1},
+                                        epsilon=self._epsilon, threshold=self._threshold)
+
+    def _publish_similarities(self, message):
+        super()._publish_similarities(message)
+        # the statistics of the next checkpoint start from scratch
+        self._accumulators.clear()
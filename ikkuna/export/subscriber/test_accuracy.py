@@ -1,29 +1,119 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import multiprocessing
+
 import torch
-from torch.utils.data import DataLoader
 
 from ikkuna.export.subscriber import PlotSubscriber, Subscription
 from ikkuna.export.messages import get_default_bus
+from ikkuna.export.snapshot import ShadowModel
+from ikkuna.utils.accuracy import AccuracyAccumulator
+from ikkuna.utils.probe_set import CachedProbeSet
+
+# state of the evaluation worker processes, set once when they are started
+_worker_state = {}
+
+
+def _init_worker(shadows, probe_set, counts_args, num_threads):
+    '''Initialise an evaluation worker process.
+
+    Parameters
+    ----------
+    shadows :   list(torch.nn.Module)
+                Shadow models in shared memory, which the main process updates in place
+    probe_set   :   ikkuna.utils.probe_set.CachedProbeSet
+                    The dataset in shared memory
+    counts_args :   tuple
+                    Arguments for the :class:`~ikkuna.utils.accuracy.AccuracyAccumulator`
+    num_threads :   int
+                    Number of threads for the worker's operators
+    '''
+    torch.set_num_threads(num_threads)
+    _worker_state['shadows']     = shadows
+    _worker_state['probe_set']   = probe_set
+    _worker_state['counts_args'] = counts_args
+
+
+def _evaluate_shard(slot, start, stop):
+    '''Evaluate a shadow model on a contiguous shard of the dataset in a worker process.
+
+    Returns
+    -------
+    ikkuna.utils.accuracy.AccuracyAccumulator
+    '''
+    model  = _worker_state['shadows'][slot]
+    counts = AccuracyAccumulator(*_worker_state['counts_args'])
+    with torch.no_grad():
+        for X, labels in _worker_state['probe_set'].batches(start, stop):
+            counts.add(model(X), labels)
+    return counts
 
 
 class TestAccuracySubscriber(PlotSubscriber):
     '''
     Subscriber which can compute the accuracy on a given data set (generally the test/validation
-    set).
+    set). The correct predictions are counted on the device, which is only synchronised with once
+    the whole dataset has been propagated. Top-k accuracies, per-class accuracies and the confusion
+    matrix can be published in addition, without further passes.
+
+    With an ``executor``, training is not blocked for the evaluation. Instead, the model's state is
+    copied into a :class:`~ikkuna.export.snapshot.ShadowModel` on the device, which is then
+    evaluated in the background (on a CUDA side stream). The results are published with the step
+    counters of the ``batch_finished`` message which triggered the evaluation, as soon as the
+    subscriber notices that the evaluation is done, i.e. at the next ``batch_finished`` or
+    :meth:`flush()`. At most ``max_in_flight`` evaluations run at the same time, each with its own
+    shadow model. Once all are busy, training waits for the oldest one to finish.
+
+    The ``'thread'`` executor evaluates on the model's device. The ``'process'`` executor is meant
+    for training on the CPU. It keeps the dataset and the shadow models in shared host memory and
+    splits the dataset into contiguous shards, one for each of ``num_workers`` forked worker
+    processes. The shadow models are updated in place, so the workers always see the latest capture
+    without it being sent to them. Each worker uses an equal share of the threads available to
+    :mod:`torch` so the cores are not oversubscribed, and sends only its counts back to be summed.
+    The workers never touch the GPU.
 
     Attributes
     ----------
     _dataset_meta    :   ikkuna.utils.DatasetMeta
                          Dataset to compute accuracy over
-    _data_loader    :   torch.utils.data.DataLoader
-                        Loader on the dataset
+    _probe_set  :   ikkuna.utils.probe_set.CachedProbeSet
+                    The dataset, cached on the device
     _frequency  :   int
                     Number of batches to ignore before computing accuracy once
     _forward_fn :   function
                     Bound method on the model to push data through and get predictions
+    _scheduler  :   ikkuna.export.probe.ProbeScheduler or None
+                    Scheduler running the passes over the dataset, if they are shared
+    _counts :   ikkuna.utils.accuracy.AccuracyAccumulator
+                Counts of the current pass
+    _outputs    :   torch.Tensor or None
+                    Network output of the current batch of a shared pass, until its labels arrive
+    _executor   :   concurrent.futures.Executor or None
+                    Executor running background evaluations
+    _in_flight  :   collections.deque
+                    Message, future and shadow model of each background evaluation, oldest first
+    _shadows    :   list(ikkuna.export.snapshot.ShadowModel)
+                    Shadow models not currently in use
+    _pool   :   multiprocessing.pool.Pool or None
+                Worker processes of the ``'process'`` executor, started with the first evaluation
+    _shards :   list(tuple(int, int))
+                Start and stop index of the datapoints evaluated by each worker process
+    _slots  :   dict(ikkuna.export.snapshot.ShadowModel, int)
+                Index of each shared shadow model in the worker processes
+    _stream :   torch.cuda.Stream or None
+                Side stream for background evaluations on the GPU, shared by all of them
     '''
 
+    # runs the model itself
+    requires_main_thread = True
+    # tag of the passes over the dataset
+    _probe_tag = 'testing'
+
     def __init__(self, dataset_meta, forward_fn, batch_size, message_bus=get_default_bus(),
-                 frequency=100, ylims=None, tag='default', subsample=1, backend='tb'):
+                 frequency=100, ylims=None, tag='default', subsample=1, backend='tb',
+                 probe_scheduler=None, topk=(), per_class=False, confusion_matrix=False,
+                 executor=None, max_in_flight=1, num_workers=None):
         '''
         Parameters
         ----------
@@ -35,16 +125,51 @@ class TestAccuracySubscriber(PlotSubscriber):
         batch_size  :   int
                         Batch size to use for pushing the test data through the model. This doesn't
                         have to be the training batch size, but must be selected so that the forward
-                        pass fits into memory.
+                        pass fits into memory. The whole dataset is kept on the device.
         frequency   :   int
                         Inverse of the frequency with which to compute the accuracy
+        probe_scheduler :   ikkuna.export.probe.ProbeScheduler or None
+                            If given (e.g. :attr:`ikkuna.export.Exporter.probe_scheduler`), the
+                            passes over the dataset are requested from it and shared with other
+                            subscribers requesting the same dataset and batch size. Otherwise, they
+                            are run by this subscriber.
+        topk    :   tuple(int)
+                    Values of ``k > 1`` for which to also publish (and plot) the top-k accuracy as
+                    ``test_accuracy_top<k>``
+        per_class   :   bool
+                        Also publish the accuracy of each class as ``test_accuracy_per_class``
+        confusion_matrix    :   bool
+                                Also publish the confusion matrix (true classes in rows) as
+                                ``test_confusion_matrix``
+        executor    :   str or None
+                        ``'thread'`` or ``'process'`` for evaluating in the background on a
+                        snapshot of the model. ``forward_fn`` must then be bound to the model.
+        max_in_flight   :   int
+                            Maximum number of background evaluations at the same time
+        num_workers :   int or None
+                        Number of worker processes for the ``'process'`` executor. Defaults to the
+                        number of CPUs.
+
+        Raises
+        ------
+        ValueError
+            If the executor is unknown or combined with a ``probe_scheduler``
         '''
+        if executor not in (None, 'thread', 'process'):
+            raise ValueError(f'Unknown executor "{executor}"')
+        if executor is not None and probe_scheduler is not None:
+            raise ValueError('Background evaluation cannot share the passes of a scheduler.')
+
         kinds  = ['batch_finished']
         title  = f'test_accuracy'
         ylabel = 'Accuracy'
         xlabel = 'Train step'
-        subscription = Subscription(self, kinds, tag=tag, subsample=subsample)
-        super().__init__([subscription],
+        subscriptions = [Subscription(self, kinds, tag=tag, subsample=subsample)]
+        if probe_scheduler is not None:
+            subscriptions.append(Subscription(self,
+                                              ['network_output', 'input_labels', 'probe_finished'],
+                                              tag=self._probe_tag))
+        super().__init__(subscriptions,
                          message_bus,
                          {'title': title,
                           'ylabel': ylabel,
@@ -54,39 +179,190 @@ class TestAccuracySubscriber(PlotSubscriber):
                          backend=backend)
 
         self._dataset_meta = dataset_meta
-        self._data_loader  = DataLoader(dataset_meta.dataset, batch_size=batch_size, shuffle=False,
-                                        pin_memory=True)
+        self._scheduler    = probe_scheduler
+        if executor == 'process':
+            self._probe_set = CachedProbeSet(dataset_meta.dataset, batch_size, shared=True)
+        elif probe_scheduler is None:
+            self._probe_set = CachedProbeSet(dataset_meta.dataset, batch_size)
+        else:
+            self._probe_set = probe_scheduler.probe_set(dataset_meta.dataset, batch_size)
         self._frequency    = frequency
         self._forward_fn   = forward_fn
+        self._outputs      = None
+        self._topk         = tuple(k for k in topk if k > 1)
+        self._per_class    = per_class
+        self._confusion    = confusion_matrix
+        self._counts       = self._new_counts()
+        self._max_in_flight = max_in_flight
+        self._in_flight     = deque()
+        self._shadows       = []
+        self._executor      = None
+        self._num_workers   = num_workers or multiprocessing.cpu_count()
+        self._pool          = None
+        self._shards        = []
+        self._slots         = dict()
+        self._stream        = None
+        self._evaluate_fn   = self._evaluate_sharded if executor == 'process' else self._evaluate
+        if executor is not None:
+            self._executor  = ThreadPoolExecutor(max_workers=max_in_flight)
 
         self._add_publication('test_accuracy', type='META')
+        for k in self._topk:
+            self._add_publication(f'test_accuracy_top{k}', type='META')
+        if per_class:
+            self._add_publication('test_accuracy_per_class', type='META')
+        if confusion_matrix:
+            self._add_publication('test_confusion_matrix', type='META')
+
+    def _publish(self, message, kind, data):
+        self.message_bus.publish_network_message(message.global_step,
+                                                 message.train_step,
+                                                 message.epoch, kind,
+                                                 data=data)
+
+    def _publish_accuracy(self, message, results=None):
+        '''Publish the metrics of a finished pass. Without ``results``, they are taken from the
+        counts of the last pass, which are reset.'''
+        if results is None:
+            results = self._counts.results()
+            self._counts.clear()
+
+        self._add_scalar('test_accuracy', results['top1'], message.global_step)
+        self._publish(message, 'test_accuracy', results['top1'])
+        for k in self._topk:
+            self._add_scalar(f'test_accuracy_top{k}', results[f'top{k}'], message.global_step)
+            self._publish(message, f'test_accuracy_top{k}', results[f'top{k}'])
+        if self._per_class:
+            self._publish(message, 'test_accuracy_per_class', results['per_class'])
+        if self._confusion:
+            self._publish(message, 'test_confusion_matrix', results['confusion_matrix'])
+
+    def _counts_args(self):
+        return (self._dataset_meta.num_classes, (1,) + self._topk,
+                self._per_class or self._confusion)
+
+    def _new_counts(self):
+        return AccuracyAccumulator(*self._counts_args())
+
+    def _evaluate(self, shadow):
+        '''Evaluate a shadow model on the whole dataset. Runs on a worker thread.'''
+        counts = self._new_counts()
+        with ExitStack() as stack:
+            stack.enter_context(torch.no_grad())
+            if self._probe_set.device.type == 'cuda':
+                stack.enter_context(torch.cuda.stream(self._stream))
+            shadow.wait()
+            for X, labels in self._probe_set:
+                counts.add(shadow.module(X), labels)
+            return counts.results()
+
+    def _start_pool(self):
+        '''Create the shadow models in shared memory and fork the worker processes.'''
+        model         = self._forward_fn.__self__
+        self._shadows = [ShadowModel(model, device='cpu', shared=True)
+                         for _ in range(self._max_in_flight)]
+        self._slots   = {shadow: slot for slot, shadow in enumerate(self._shadows)}
+        self._probe_set.load()
+
+        batches_per_shard = -(-len(self._probe_set) // self._num_workers)
+        shard_size        = batches_per_shard * self._probe_set.batch_size
+        self._shards      = [(start, start + shard_size)
+                             for start in range(0, self._probe_set.size, shard_size)]
+
+        num_threads = max(1, torch.get_num_threads() // len(self._shards))
+        self._pool  = multiprocessing.get_context('fork').Pool(
+            len(self._shards), _init_worker,
+            ([shadow.module for shadow in self._shadows], self._probe_set, self._counts_args(),
+             num_threads)
+        )
+
+    def _evaluate_sharded(self, shadow):
+        '''Evaluate a shadow model in shared memory with the worker processes and sum their counts.
+        Runs on a worker thread.'''
+        slot   = self._slots[shadow]
+        counts = self._new_counts()
+        for shard_counts in self._pool.starmap(_evaluate_shard,
+                                               [(slot, start, stop)
+                                                for start, stop in self._shards]):
+            counts.merge(shard_counts)
+        return counts.results()
+
+    def _publish_finished(self, block=False):
+        '''Publish the results of the background evaluations which are done, in the order in which
+        they were started.
+
+        Parameters
+        ----------
+        block   :   bool
+                    Wait for the oldest evaluation to finish
+        '''
+        while self._in_flight and (block or self._in_flight[0][1].done()):
+            message, future, shadow = self._in_flight.popleft()
+            self._shadows.append(shadow)
+            self._publish_accuracy(message, future.result())
+            block = False
+
+    def _submit(self, message):
+        '''Capture the model's state and start evaluating it in the background.'''
+        if self._evaluate_fn == self._evaluate_sharded and self._pool is None:
+            self._start_pool()
+        if not self._shadows:
+            if len(self._in_flight) < self._max_in_flight:
+                self._shadows.append(ShadowModel(self._forward_fn.__self__))
+            else:
+                self._publish_finished(block=True)
+        shadow = self._shadows.pop()
+        # load before capturing, so the event recorded by the capture also orders the first load
+        # before the reads on the side stream
+        self._probe_set.load()
+        if self._probe_set.device.type == 'cuda' and self._stream is None:
+            self._stream = torch.cuda.Stream(device=self._probe_set.device)
+        shadow.capture()
+        future = self._executor.submit(self._evaluate_fn, shadow)
+        self._in_flight.append((message, future, shadow))
+
+    def flush(self):
+        '''Wait for all background evaluations and publish their results.'''
+        while self._in_flight:
+            self._publish_finished(block=True)
+
+    def close(self):
+        '''Publish all background evaluations and stop the executor and worker processes.'''
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
 
     def compute(self, message):
         '''Compute accuracy over the entire test set.
 
         A :class:`~ikkuna.export.messages.NetworkMessage` with the identifier
-        ``test_accuracy`` is published.
+        ``test_accuracy`` is published, along with the requested top-k and per-class accuracies and
+        confusion matrix.
         '''
-        if self.subscriptions['batch_finished'].counter['batch_finished'] % self._frequency == 0:
-            n_batches = 0
-            accuracy  = 0
-            loader    = iter(self._data_loader)
-            try:
-                while True:
-                    X, labels   = next(loader)
-                    if torch.cuda.is_available():
-                        X = X.cuda()
-                    outputs     = self._forward_fn(X, should_train=False, tag='testing')
-                    predictions = outputs.argmax(1)
-                    n_correct   = (predictions.cpu() == labels).sum().item()
-                    accuracy   += n_correct / X.shape[0]
-                    n_batches  += 1
-            except StopIteration:
-                accuracy /= n_batches
-                self._backend.add_data('test_accuracy', accuracy, message.global_step)
-
-                kind = 'test_accuracy'
-                self.message_bus.publish_network_message(message.global_step,
-                                                         message.train_step,
-                                                         message.epoch, kind,
-                                                         data=accuracy)
+        if message.kind == 'batch_finished':
+            self._publish_finished()
+            if self.subscriptions['batch_finished'].counter['batch_finished'] % self._frequency:
+                return
+            if self._executor is not None:
+                self._submit(message)
+                return
+            if self._scheduler is not None:
+                self._scheduler.request(self._probe_set, self._probe_tag)
+                return
+
+            for X, labels in self._probe_set:
+                outputs = self._forward_fn(X, should_train=False, tag=self._probe_tag)
+                self._counts.add(outputs, labels)
+            self._publish_accuracy(message)
+
+        elif message.kind == 'network_output':
+            self._outputs = message.data
+        elif message.kind == 'input_labels':
+            self._counts.add(self._outputs, message.data)
+            self._outputs = None
+        else:
+            self._publish_accuracy(message)
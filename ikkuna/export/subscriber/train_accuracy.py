@@ -34,9 +34,9 @@ class TrainAccuracySubscriber(PlotSubscriber):
         Y           = message.data['network_output']
         labels      = message.data['input_labels']
         predictions = Y.argmax(1)
-        n_correct   = (predictions == labels).sum().item()
-        accuracy    = n_correct / float(labels.numel())
-        self._backend.add_data('train_batch_accuracy', accuracy, message.global_step)
+        n_correct   = (predictions == labels).sum()
+        accuracy    = n_correct.float() / labels.numel()
+        self._add_scalar('train_batch_accuracy', accuracy, message.global_step)
 
         kind = 'train_accuracy'
         self.message_bus.publish_network_message(message.global_step,
@@ -1,14 +1,24 @@
-from ikkuna.export.subscriber import PlotSubscriber, Subscription
+from ikkuna.export.subscriber import PlotSubscriber, Subscription, BatchedMixin
 from ikkuna.export.messages import get_default_bus
+from ikkuna.utils.batched import variances
 
 
-class VarianceSubscriber(PlotSubscriber):
+class VarianceSubscriber(BatchedMixin, PlotSubscriber):
     '''A :class:`~ikkuna.export.subscriber.Subscriber` which computes the
     variance of quantity for the current batch.
     '''
 
+    _suffix = 'variance'
+
     def __init__(self, kind, message_bus=get_default_bus(), tag='default', subsample=1, ylims=None,
-                 backend='tb'):
+                 backend='tb', batched=False):
+        '''
+        Parameters
+        ----------
+        batched :   bool
+                    Compute the variances of each step at once (see
+                    :class:`~ikkuna.export.subscriber.BatchedMixin`)
+        '''
 
         if not isinstance(kind, str):
             raise ValueError('VarianceSubscriber only accepts 1 kind')
@@ -16,7 +26,8 @@ class VarianceSubscriber(PlotSubscriber):
         title        = f'{kind}_variance'
         ylabel       = 'σ^2'
         xlabel       = 'Train step'
-        subscription = Subscription(self, [kind], tag=tag, subsample=subsample)
+        kinds        = self._batched_kinds(kind, batched)
+        subscription = Subscription(self, kinds, tag=tag, subsample=subsample)
         super().__init__([subscription], message_bus,
                          {'title': title,
                           'ylabel': ylabel,
@@ -26,17 +37,8 @@ class VarianceSubscriber(PlotSubscriber):
 
         self._add_publication(f'{kind}_variance', type='DATA')
 
-    def compute(self, message):
-        '''Compute the variance of a quantity. A :class:`~ikkuna.export.messages.ModuleMessage`
-        with the identifier ``{kind}_variance`` is published. '''
-
-        module, module_name = message.key
-        data                = message.data
-        var                 = data.var()
-        self._backend.add_data(module_name, var, message.global_step)
+    def _statistic(self, tensor):
+        return tensor.var()
 
-        kind = f'{message.kind}_variance'
-        self.message_bus.publish_module_message(message.global_step,
-                                                message.train_step,
-                                                message.epoch, kind,
-                                                message.key, var)
+    def _statistics(self, tensors):
+        return variances(tensors)
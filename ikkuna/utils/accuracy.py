@@ -0,0 +1,127 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains the :class:`AccuracyAccumulator` for computing classification metrics over
+many batches without synchronising with the device for each of them.
+'''
+import torch
+
+
+class AccuracyAccumulator(object):
+    '''Accumulates the number of correct top-k predictions and the confusion matrix batch by batch.
+    All counts are kept as integer tensors on the device of the first batch, so adding a batch
+    launches only a few kernels and never waits for the device. The counts are copied to the host
+    in one go by :meth:`results()`.
+
+    The accuracies are the number of correct predictions over the number of datapoints, so that a
+    smaller last batch does not get more weight than the others.
+
+    Attributes
+    ----------
+    _n  :   torch.Tensor or None
+            Number of datapoints seen
+    _correct    :   torch.Tensor or None
+                    Number of correct predictions for each ``k`` in ``topk``
+    _confusion  :   torch.Tensor or None
+                    Counts of shape ``(num_classes, num_classes)`` of each true (row) and predicted
+                    (column) class, if requested
+    '''
+
+    def __init__(self, num_classes, topk=(1,), confusion=False):
+        '''
+        Parameters
+        ----------
+        num_classes :   int
+        topk    :   tuple(int)
+                    Numbers of top predictions among which the label counts as correct
+        confusion   :   bool
+                        Accumulate the confusion matrix, from which the per-class accuracies are
+                        computed
+        '''
+        self._num_classes    = num_classes
+        self._topk           = tuple(topk)
+        self._with_confusion = confusion
+        self.clear()
+
+    def clear(self):
+        '''Reset all counts.'''
+        self._n         = None
+        self._correct   = None
+        self._confusion = None
+
+    def add(self, outputs, labels):
+        '''Add a batch of predictions.
+
+        Parameters
+        ----------
+        outputs :   torch.Tensor
+                    Scores of shape ``(n, num_classes)``
+        labels  :   torch.Tensor
+                    True classes of shape ``(n,)``
+        '''
+        with torch.no_grad():
+            labels = labels.to(outputs.device, non_blocking=True)
+            if self._n is None:
+                device          = outputs.device
+                self._n         = torch.zeros((), dtype=torch.long, device=device)
+                self._correct   = torch.zeros(len(self._topk), dtype=torch.long, device=device)
+                if self._with_confusion:
+                    self._confusion = torch.zeros(self._num_classes ** 2, dtype=torch.long,
+                                                  device=device)
+
+            top  = outputs.topk(max(self._topk), dim=1).indices
+            hits = (top == labels.unsqueeze(1)).cumsum(1)
+            self._n += labels.shape[0]
+            for i, k in enumerate(self._topk):
+                self._correct[i] += hits[:, k - 1].sum()
+            if self._confusion is not None:
+                self._confusion += torch.bincount(labels * self._num_classes + top[:, 0],
+                                                  minlength=self._num_classes ** 2)
+
+    def merge(self, other):
+        '''Add the counts of another accumulator with the same configuration, e.g. from a different
+        shard of the dataset.
+
+        Parameters
+        ----------
+        other   :   AccuracyAccumulator
+        '''
+        if other.empty:
+            return
+        if self.empty:
+            self._n         = other._n.clone()
+            self._correct   = other._correct.clone()
+            self._confusion = None if other._confusion is None else other._confusion.clone()
+        else:
+            self._n       += other._n.to(self._n.device)
+            self._correct += other._correct.to(self._correct.device)
+            if self._confusion is not None:
+                self._confusion += other._confusion.to(self._confusion.device)
+
+    @property
+    def empty(self):
+        '''bool: Whether no batch was added since the last reset'''
+        return self._n is None
+
+    def results(self):
+        '''Copy the counts to the host and compute the metrics.
+
+        Returns
+        -------
+        dict(str, torch.Tensor)
+            ``'top{k}'`` holds the top-k accuracy for each ``k``. If the confusion matrix is
+            accumulated, ``'confusion_matrix'`` holds it and ``'per_class'`` holds the accuracy for
+            each class, which is ``nan`` for classes which did not occur.
+        '''
+        counts = [self._n.view(1), self._correct]
+        if self._confusion is not None:
+            counts.append(self._confusion)
+        # one copy and synchronisation for everything
+        counts  = torch.cat(counts).cpu()
+        n       = counts[0].double()
+        results = {f'top{k}': counts[1 + i].double() / n for i, k in enumerate(self._topk)}
+        if self._confusion is not None:
+            confusion = counts[1 + len(self._topk):].view(self._num_classes, self._num_classes)
+            results['confusion_matrix'] = confusion
+            results['per_class']        = confusion.diag().double() / confusion.sum(1).double()
+        return results
@@ -0,0 +1,126 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains functions for computing simple statistics of many tensors at once. Instead of
+launching one set of kernels per tensor, the tensors are grouped by device and dtype and processed
+with multi-tensor (``foreach``) kernels or as one flattened concatenation with segment reductions.
+All functions return a list of scalar tensors in the order of the inputs.
+'''
+from collections import defaultdict
+
+import torch
+
+
+def _groups(tensors):
+    '''Group tensors which can be processed together.
+
+    Returns
+    -------
+    dict(tuple(torch.device, torch.dtype), list(int))
+        Indices of the tensors for each device and dtype
+    '''
+    groups = defaultdict(list)
+    for i, t in enumerate(tensors):
+        groups[(t.device, t.dtype)].append(i)
+    return groups
+
+
+def _segment_sums(tensors):
+    '''Sum each of a list of tensors on the same device in one reduction.
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor)
+        The sums, the number of elements of each tensor, the flattened concatenation of all tensors
+        and the index of the tensor for each element in it
+    '''
+    flat   = torch.cat([t.reshape(-1) for t in tensors])
+    device = flat.device
+    counts = torch.tensor([t.numel() for t in tensors], device=device)
+    # passing the output size avoids a device synchronisation
+    ids    = torch.repeat_interleave(torch.arange(len(tensors), device=device), counts,
+                                     output_size=flat.numel())
+    sums   = flat.new_zeros(len(tensors)).index_add_(0, ids, flat)
+    return sums, counts.to(flat.dtype), flat, ids
+
+
+def _apply(tensors, fn):
+    '''Apply a function computing one value per tensor to each group of compatible tensors.'''
+    results = [None] * len(tensors)
+    with torch.no_grad():
+        for indices in _groups(tensors).values():
+            values = fn([tensors[i] for i in indices])
+            for i, value in zip(indices, values.unbind()):
+                results[i] = value
+    return results
+
+
+def norms(tensors, p=2):
+    '''Compute the norm of each tensor, treating it as a flat vector.
+
+    Parameters
+    ----------
+    tensors :   list(torch.Tensor)
+    p   :   float
+            Order of the norm
+
+    Returns
+    -------
+    list(torch.Tensor)
+    '''
+    if hasattr(torch, '_foreach_norm'):
+        return _apply(tensors, lambda ts: torch.stack(torch._foreach_norm(ts, p)))
+    else:
+        return _apply(tensors, lambda ts: torch.stack([t.norm(p=p) for t in ts]))
+
+
+def sums(tensors):
+    '''Compute the sum of each tensor.
+
+    Parameters
+    ----------
+    tensors :   list(torch.Tensor)
+
+    Returns
+    -------
+    list(torch.Tensor)
+    '''
+    return _apply(tensors, lambda ts: _segment_sums(ts)[0])
+
+
+def means(tensors):
+    '''Compute the mean of each tensor.
+
+    Parameters
+    ----------
+    tensors :   list(torch.Tensor)
+
+    Returns
+    -------
+    list(torch.Tensor)
+    '''
+    def mean(ts):
+        sums, counts, _, _ = _segment_sums(ts)
+        return sums / counts
+    return _apply(tensors, mean)
+
+
+def variances(tensors, unbiased=True):
+    '''Compute the variance of each tensor with the two-pass algorithm.
+
+    Parameters
+    ----------
+    tensors :   list(torch.Tensor)
+    unbiased    :   bool
+                    Use Bessel's correction (as :meth:`torch.Tensor.var()` does by default)
+
+    Returns
+    -------
+    list(torch.Tensor)
+    '''
+    def variance(ts):
+        sums, counts, flat, ids = _segment_sums(ts)
+        deviations = flat - (sums / counts)[ids]
+        squares    = flat.new_zeros(len(ts)).index_add_(0, ids, deviations * deviations)
+        return squares / (counts - 1 if unbiased else counts)
+    return _apply(tensors, variance)
@@ -0,0 +1,253 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains routines for computing the canonical correlation analysis (CCA) similarity of
+two sets of activations from their covariances, so that the activations themselves never have to
+be kept in memory. The similarity is computed as in Google's ``svcca`` package, but entirely in
+PyTorch and for many pairs of sets at once.
+'''
+import torch
+
+
+class CovarianceAccumulator(object):
+    '''Accumulates the sufficient statistics for the auto- and cross-covariances of two sets of
+    neurons batch by batch. The statistics are kept in double precision on the device of the first
+    batch and shifted by the means of the first batch to avoid cancellation.
+
+    Attributes
+    ----------
+    _n  :   int
+            Number of datapoints seen
+    _shift  :   tuple(torch.Tensor, torch.Tensor) or None
+                Means of the first batch
+    _sums   :   tuple(torch.Tensor, torch.Tensor)
+                Sums of the shifted data
+    _xx :   torch.Tensor
+            Sum of outer products of the shifted first set
+    _yy :   torch.Tensor
+            Sum of outer products of the shifted second set
+    _xy :   torch.Tensor
+            Sum of outer products of the shifted first and second sets
+    '''
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        '''Forget all data.'''
+        self._n     = 0
+        self._shift = None
+        self._sums  = None
+        self._xx    = None
+        self._yy    = None
+        self._xy    = None
+
+    @property
+    def n(self):
+        '''int: Number of datapoints seen'''
+        return self._n
+
+    def add(self, x, y):
+        '''Add a batch of paired datapoints.
+
+        Parameters
+        ----------
+        x   :   torch.Tensor
+                Datapoints of shape ``(m, d1)``
+        y   :   torch.Tensor
+                Datapoints of shape ``(m, d2)``
+        '''
+        with torch.no_grad():
+            x, y = x.double(), y.double()
+            if self._shift is None:
+                self._shift = (x.mean(0), y.mean(0))
+                self._sums  = (x.new_zeros(x.size(1)), y.new_zeros(y.size(1)))
+                self._xx    = x.new_zeros(x.size(1), x.size(1))
+                self._yy    = y.new_zeros(y.size(1), y.size(1))
+                self._xy    = x.new_zeros(x.size(1), y.size(1))
+            x = x - self._shift[0]
+            y = y - self._shift[1]
+            self._sums[0].add_(x.sum(0))
+            self._sums[1].add_(y.sum(0))
+            self._xx.addmm_(x.t(), x)
+            self._yy.addmm_(y.t(), y)
+            self._xy.addmm_(x.t(), y)
+            self._n += x.size(0)
+
+    def covariances(self):
+        '''Compute the sample covariances from the data seen so far.
+
+        Returns
+        -------
+        tuple(torch.Tensor, torch.Tensor, torch.Tensor)
+            The covariances of the first set, between the sets and of the second set
+
+        Raises
+        ------
+        ValueError
+            If fewer than two datapoints were added
+        '''
+        if self._n < 2:
+            raise ValueError('At least two datapoints are needed for computing covariances.')
+        mx, my = self._sums[0] / self._n, self._sums[1] / self._n
+        n      = self._n
+        sigma_xx = (self._xx - n * torch.ger(mx, mx)) / (n - 1)
+        sigma_yy = (self._yy - n * torch.ger(my, my)) / (n - 1)
+        sigma_xy = (self._xy - n * torch.ger(mx, my)) / (n - 1)
+        return sigma_xx, sigma_xy, sigma_yy
+
+
+def covariances(x, y):
+    '''Compute the sample covariances of two sets of neurons in double precision.
+
+    Parameters
+    ----------
+    x   :   torch.Tensor
+            Datapoints of shape ``(m, d1)``
+    y   :   torch.Tensor
+            Datapoints of shape ``(m, d2)``
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor, torch.Tensor)
+        The covariances of the first set, between the sets and of the second set
+    '''
+    with torch.no_grad():
+        x = x.double()
+        y = y.double()
+        x = x - x.mean(0)
+        y = y - y.mean(0)
+        n = x.size(0)
+        return x.t() @ x / (n - 1), x.t() @ y / (n - 1), y.t() @ y / (n - 1)
+
+
+def _inverse_sqrt(sigma, epsilon):
+    '''Compute the inverse square roots of a batch of symmetric positive semi-definite matrices,
+    treating all eigenvalues below ``epsilon`` as ``epsilon``.'''
+    L, V = torch.linalg.eigh(sigma)
+    return (V * L.clamp(min=epsilon).rsqrt().unsqueeze(-2)) @ V.transpose(-1, -2)
+
+
+def _mask_small(sigma, keep):
+    '''Replace the rows and columns of removed neurons in a batch of covariances by those of
+    the identity, so that they do not affect the whitening of the others.'''
+    both = keep.unsqueeze(-1) & keep.unsqueeze(-2)
+    eye  = torch.eye(sigma.size(-1), dtype=sigma.dtype, device=sigma.device)
+    return torch.where(both, sigma, eye)
+
+
+def cca_similarities(sigma_xx, sigma_xy, sigma_yy, epsilon=1e-8, threshold=0.98):
+    '''Compute the mean canonical correlation for a batch of pairs of sets of neurons from their
+    covariances. As in ``svcca.cca_core.get_cca_similarity()``, the covariances are rescaled by
+    their largest entries, neurons with a variance below ``epsilon`` are removed and only the
+    largest correlations which account for a ``threshold`` fraction of their sum are averaged.
+    Removed neurons are masked instead of cut out so that the whole batch is processed at once;
+    they only contribute canonical correlations of zero, which the threshold never includes.
+
+    Parameters
+    ----------
+    sigma_xx    :   torch.Tensor
+                    Covariances of the first sets of shape ``(B, d1, d1)``
+    sigma_xy    :   torch.Tensor
+                    Cross-covariances of shape ``(B, d1, d2)``
+    sigma_yy    :   torch.Tensor
+                    Covariances of the second sets of shape ``(B, d2, d2)``
+    epsilon :   float
+                Regularisation of the covariances and threshold for removing neurons
+    threshold   :   float
+                    Fraction of the sum of correlations to keep
+
+    Returns
+    -------
+    torch.Tensor
+        The mean correlations of shape ``(B,)``, ``0`` where all neurons of either set were
+        removed
+    '''
+    with torch.no_grad():
+        sigma_xx = sigma_xx.double()
+        sigma_yy = sigma_yy.double()
+        sigma_xy = sigma_xy.double()
+        # sets without any variance are removed below, just avoid dividing by zero
+        tiny     = torch.finfo(torch.float64).tiny
+        x_max    = sigma_xx.abs().flatten(1).max(1)[0].clamp(min=tiny).view(-1, 1, 1)
+        y_max    = sigma_yy.abs().flatten(1).max(1)[0].clamp(min=tiny).view(-1, 1, 1)
+        sigma_xx = sigma_xx / x_max
+        sigma_yy = sigma_yy / y_max
+        sigma_xy = sigma_xy / (x_max * y_max).sqrt()
+
+        x_keep   = sigma_xx.diagonal(dim1=-2, dim2=-1).abs() >= epsilon
+        y_keep   = sigma_yy.diagonal(dim1=-2, dim2=-1).abs() >= epsilon
+        sigma_xx = _mask_small(sigma_xx, x_keep)
+        sigma_yy = _mask_small(sigma_yy, y_keep)
+        sigma_xy = sigma_xy * (x_keep.unsqueeze(-1) & y_keep.unsqueeze(-2))
+
+        eye_x    = torch.eye(sigma_xx.size(-1), dtype=sigma_xx.dtype, device=sigma_xx.device)
+        eye_y    = torch.eye(sigma_yy.size(-1), dtype=sigma_yy.dtype, device=sigma_yy.device)
+        whitened = (_inverse_sqrt(sigma_xx + epsilon * eye_x, epsilon) @ sigma_xy
+                    @ _inverse_sqrt(sigma_yy + epsilon * eye_y, epsilon))
+        rho      = torch.linalg.svdvals(whitened)
+
+        # number of largest correlations needed to reach the threshold of their sum
+        cumulative = rho.cumsum(-1)
+        k          = (cumulative < threshold * cumulative[:, -1:]).sum(-1, keepdim=True) + 1
+        selected   = torch.arange(rho.size(-1), device=rho.device) < k
+        means      = (rho * selected).sum(-1) / k.squeeze(-1).clamp(max=rho.size(-1))
+        return torch.where(x_keep.any(-1) & y_keep.any(-1), means, torch.zeros_like(means))
+
+
+def cca_similarity(sigma_xx, sigma_xy, sigma_yy, epsilon=1e-8, threshold=0.98):
+    '''Compute the mean canonical correlation of two sets of neurons from their covariances. See
+    :func:`cca_similarities()`.
+
+    Parameters
+    ----------
+    sigma_xx    :   torch.Tensor
+                    Covariance of the first set of shape ``(d1, d1)``
+    sigma_xy    :   torch.Tensor
+                    Cross-covariance of shape ``(d1, d2)``
+    sigma_yy    :   torch.Tensor
+                    Covariance of the second set of shape ``(d2, d2)``
+    epsilon :   float
+                Regularisation of the covariances and threshold for removing neurons
+    threshold   :   float
+                    Fraction of the sum of correlations to keep
+
+    Returns
+    -------
+    torch.Tensor
+        The mean correlation as a scalar
+    '''
+    return cca_similarities(sigma_xx.unsqueeze(0), sigma_xy.unsqueeze(0), sigma_yy.unsqueeze(0),
+                            epsilon=epsilon, threshold=threshold)[0]
+
+
+def grouped_cca_similarities(covariances, epsilon=1e-8, threshold=0.98):
+    '''Compute the mean canonical correlations for many pairs of sets of neurons, batching all
+    pairs whose covariances have the same shapes and device.
+
+    Parameters
+    ----------
+    covariances :   dict(object, tuple(torch.Tensor, torch.Tensor, torch.Tensor))
+                    Covariances of the first set, between the sets and of the second set, e.g. for
+                    each module
+    epsilon :   float
+                Regularisation of the covariances and threshold for removing neurons
+    threshold   :   float
+                    Fraction of the sum of correlations to keep
+
+    Returns
+    -------
+    dict(object, torch.Tensor)
+        The mean correlation for each key
+    '''
+    groups = {}
+    for key, (sigma_xx, sigma_xy, sigma_yy) in covariances.items():
+        groups.setdefault((sigma_xy.shape, sigma_xy.device), []).append(key)
+
+    similarities = {}
+    for keys in groups.values():
+        stacked = [torch.stack(tensors) for tensors in zip(*(covariances[key] for key in keys))]
+        for key, similarity in zip(keys, cca_similarities(*stacked, epsilon=epsilon,
+                                                          threshold=threshold).unbind()):
+            similarities[key] = similarity
+    return similarities
@@ -0,0 +1,137 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains routines for computing the linear centered kernel alignment (CKA) of two sets
+of activations with the minibatch estimator of `Nguyen et al. (2020)
+<https://arxiv.org/abs/2010.15327>`_. The unbiased HSIC estimator of `Song et al. (2012)
+<http://www.jmlr.org/papers/v13/song12a.html>`_ is averaged over batches, so only the Gram
+matrices of one batch are needed at a time and no decomposition is necessary.
+'''
+import torch
+
+
+def gram_linear(x):
+    '''Compute the linear kernel matrix of a batch of datapoints in double precision.
+
+    Parameters
+    ----------
+    x   :   torch.Tensor
+            Datapoints of shape ``(n, ...)``. All but the first dimension are flattened.
+
+    Returns
+    -------
+    torch.Tensor
+        Matrix of shape ``(n, n)``
+    '''
+    x = x.flatten(1).double()
+    return x @ x.t()
+
+
+def unbiased_hsic(K, L):
+    '''Compute the unbiased estimate of the Hilbert-Schmidt independence criterion from two
+    (batches of) kernel matrices. Only elementwise products and sums are needed, so the cost is
+    quadratic in the number of datapoints.
+
+    Parameters
+    ----------
+    K   :   torch.Tensor
+            Symmetric kernel matrices of shape ``(..., n, n)``
+    L   :   torch.Tensor
+            Symmetric kernel matrices of the same shape
+
+    Returns
+    -------
+    torch.Tensor
+        The estimates of shape ``(...)``
+
+    Raises
+    ------
+    ValueError
+        If there are fewer than four datapoints
+    '''
+    n = K.size(-1)
+    if n < 4:
+        raise ValueError(f'The unbiased HSIC needs at least 4 datapoints, got {n}.')
+    K       = K - torch.diag_embed(K.diagonal(dim1=-2, dim2=-1))
+    L       = L - torch.diag_embed(L.diagonal(dim1=-2, dim2=-1))
+    K_rows  = K.sum(-1)
+    L_rows  = L.sum(-1)
+    trace   = (K * L).sum((-2, -1))
+    sums    = K_rows.sum(-1) * L_rows.sum(-1) / ((n - 1) * (n - 2))
+    rows    = 2 * (K_rows * L_rows).sum(-1) / (n - 2)
+    return (trace + sums - rows) / (n * (n - 3))
+
+
+class CKAAccumulator(object):
+    '''Accumulates the unbiased HSIC estimates of two sets of neurons batch by batch for computing
+    their minibatch linear CKA. Only three scalars are kept, regardless of the number of neurons and
+    datapoints.
+
+    Attributes
+    ----------
+    _n_batches  :   int
+                    Number of batches seen
+    _xy :   torch.Tensor or float
+            Sum of the estimates between the sets
+    _xx :   torch.Tensor or float
+            Sum of the estimates of the first set with itself
+    _yy :   torch.Tensor or float
+            Sum of the estimates of the second set with itself
+    '''
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        '''Forget all data.'''
+        self._n_batches = 0
+        self._xy        = 0.
+        self._xx        = 0.
+        self._yy        = 0.
+
+    @property
+    def n(self):
+        '''int: Number of batches seen'''
+        return self._n_batches
+
+    def add(self, x, y):
+        '''Add a batch of paired datapoints. Batches of fewer than four datapoints are ignored,
+        since the estimator is undefined for them.
+
+        Parameters
+        ----------
+        x   :   torch.Tensor
+                Datapoints of shape ``(n, ...)``
+        y   :   torch.Tensor
+                Datapoints of shape ``(n, ...)``
+        '''
+        if x.size(0) < 4:
+            return
+        with torch.no_grad():
+            K = gram_linear(x)
+            L = gram_linear(y)
+            self._xy = self._xy + unbiased_hsic(K, L)
+            self._xx = self._xx + unbiased_hsic(K, K)
+            self._yy = self._yy + unbiased_hsic(L, L)
+            self._n_batches += 1
+
+    def similarity(self):
+        '''Compute the minibatch CKA from the batches seen so far.
+
+        Returns
+        -------
+        torch.Tensor
+            The similarity as a scalar, ``0`` if the estimated variance of either set is not
+            positive
+
+        Raises
+        ------
+        ValueError
+            If no batch was added
+        '''
+        if self._n_batches == 0:
+            raise ValueError('At least one batch is needed for computing the similarity.')
+        # the averaging over batches cancels out
+        norm = self._xx * self._yy
+        tiny = torch.finfo(torch.float64).tiny
+        return torch.where(norm > 0, self._xy / norm.clamp(min=tiny).sqrt(), torch.zeros_like(norm))
@@ -0,0 +1,106 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains the :class:`HessianOperator` for computing products of the Hessian of a loss
+with vectors, without ever forming the Hessian. Together with
+:func:`~ikkuna.utils.linalg.lanczos` and :func:`~ikkuna.utils.linalg.hutchinson_trace`, this
+gives estimates of its spectrum.
+'''
+import torch
+
+
+class HessianOperator(object):
+    '''The Hessian of a loss w.r.t. some parameters, averaged over a fixed set of batches, as a
+    linear operator on flat vectors. The gradients of all batches are computed once with
+    ``create_graph`` when entering the operator as a context manager and each product then only
+    differentiates them once more. The graphs of all batches are kept in memory until the context
+    is left, so the batches should be few and small.
+
+    .. code-block:: python
+
+        with HessianOperator(forward_fn, loss_fn, parameters, batches) as H:
+            eigenvalues, eigenvectors, _ = lanczos(H.matvec, H.random_vector(), num_eig=3)
+
+    Attributes
+    ----------
+    _forward_fn :   function
+                    Function to obtain predictions
+    _loss_fn    :   function
+                    Function of predictions and labels returning a scalar loss
+    _parameters :   list(torch.nn.Parameter)
+    _batches    :   list(tuple(torch.Tensor, torch.Tensor))
+                    Inputs and labels
+    _gradients  :   list(tuple(torch.Tensor)) or None
+                    Differentiable gradients for each batch while inside the context
+    '''
+
+    def __init__(self, forward_fn, loss_fn, parameters, batches):
+        '''
+        Parameters
+        ----------
+        forward_fn  :   function
+                        Function to obtain predictions
+        loss_fn :   function
+                    Function of predictions and labels returning a scalar loss
+        parameters  :   list(torch.nn.Parameter)
+                        Parameters to differentiate w.r.t.
+        batches :   list(tuple(torch.Tensor, torch.Tensor))
+                    Inputs and labels, already on the parameters' device
+        '''
+        self._forward_fn = forward_fn
+        self._loss_fn    = loss_fn
+        self._parameters = list(parameters)
+        self._batches    = batches
+        self._gradients  = None
+
+    @property
+    def size(self):
+        '''int: Number of rows and columns of the Hessian'''
+        return sum(p.numel() for p in self._parameters)
+
+    def random_vector(self):
+        '''Draw a random vector matching the operator's size, dtype and device.
+
+        Returns
+        -------
+        torch.Tensor
+        '''
+        p = self._parameters[0]
+        return torch.randn(self.size, dtype=p.dtype, device=p.device)
+
+    def __enter__(self):
+        self._gradients = []
+        for X, Y in self._batches:
+            loss = self._loss_fn(self._forward_fn(X), Y)
+            self._gradients.append(torch.autograd.grad(loss, self._parameters, create_graph=True))
+        return self
+
+    def __exit__(self, *args):
+        # drop the graphs
+        self._gradients = None
+
+    def matvec(self, v):
+        '''Compute the product of the Hessian with a vector.
+
+        Parameters
+        ----------
+        v   :   torch.Tensor
+                Flat vector of length :attr:`size`
+
+        Returns
+        -------
+        torch.Tensor
+        '''
+        if self._gradients is None:
+            raise RuntimeError(f'{self.__class__.__name__} must be used as a context manager.')
+
+        v       = v.detach()
+        vectors = [chunk.view_as(p)
+                   for chunk, p in zip(v.split([p.numel() for p in self._parameters]),
+                                       self._parameters)]
+        result  = torch.zeros_like(v)
+        for gradients in self._gradients:
+            products = torch.autograd.grad(gradients, self._parameters, grad_outputs=vectors,
+                                           retain_graph=True)
+            result  += torch.cat([product.reshape(-1) for product in products])
+        return result / len(self._gradients)
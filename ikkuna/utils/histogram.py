@@ -0,0 +1,153 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains the :class:`HistogramBinner` for computing histograms of tensors on their
+device, so that only the bin counts have to be copied to the host and plotted.
+'''
+import numpy as np
+import torch
+
+
+class Histogram(object):
+    '''Bin counts of a tensor together with the summary statistics tensorboard displays. All
+    values are on the host.
+
+    Attributes
+    ----------
+    edges   :   numpy.ndarray
+                ``bins + 1`` edges of the bins
+    counts  :   numpy.ndarray
+                Number of values in each bin
+    min :   float
+    max :   float
+    num :   int
+            Number of values
+    sum :   float
+    sum_squares :   float
+    '''
+
+    def __init__(self, edges, counts, min, max, num, sum, sum_squares):
+        self.edges       = edges
+        self.counts      = counts
+        self.min         = min
+        self.max         = max
+        self.num         = num
+        self.sum         = sum
+        self.sum_squares = sum_squares
+
+    def rebin(self, edges):
+        '''Distribute the counts onto different bins, assuming the values are spread uniformly
+        within each bin.
+
+        Parameters
+        ----------
+        edges   :   numpy.ndarray
+
+        Returns
+        -------
+        numpy.ndarray
+            Counts for the new bins
+        '''
+        if np.array_equal(edges, self.edges):
+            return self.counts
+        cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+        return np.diff(np.interp(edges, self.edges, cumulative))
+
+    @staticmethod
+    def merge(histograms):
+        '''Combine several histograms of the same quantity into one. Histograms with different
+        edges are rebinned onto the edges spanning the widest range.
+
+        Parameters
+        ----------
+        histograms  :   list(Histogram)
+
+        Returns
+        -------
+        Histogram
+        '''
+        edges = max((h.edges for h in histograms), key=lambda e: e[-1] - e[0])
+        return Histogram(edges,
+                         sum(h.rebin(edges) for h in histograms),
+                         min(h.min for h in histograms),
+                         max(h.max for h in histograms),
+                         sum(h.num for h in histograms),
+                         sum(h.sum for h in histograms),
+                         sum(h.sum_squares for h in histograms))
+
+
+class HistogramBinner(object):
+    '''Computes :class:`Histogram`\ s of tensors with a fixed number of bins on the tensor's device.
+    The counts and statistics are copied to the host together in one go, so the cost of a
+    histogram no longer depends on the size of the tensor, apart from the binning itself.
+
+    The edges are either fixed by ``range``, in which case values outside of it are counted in the
+    outermost bins, or adapted to each key (e.g. module) separately: They span the smallest and
+    largest value seen for that key so far, which are tracked on the device. The edges therefore
+    only ever grow, and histograms of the same key from different steps stay comparable.
+
+    Attributes
+    ----------
+    _ranges :   dict(object, torch.Tensor)
+                Smallest and largest value seen for each key if the edges are adaptive
+    '''
+
+    def __init__(self, bins=50, range=None):
+        '''
+        Parameters
+        ----------
+        bins    :   int
+                    Number of bins
+        range   :   tuple(float, float) or None
+                    Lower and upper edge of the bins. ``None`` adapts the edges to the data.
+        '''
+        if range is not None and not range[0] < range[1]:
+            raise ValueError(f'Invalid histogram range {range}')
+        self._bins   = bins
+        self._range  = range
+        self._ranges = dict()
+
+    def __call__(self, key, X):
+        '''Compute the histogram of a tensor.
+
+        Parameters
+        ----------
+        key :   object
+                Key under which the adaptive edges are tracked
+        X   :   torch.Tensor
+
+        Returns
+        -------
+        Histogram
+        '''
+        with torch.no_grad():
+            X     = X.detach().reshape(-1).float()
+            stats = torch.stack([X.min().double(), X.max().double(), X.sum(dtype=torch.float64),
+                                 X.pow(2).sum(dtype=torch.float64)])
+
+            if self._range is not None:
+                lower, upper = self._range
+                counts = torch.histc(X.clamp(lower, upper), self._bins, lower, upper)
+                packed = torch.cat([stats, counts.double()]).cpu().numpy()
+                counts = packed[4:]
+            else:
+                limits = self._ranges.get(key)
+                if limits is None:
+                    limits = stats[:2].clone()
+                else:
+                    limits = torch.stack([torch.min(limits[0], stats[0]),
+                                          torch.max(limits[1], stats[1])])
+                self._ranges[key] = limits
+                # avoid zero-width bins for constant tensors
+                width  = (limits[1] - limits[0]).clamp(min=1e-12)
+                steps  = torch.arange(1, self._bins, device=X.device, dtype=torch.float64)
+                inner  = (limits[0] + width * steps / self._bins).float()
+                counts = torch.bincount(torch.bucketize(X, inner, right=True),
+                                        minlength=self._bins)
+                packed = torch.cat([stats, counts.double(), limits[:1], width.view(1)])
+                packed = packed.cpu().numpy()
+                lower, upper = packed[-2], packed[-2] + packed[-1]
+                counts = packed[4:-2]
+
+        return Histogram(np.linspace(lower, upper, self._bins + 1), counts, float(packed[0]),
+                         float(packed[1]), X.numel(), float(packed[2]), float(packed[3]))
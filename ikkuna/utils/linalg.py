@@ -0,0 +1,267 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains linear algebra routines used by the subscribers. They operate on batches of
+matrices so that many layers can be handled with one set of kernel launches.
+'''
+import torch
+from torch.nn.functional import normalize
+
+
+def as_matrix(tensor):
+    '''Reshape a weight tensor into a matrix with one row per output unit.
+
+    Parameters
+    ----------
+    tensor  :   torch.Tensor
+
+    Returns
+    -------
+    torch.Tensor
+    '''
+    return tensor.reshape(tensor.size(0), -1)
+
+
+def power_iteration(matrices, u, n_iter=20, tol=1e-4, sigma=None, check_every=5):
+    '''Estimate the largest singular value of each matrix in a batch by power iteration. The
+    iteration stops early if the relative change of all estimates falls below ``tol``. Since
+    reading the change synchronises with the device, it is checked for the whole batch at once, and
+    only after the first iteration (where warm-started estimates have usually converged already)
+    and then every ``check_every`` iterations.
+
+    Parameters
+    ----------
+    matrices    :   torch.Tensor
+                    Batch of matrices of shape ``(B, m, n)``
+    u   :   torch.Tensor
+            Start vectors of shape ``(B, m)``, e.g. the left singular vectors from a previous call
+            for warm-starting
+    n_iter  :   int
+                Maximum number of iterations
+    tol :   float or None
+            Relative tolerance for stopping. ``None`` always runs ``n_iter`` iterations and avoids
+            the device synchronisation needed for checking convergence.
+    sigma   :   torch.Tensor or None
+                Previous estimates of shape ``(B,)``. If given, the first iteration may already be
+                considered converged.
+    check_every :   int
+                    Number of iterations between convergence checks
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor, int)
+        The estimates of shape ``(B,)``, the left singular vectors of shape ``(B, m)`` and the
+        number of iterations run
+    '''
+    with torch.no_grad():
+        transposed = matrices.transpose(1, 2)
+        for i in range(1, n_iter + 1):
+            v         = normalize(torch.bmm(transposed, u.unsqueeze(2)).squeeze(2), dim=1)
+            Wv        = torch.bmm(matrices, v.unsqueeze(2)).squeeze(2)
+            new_sigma = Wv.norm(dim=1)
+            u         = Wv / new_sigma.clamp(min=1e-12).unsqueeze(1)
+            if tol is not None and sigma is not None and (i == 1 or i % check_every == 0):
+                change = ((new_sigma - sigma).abs() / new_sigma.clamp(min=1e-12)).max()
+                if change.item() < tol:
+                    return new_sigma, u, i
+            sigma = new_sigma
+    return sigma, u, n_iter
+
+
+def top_singular(matrices):
+    '''Compute the largest singular value and corresponding left singular vector exactly.
+
+    Parameters
+    ----------
+    matrices    :   torch.Tensor
+                    Batch of matrices of shape ``(B, m, n)``
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor)
+        The singular values of shape ``(B,)`` and the vectors of shape ``(B, m)``
+    '''
+    with torch.no_grad():
+        U, S, _ = torch.linalg.svd(matrices, full_matrices=False)
+    return S[:, 0], U[:, :, 0]
+
+
+def _lanczos(matvec, q, k, stop=None):
+    '''Run up to ``k`` steps of the Lanczos iteration on a symmetric operator with full
+    reorthogonalisation. The iteration also ends once the Krylov space is invariant, i.e. the new
+    direction vanishes relative to ``T``, in which case the eigenvalues of ``T`` are exact.
+
+    Parameters
+    ----------
+    matvec  :   function
+                Function computing the product of the operator with a vector
+    q   :   torch.Tensor
+            Unit start vector of length ``N``
+    k   :   int
+            Maximum number of steps, at most ``N``
+    stop    :   function or None
+                Called with the tridiagonal matrix after each step. The iteration ends early if it
+                returns ``True``.
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor)
+        The tridiagonal matrix ``T`` of shape ``(j, j)`` and the orthonormal basis ``Q`` of shape
+        ``(N, j)`` with ``T = Q^T A Q``, where ``j`` is the number of steps run
+    '''
+    Q = q.new_zeros(q.numel(), k)
+    T = q.new_zeros(k, k)
+    for j in range(k):
+        Q[:, j] = q
+        w       = matvec(q)
+        T[j, j] = torch.dot(q, w)
+        if j == k - 1 or (stop is not None and stop(T[:j + 1, :j + 1])):
+            break
+        # full reorthogonalisation against the basis so far (twice is enough)
+        w      -= torch.mv(Q[:, :j + 1], torch.mv(Q[:, :j + 1].t(), w))
+        w      -= torch.mv(Q[:, :j + 1], torch.mv(Q[:, :j + 1].t(), w))
+        beta    = w.norm()
+        if (beta <= torch.finfo(w.dtype).eps * T.norm()).item():
+            break
+        q       = w / beta
+        T[j, j + 1] = T[j + 1, j] = beta
+    return T[:j + 1, :j + 1], Q[:, :j + 1]
+
+
+def lanczos(matvec, start, num_eig=1, n_steps=20, tol=1e-3, check_every=5):
+    '''Estimate the largest eigenvalues and corresponding eigenvectors of a symmetric operator
+    which is only available through its products with vectors. Convergence is checked every
+    ``check_every`` steps, since it needs a synchronisation with the device.
+
+    Parameters
+    ----------
+    matvec  :   function
+                Function computing the product of the operator with a vector
+    start   :   torch.Tensor
+                Start vector, e.g. the sum of the eigenvectors from a previous call for
+                warm-starting
+    num_eig :   int
+                Number of eigenpairs to compute
+    n_steps :   int
+                Maximum number of steps, i.e. products with the operator
+    tol :   float or None
+            Relative change of the estimates since the last check below which the iteration
+            stops. ``None`` always runs ``n_steps`` steps.
+    check_every :   int
+                    Number of steps between convergence checks
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor, int)
+        The eigenvalues of shape ``(num_eig,)`` in descending order, the eigenvectors of shape
+        ``(N, num_eig)`` and the number of steps run
+    '''
+    previous = None
+
+    def converged(T):
+        nonlocal previous
+        if tol is None or T.size(0) < num_eig or T.size(0) % check_every:
+            return False
+        ritz = torch.linalg.eigvalsh(T)[-num_eig:]
+        done = (previous is not None
+                and ((ritz - previous).abs() / ritz.abs().clamp(min=1e-12)).max().item() < tol)
+        previous = ritz
+        return done
+
+    with torch.no_grad():
+        q    = start / start.norm()
+        T, Q = _lanczos(matvec, q, min(n_steps, q.numel()), stop=converged)
+        L, S = torch.linalg.eigh(T)
+        L, S = L.flip(0)[:num_eig], S.flip(1)[:, :num_eig]
+    return L, Q @ S, T.size(0)
+
+
+def hutchinson_trace(matvec, like, n_samples=10):
+    '''Estimate the trace of an operator from its products with random Rademacher vectors.
+
+    Parameters
+    ----------
+    matvec  :   function
+                Function computing the product of the operator with a vector
+    like    :   torch.Tensor
+                Vector with the size, dtype and device of the operator's inputs
+    n_samples   :   int
+                    Number of random vectors
+
+    Returns
+    -------
+    torch.Tensor
+        The estimate
+    '''
+    with torch.no_grad():
+        trace = like.new_zeros(())
+        for _ in range(n_samples):
+            z      = torch.randint_like(like, 2) * 2 - 1
+            trace += torch.dot(z, matvec(z))
+    return trace / n_samples
+
+
+def extreme_singular_values(matrix, start=None, k=64, n_restarts=20, tol=1e-6, exact_size=4096,
+                            check_every=2):
+    '''Estimate the largest and smallest singular values of a matrix with restarted Lanczos
+    iteration on its Gram matrix, without computing a full SVD. Computation happens in double
+    precision. The smallest singular value is taken over the smaller dimension, so it is the
+    smallest nonzero one for matrices of full rank, i.e. the reciprocal of the largest singular
+    value of the pseudo-inverse.
+
+    Parameters
+    ----------
+    matrix  :   torch.Tensor
+                Matrix of shape ``(m, n)``
+    start   :   torch.Tensor or None
+                Start vector of length ``min(m, n)``, e.g. the one returned by a previous call for
+                warm-starting. A random vector is used if ``None``.
+    k   :   int
+            Size of the Krylov subspace per restart
+    n_restarts  :   int
+                    Maximum number of restarts
+    tol :   float
+            Relative change of the smallest eigenvalue of the Gram matrix since the last check
+            below which the iteration stops
+    exact_size  :   int
+                    If ``min(m, n)`` is at most this, the eigenvalues of the Gram matrix are
+                    computed exactly. This is faster than the iteration for all but very large
+                    matrices and more robust if the smallest singular values are clustered.
+    check_every :   int
+                    Number of restarts between convergence checks, each of which synchronises with
+                    the device
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor, torch.Tensor)
+        The largest and smallest singular values and a start vector for the next call
+    '''
+    with torch.no_grad():
+        A = matrix.double()
+        # the Gram matrix of the smaller side has no spurious zero eigenvalues. Forming it reads
+        # the matrix once, while every Lanczos step on the matrix itself would read it twice.
+        G = A @ A.t() if A.size(0) <= A.size(1) else A.t() @ A
+        N = G.size(0)
+        if start is None:
+            start = torch.randn(N, dtype=G.dtype, device=G.device)
+        q = start.to(G.dtype) / start.norm()
+        if N <= max(exact_size, k):
+            L = torch.linalg.eigvalsh(G)
+            return L[-1].sqrt(), L[0].clamp(min=0).sqrt(), q
+
+        previous = None
+        for restart in range(1, n_restarts + 1):
+            T, Q       = _lanczos(lambda x: torch.mv(G, x), q, k)
+            L, S       = torch.linalg.eigh(T)
+            lambda_min = L[0].clamp(min=0)
+            lambda_max = L[-1]
+            # restart with the Ritz vectors of both extremes
+            q          = Q @ (S[:, 0] + S[:, -1])
+            q          = q / q.norm()
+            if restart % check_every:
+                continue
+            if previous is not None and ((previous - lambda_min).abs()
+                                         / lambda_min.clamp(min=1e-300)).item() < tol:
+                break
+            previous = lambda_min
+    return lambda_max.sqrt(), lambda_min.sqrt(), q
@@ -0,0 +1,178 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains the :class:`CachedProbeSet`, which keeps a dataset used for evaluation passes
+in memory as ready-made batches, so that propagating it again is pure compute.
+'''
+import torch
+from torch.utils.data import DataLoader
+
+
+class CachedProbeSet(object):
+    '''A dataset which is loaded once into two contiguous tensors of inputs and labels on the
+    device (or in shared host memory) and then iterated in batches of ``(inputs, labels)``, like a
+    :class:`~torch.utils.data.DataLoader` without shuffling. Nothing is decoded, collated or copied
+    to the device again, the batches are views into the cached tensors.
+
+    The inputs can be stored with less precision to save memory. With ``torch.uint8``, inputs in
+    ``[0, 1]`` (e.g. images after :class:`~torchvision.transforms.ToTensor`) are stored as
+    multiples of ``1/255``, which is lossless for 8-bit images. Since this precludes normalised
+    inputs, the normalisation can be applied on the fly to each batch instead, after it has been
+    converted back to single precision.
+
+    The dataset is only loaded when the probe set is first iterated or :meth:`load()` is called.
+
+    Attributes
+    ----------
+    _inputs :   torch.Tensor or None
+                All inputs, once loaded
+    _labels :   torch.Tensor or None
+                All labels, once loaded
+    '''
+
+    DTYPES = (None, torch.float16, torch.uint8)
+
+    def __init__(self, dataset, batch_size, device=None, dtype=None, mean=None, std=None,
+                 shared=False):
+        '''
+        Parameters
+        ----------
+        dataset :   torch.utils.data.Dataset
+                    Dataset returning pairs of input tensors and labels
+        batch_size  :   int
+        device  :   torch.device or str or None
+                    Device to keep the data on. Defaults to the GPU if one is available.
+        dtype   :   torch.dtype or None
+                    ``torch.float16`` or ``torch.uint8`` to store the inputs with. ``None`` keeps
+                    them as they are.
+        mean    :   sequence(float) or None
+                    Per-channel mean to subtract from each batch
+        std :   sequence(float) or None
+                Per-channel standard deviation to divide each batch by
+        shared  :   bool
+                    Keep the tensors in shared host memory, so that other processes can read them
+                    without copying
+
+        Raises
+        ------
+        ValueError
+            If the dtype is not supported or shared memory is requested for a device other than
+            the CPU
+        '''
+        if dtype not in CachedProbeSet.DTYPES:
+            raise ValueError(f'Unsupported dtype {dtype}')
+        if device is None:
+            device = 'cpu' if shared or not torch.cuda.is_available() else 'cuda'
+        device = torch.device(device)
+        if shared and device.type != 'cpu':
+            raise ValueError('Shared memory can only be used on the CPU.')
+
+        self._dataset    = dataset
+        self._batch_size = batch_size
+        self._device     = device
+        self._dtype      = dtype
+        self._mean       = mean
+        self._std        = std
+        self._shared     = shared
+        self._inputs     = None
+        self._labels     = None
+
+    @property
+    def device(self):
+        '''torch.device: Device the data is kept on'''
+        return self._device
+
+    @property
+    def batch_size(self):
+        '''int: Number of datapoints per batch'''
+        return self._batch_size
+
+    def __len__(self):
+        '''Get the number of batches.'''
+        return -(-self.size // self._batch_size)
+
+    @property
+    def size(self):
+        '''int: Number of datapoints'''
+        return len(self._dataset)
+
+    def bytesize(self):
+        '''Compute the bytes occupied by the cached data. Zero before it is loaded.
+
+        Returns
+        -------
+        int
+        '''
+        if self._inputs is None:
+            return 0
+        return sum(t.numel() * t.element_size() for t in (self._inputs, self._labels))
+
+    def _quantize(self, X):
+        '''Convert a batch of inputs to the storage dtype.'''
+        if self._dtype == torch.uint8:
+            if X.min() < 0 or X.max() > 1:
+                raise ValueError('Inputs must be in [0, 1] to be stored as uint8.')
+            return X.mul(255).round_().to(torch.uint8)
+        elif self._dtype is not None:
+            return X.to(self._dtype)
+        return X
+
+    def load(self):
+        '''Load the whole dataset into contiguous tensors, unless already done. This happens on the
+        first iteration, but should be done explicitly before the probe set is iterated from several
+        threads.'''
+        if self._inputs is not None:
+            return
+        loader = DataLoader(self._dataset, batch_size=self._batch_size, shuffle=False)
+        inputs, labels = [], []
+        for X, Y in loader:
+            inputs.append(self._quantize(X).to(self._device, non_blocking=True))
+            labels.append(torch.as_tensor(Y).to(self._device, non_blocking=True))
+        self._inputs = torch.cat(inputs)
+        self._labels = torch.cat(labels)
+        if self._shared:
+            self._inputs.share_memory_()
+            self._labels.share_memory_()
+
+        if self._mean is not None or self._std is not None:
+            shape = (1, -1) + (1,) * (self._inputs.ndimension() - 2)
+            if self._mean is not None:
+                self._mean = torch.tensor(self._mean, device=self._device).view(shape)
+            if self._std is not None:
+                self._std = torch.tensor(self._std, device=self._device).view(shape)
+
+    def _prepare(self, X):
+        '''Convert a batch of inputs back to single precision and normalise it.'''
+        if self._dtype == torch.uint8:
+            X = X.float().div_(255)
+        elif self._dtype is not None:
+            X = X.float()
+        if self._mean is not None:
+            X = X - self._mean
+        if self._std is not None:
+            X = X / self._std
+        return X
+
+    def batches(self, start=0, stop=None):
+        '''Iterate over the batches of a contiguous shard of the datapoints.
+
+        Parameters
+        ----------
+        start   :   int
+                    Index of the first datapoint
+        stop    :   int or None
+                    Index after the last datapoint. Defaults to the end of the dataset.
+
+        Yields
+        ------
+        tuple(torch.Tensor, torch.Tensor)
+            Inputs and labels of at most ``batch_size`` datapoints
+        '''
+        self.load()
+        stop = self._inputs.shape[0] if stop is None else min(stop, self._inputs.shape[0])
+        for begin in range(start, stop, self._batch_size):
+            end = min(begin + self._batch_size, stop)
+            yield self._prepare(self._inputs[begin:end]), self._labels[begin:end]
+
+    def __iter__(self):
+        return self.batches()
@@ -0,0 +1,145 @@
+'''
+.. moduleauthor:: Rasmus Diederichsen
+
+This module contains the :class:`ActivationReducer` for shrinking activations on their device
+before they are stored, e.g. by the SVCCA subscribers.
+'''
+import math
+
+import torch
+import torch.nn.functional as F
+
+# adaptive average pooling by number of spatial dimensions
+_ADAPTIVE_POOLS = {1: F.adaptive_avg_pool1d, 2: F.adaptive_avg_pool2d, 3: F.adaptive_avg_pool3d}
+
+
+class ActivationReducer(object):
+    '''Reduces a module's activations of shape ``(n, C, ...)`` by subsampling or pooling the
+    spatial positions and by randomly projecting the channels. The number of datapoints is never
+    changed. All choices which are random are drawn once per module, so that activations of the
+    same module from different checkpoints or batches are reduced in the same way and stay
+    comparable.
+
+    The reductions trade accuracy for memory and compute in different ways:
+
+    * Sampling ``spatial_samples`` random positions or every ``spatial_stride``-th position in both
+      directions divides the number of rows of the activation matrices by ``H * W /
+      spatial_samples`` or ``spatial_stride ** 2``, respectively. Since neighbouring positions are
+      strongly correlated, the similarity is usually only slightly noisier, as long as enough rows
+      remain for the number of channels.
+    * Pooling to ``pool_size`` averages neighbouring positions instead of dropping them. The
+      memory saved is the same as for sampling, but the representation is smoothed, which tends to
+      increase the similarity somewhat.
+    * Projecting the channels onto ``projection_dim`` random directions divides the number of
+      columns, which reduces the cost of the decompositions cubically. Distances are preserved in
+      expectation, but canonical correlations along directions not in the projected span are lost,
+      so the dimension should be kept well above the number of directions needed for the SVCCA
+      ``threshold``. The sparse projection has the same guarantees and is faster to apply.
+
+    Attributes
+    ----------
+    _positions  :   dict(torch.nn.Module, torch.Tensor)
+                    Indices of the sampled spatial positions per module
+    _projections    :   dict(torch.nn.Module, torch.Tensor)
+                        Projection matrix of shape ``(C, projection_dim)`` per module
+    '''
+
+    def __init__(self, spatial_stride=1, spatial_samples=None, pool_size=None,
+                 projection_dim=None, projection='gaussian', seed=0):
+        '''
+        Parameters
+        ----------
+        spatial_stride  :   int
+                            Keep only every nth position in each spatial dimension
+        spatial_samples :   int or None
+                            Number of random spatial positions to keep
+        pool_size   :   int or tuple(int) or None
+                        Spatial size to average pool to, for activations with one to three
+                        spatial dimensions. Activations without any are left as they are.
+        projection_dim  :   int or None
+                            Number of random directions to project the channels onto. Modules with
+                            no more channels than that are not projected.
+        projection  :   str
+                        ``'gaussian'`` or ``'sparse'``
+        seed    :   int
+                    Seed for the random positions and projections
+
+        Raises
+        ------
+        ValueError
+            If an unknown projection is given or more than one spatial reduction is chosen
+        '''
+        if projection not in ('gaussian', 'sparse'):
+            raise ValueError(f'Unknown projection "{projection}"')
+        if sum([spatial_stride > 1, spatial_samples is not None, pool_size is not None]) > 1:
+            raise ValueError('Only one of spatial_stride, spatial_samples and pool_size can be '
+                             'set.')
+
+        self._spatial_stride  = spatial_stride
+        self._spatial_samples = spatial_samples
+        self._pool_size       = pool_size
+        self._projection_dim  = projection_dim
+        self._projection      = projection
+        self._seed            = seed
+        self._positions       = {}
+        self._projections     = {}
+
+    def _generator(self, key):
+        '''Create a CPU generator whose seed depends on the order in which modules are seen. Even
+        keys are used for positions and odd ones for projections.'''
+        generator = torch.Generator()
+        generator.manual_seed(self._seed + key)
+        return generator
+
+    def _sample_positions(self, module, activations):
+        if module not in self._positions:
+            n_positions = activations[0, 0].numel()
+            generator   = self._generator(2 * len(self._positions))
+            indices     = torch.randperm(n_positions, generator=generator)[:self._spatial_samples]
+            self._positions[module] = indices.sort()[0].to(activations.device)
+        return activations.flatten(2).index_select(2, self._positions[module])
+
+    def _project(self, module, activations):
+        if module not in self._projections:
+            c, k      = activations.size(1), self._projection_dim
+            generator = self._generator(2 * len(self._projections) + 1)
+            if self._projection == 'gaussian':
+                P = torch.randn(c, k, generator=generator) / math.sqrt(k)
+            else:
+                # Achlioptas' projection: +-sqrt(3 / k) with probability 1/6 each, 0 otherwise
+                u = torch.rand(c, k, generator=generator)
+                P = ((u < 1 / 6).float() - (u > 5 / 6).float()) * math.sqrt(3 / k)
+            self._projections[module] = P.to(activations.device, activations.dtype)
+        P = self._projections[module]
+        return (activations.movedim(1, -1) @ P).movedim(-1, 1)
+
+    def __call__(self, module, activations):
+        '''Reduce the activations of a module.
+
+        Parameters
+        ----------
+        module  :   torch.nn.Module or str
+                    Some unique key for this module
+        activations :   torch.Tensor
+                        Activations of shape ``(n, C, ...)``
+
+        Returns
+        -------
+        torch.Tensor
+            The reduced activations of shape ``(n, C', ...)``
+        '''
+        with torch.no_grad():
+            if activations.ndimension() > 2:
+                if self._spatial_stride > 1:
+                    n_spatial   = activations.ndimension() - 2
+                    steps       = (slice(None, None, self._spatial_stride),) * n_spatial
+                    activations = activations[(Ellipsis,) + steps]
+                elif self._spatial_samples is not None:
+                    activations = self._sample_positions(module, activations)
+                elif self._pool_size is not None:
+                    pool        = _ADAPTIVE_POOLS[activations.ndimension() - 2]
+                    activations = pool(activations, self._pool_size)
+
+            if self._projection_dim is not None and activations.size(1) > self._projection_dim:
+                activations = self._project(module, activations)
+            return activations
@@ -5,6 +5,7 @@ import numpy as np
 from collections import defaultdict
 from mpl_toolkits.mplot3d import Axes3D     # noqa
 from ikkuna.utils import make_fill_polygons
+from ikkuna.utils.histogram import Histogram, HistogramBinner
 import torch
 
 
@@ -50,8 +51,8 @@ class Backend(abc.ABC):
         ----------
         module_name  :  str
                         Name of module which emitted the data
-        datum   :   torch.Tensor
-                    Payload, not the histogram itself
+        datum   :   torch.Tensor or ikkuna.utils.histogram.Histogram
+                    Payload to bin or the histogram computed already
         step    :   int
                     Global step
         '''
@@ -186,17 +187,16 @@ class UpdatableHistogram(object):
             self._ax.add_collection3d(collection)
 
     def add_data(self, X):
-        '''Add data for a new histogram. Currently, the number of bins is fixed at 50. Old data is
-        deleted.
+        '''Add data for a new histogram. Old data is deleted.
 
         Parameters
         ----------
-        X   :   list
-                Arbitrary sequence of tensors to merge for a histogram
+        X   :   list(ikkuna.utils.histogram.Histogram)
+                Arbitrary sequence of histograms to merge
         '''
-        import torch
-        X           = torch.cat(X).detach().cpu().numpy()
-        hist, edges = np.histogram(X, bins=50, density=True)
+        histogram = Histogram.merge(X)
+        edges     = histogram.edges
+        hist      = histogram.counts / (histogram.counts.sum() * np.diff(edges))
         self._hists.append((hist, edges))
         if len(self._hists) > self._max_hists:
             self._hists.pop(0)
@@ -221,9 +221,11 @@ class MPLBackend(Backend):
     _axes   :   dict
                 module-UpdatableHistogram mapping (this should be refactored)
     _buffer :   dict
-                Per-module buffer of tensors for more reliable histograms
+                Per-module buffer of histograms for more reliable histograms
     _buffer_lim :   int
                     Size of the buffer
+    _binner :   ikkuna.utils.histogram.HistogramBinner
+                Computes histograms of tensors on their device
     '''
 
     def __init__(self, **kwargs):
@@ -235,6 +237,10 @@ class MPLBackend(Backend):
         ylims   :   tuple
         buffer_lim  :   int
                         Buffer size for more reliable histograms
+        bins    :   int
+                    Number of bins to use for histograms
+        range   :   tuple(float, float) or None
+                    Range of the histogram bins. ``None`` adapts them to each module's data.
         '''
         super().__init__(kwargs.get('title'))
 
@@ -255,6 +261,7 @@ class MPLBackend(Backend):
         ####################
         self._buffer      = defaultdict(list)
         self._buffer_lim  = kwargs.get('buffer_size', 20)
+        self._binner      = HistogramBinner(kwargs.get('bins', 50), kwargs.get('range'))
 
     def _prepare_axis(self, ax):
         '''Prepare the line plot axis with labels and scaling.'''
@@ -318,6 +325,8 @@ class MPLBackend(Backend):
 
             self._reflow_plots()
 
+        if not isinstance(datum, Histogram):
+            datum = self._binner(module_name, datum)
         self._buffer[module_name].append(datum)
 
         if len(self._buffer[module_name]) == self._buffer_lim:   # buffer full
@@ -413,8 +422,9 @@ class TBBackend(Backend):
     Attributes
     ----------
     _writer :   tensorboardX.SummaryWriter
-    _hist_bins   :   int
-                     Number of bins to use for histograms
+    _binner :   ikkuna.utils.histogram.HistogramBinner
+                Computes histograms of tensors on their device with the ``bins`` and ``range`` from
+                the plot configuration
     '''
 
     # TODO: make printing metadata non-hacky
@@ -422,7 +432,7 @@ class TBBackend(Backend):
 
     def __init__(self, **kwargs):
         super().__init__(kwargs.pop('title'))
-        self._hist_bins = kwargs.pop('bins', 50)
+        self._binner    = HistogramBinner(kwargs.pop('bins', 50), kwargs.pop('range', None))
         self.log_dir    = kwargs.pop('log_dir', 'runs' if not prefix else prefix)
         index           = determine_run_index(self.log_dir)
         log_dir         = f'{self.log_dir}/run{index}'
@@ -433,6 +443,11 @@ class TBBackend(Backend):
         # Unfortunately, xlabels, ylabels and plot titles are not supported
         self._writer.add_scalars(f'{self.title}', {module_name: datum}, global_step=step)
 
-    def add_histogram(self, module_name, datum, step, bins='auto'):
-        self._writer.add_histogram(f'{self.title}: {module_name}', datum, global_step=step,
-                                   bins=bins)
+    def add_histogram(self, module_name, datum, step):
+        # only the bin counts are sent, tensorboard only needs the right edges
+        if not isinstance(datum, Histogram):
+            datum = self._binner(module_name, datum)
+        self._writer.add_histogram_raw(f'{self.title}: {module_name}', datum.min, datum.max,
+                                       datum.num, datum.sum, datum.sum_squares,
+                                       datum.edges[1:].tolist(), datum.counts.tolist(),
+                                       global_step=step)
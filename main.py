@@ -26,10 +26,12 @@ from torchvision.transforms import ToTensor
 #######################
 from train import Trainer
 from ikkuna.utils import load_dataset, seed_everything
+from ikkuna.utils.sketch import ActivationReducer
 from ikkuna.export.subscriber import (RatioSubscriber, HistogramSubscriber, SpectralNormSubscriber,
                                       TestAccuracySubscriber, TrainAccuracySubscriber,
                                       NormSubscriber, MessageMeanSubscriber,
-                                      VarianceSubscriber, SVCCASubscriber)
+                                      VarianceSubscriber, SVCCASubscriber,
+                                      BatchedSVCCASubscriber, MetricAccumulator)
 from ikkuna.export import Exporter
 from ikkuna.export.messages import MessageBus
 import ikkuna.visualization
@@ -62,7 +64,8 @@ def _main(dataset_str, model_str, batch_size, epochs, optimizer, **kwargs):
                                         module_filter=[torch.nn.Conv2d],
                                         message_bus=bus))
     trainer.set_model(model_str)
-    trainer.optimize(name=optimizer, lr=kwargs.get('learning_rate', 0.01))
+    trainer.optimize(name=optimizer, lr=kwargs.get('learning_rate', 0.01),
+                     hook_optimizer=kwargs.get('hook_optimizer', False))
     if 'exponential_decay' in kwargs:
         decay = kwargs['exponential_decay']
         if decay is not None:
@@ -70,6 +73,10 @@ def _main(dataset_str, model_str, batch_size, epochs, optimizer, **kwargs):
 
     subsample = kwargs['subsample']
     backend   = kwargs['visualisation']
+    # plotted values are copied from the device in bulk every `flush_every` steps
+    MetricAccumulator.for_bus(bus, flush_every=kwargs['flush_every'])
+    # subscribers propagating the same data through the model share the passes
+    probe_scheduler = trainer.exporter.probe_scheduler
     subscriber_added = False
 
     if kwargs['hessian']:
@@ -79,9 +86,9 @@ def _main(dataset_str, model_str, batch_size, epochs, optimizer, **kwargs):
         trainer.add_subscriber(HessianEigenSubscriber(trainer.model.forward, trainer.loss, loader,
                                                       batch_size,
                                                       frequency=trainer.batches_per_epoch,
-                                                      num_eig=1, power_steps=25,
+                                                      num_eig=1, lanczos_steps=25,
+                                                      exporter=trainer.exporter,
                                                       backend=backend))
-        trainer.create_graph = True
         subscriber_added = True
 
     if kwargs['spectral_norm']:
@@ -100,7 +107,8 @@ def _main(dataset_str, model_str, batch_size, epochs, optimizer, **kwargs):
         test_accuracy_subscriber = TestAccuracySubscriber(dataset_test, trainer.model.forward,
                                                           frequency=trainer.batches_per_epoch,
                                                           batch_size=batch_size,
-                                                          backend=backend)
+                                                          backend=backend,
+                                                          probe_scheduler=probe_scheduler)
         trainer.add_subscriber(test_accuracy_subscriber)
         subscriber_added = True
 
@@ -125,7 +133,9 @@ def _main(dataset_str, model_str, batch_size, epochs, optimizer, **kwargs):
 
     if kwargs['histogram']:
         for kind in kwargs['histogram']:
-            histogram_subscriber = HistogramSubscriber(kind, backend=backend)
+            histogram_subscriber = HistogramSubscriber(kind, backend=backend,
+                                                       bins=kwargs['histogram_bins'],
+                                                       range=kwargs['histogram_range'])
             trainer.add_subscriber(histogram_subscriber)
         subscriber_added = True
 
@@ -135,9 +145,21 @@ def _main(dataset_str, model_str, batch_size, epochs, optimizer, **kwargs):
             trainer.add_subscriber(norm_subscriber)
         subscriber_added = True
 
-    if kwargs['svcca']:
+    if kwargs['svcca'] and kwargs['test_accuracy']:
+        # propagate the same data as the test accuracy at the same steps, so both share one pass.
+        # The activations of the whole test set are pooled to keep them small.
+        svcca_subscriber = BatchedSVCCASubscriber(dataset_test, None, trainer.model.forward,
+                                                  batch_size=batch_size,
+                                                  subsample=trainer.batches_per_epoch,
+                                                  reducer=ActivationReducer(pool_size=4),
+                                                  backend=backend,
+                                                  probe_scheduler=probe_scheduler)
+        trainer.add_subscriber(svcca_subscriber)
+        subscriber_added = True
+    elif kwargs['svcca']:
         svcca_subscriber = SVCCASubscriber(dataset_test, 500, trainer.model.forward,
-                                           subsample=trainer.batches_per_epoch, backend=backend)
+                                           subsample=trainer.batches_per_epoch, backend=backend,
+                                           probe_scheduler=probe_scheduler)
         trainer.add_subscriber(svcca_subscriber)
         subscriber_added = True
 
@@ -164,6 +186,8 @@ def _main(dataset_str, model_str, batch_size, epochs, optimizer, **kwargs):
         for batch_idx in batch_range:
             trainer.train_batch()
 
+    trainer.close()
+
 
 def get_parser():
     '''Obtain a configured argument parser. This function is necessary for the sphinx argparse
@@ -191,6 +215,9 @@ def get_parser():
     parser.add_argument('-e', '--epochs', type=int, default=10)
     parser.add_argument('-o', '--optimizer', type=str, default='Adam', help='Optimizer to use')
     parser.add_argument('-l', '--learning-rate', type=float, default=0.01, help='Learning rate')
+    parser.add_argument('--hook-optimizer', action='store_true',
+                        help='Compute weight updates around the optimizer step instead of copying '
+                        'weights in every forward pass')
     parser.add_argument('-a', '--ratio-average', type=int, default=10, help='Number of ratios to '
                         'average for stability (currently unused)', metavar='N')
     parser.add_argument('-s', '--subsample', type=int, default=1,
@@ -207,6 +234,11 @@ def get_parser():
                         help='Use variance norm subscriber(s)')
     parser.add_argument('--histogram', nargs='+', type=str, default=None, metavar='TOPIC',
                         help='Use histogram subscriber(s)')
+    parser.add_argument('--histogram-bins', type=int, default=50,
+                        help='Number of bins for histogram subscriber(s)')
+    parser.add_argument('--histogram-range', type=float, nargs=2, default=None,
+                        metavar=('MIN', 'MAX'),
+                        help='Fixed range of the histogram bins (default: adapt to the data)')
     parser.add_argument('--ratio', type=list_of_tuples, nargs='+', default=None,
                         metavar='TOPIC,TOPIC', help='Use ratio subscriber(s)')
     parser.add_argument('--norm', nargs='+', type=str, default=None, metavar='TOPIC',
@@ -227,6 +259,8 @@ def get_parser():
                         default='runs')
     parser.add_argument('--seed', type=int, required=False, default=None,
                         help='Seed to use. None means don\'t seed')
+    parser.add_argument('--flush-every', type=int, default=1, metavar='N',
+                        help='Number of steps between copying the plotted values from the device')
     return parser
 
 
@@ -2,9 +2,7 @@
 
 from distutils.core import setup
 import setuptools
-import os
 import ikkuna
-import warnings
 
 # read the requirements from requirements.txt. Some specs need special handing as `install_requires`
 # understands only a subset of what `pip install` understands
@@ -31,61 +29,15 @@ entry_points = {
               'MessageMeanSubscriber = ikkuna.export.subscriber.message_mean:MessageMeanSubscriber',
               'LossSubscriber = ikkuna.export.subscriber.loss:LossSubscriber',
               'CallbackSubscriber = ikkuna.export.subscriber.subscriber:CallbackSubscriber',
+              'HessianEigenSubscriber = ikkuna.export.subscriber.hessian_eig:HessianEigenSubscriber',
+              'SVCCASubscriber = ikkuna.export.subscriber.svcca:SVCCASubscriber',
+              'BatchedSVCCASubscriber = ikkuna.export.subscriber.svcca:BatchedSVCCASubscriber',
+              'StreamingSVCCASubscriber = ikkuna.export.subscriber.svcca:StreamingSVCCASubscriber',
+              'ReferenceSVCCASubscriber = ikkuna.export.subscriber.svcca:ReferenceSVCCASubscriber',
+              'CKASubscriber = ikkuna.export.subscriber.cka:CKASubscriber',
           ]
       }
 
-# if hessian_eigenthings is installed, we can supply the HessianEigenSubscriber, otherwise simply
-# drop it
-try:
-    import hessian_eigenthings  # noqa
-    entry_points['ikkuna.export.subscriber'].append(
-        'HessianEigenSubscriber = ikkuna.export.subscriber.hessian_eig:HessianEigenSubscriber'
-    )
-except ImportError:
-    warnings.warn('pytorch-hessian-eigenthings could not be imported. '
-                  '`HessianEigenSubscriber` will not be installed. You can find the package at '
-                  '`https://github.com/noahgolmant/pytorch-hessian-eigenthings/`')
-
-# Problem: PyPi does not allow the syntax introduced in Pep 508 for listing requirements from a vcs
-# repository, although setuptools understands it. This is supposedly because the developers want to
-# avoid PyPi packages pulling from arbitrary URLs. So, as a workaround, we manually pull from this
-# arbitrary url and install the SVCCA package. In the future, SVCCA should be on PyPi as well,
-# making this unnecessary, but for now it's not tested enough.
-try:
-    import svcca  # noqa
-    entry_points['ikkuna.export.subscriber'].extend(
-        [
-            'SVCCASubscriber = ikkuna.export.subscriber.svcca:SVCCASubscriber',
-            'BatchedSVCCASubscriber = ikkuna.export.subscriber.svcca:BatchedSVCCASubscriber',
-        ]
-    )
-except ImportError:
-    cwd = os.getcwd()
-    svcca_url = 'https://github.com/themightyoarfish/svcca-gpu/archive/master.zip'
-    archive_dirname = 'svcca-gpu-master'
-    warnings.warn(f'SVCCA is not installed. Installing from `{svcca_url}`')
-    import tempfile
-    import importlib
-    from urllib.request import urlretrieve
-    from zipfile import ZipFile
-    with tempfile.TemporaryDirectory() as tempdir:
-        os.chdir(tempdir)
-        print(f'Downloading `{svcca_url}`')
-        fname, headers = urlretrieve(svcca_url, f'{tempdir}/svcca.zip')
-        f = ZipFile(fname)
-        extracted_repo_path = os.path.join(tempdir, archive_dirname)
-        print(f'Extracting `{archive_dirname}`')
-        f.extractall()
-        os.chdir(extracted_repo_path)
-        print('Running setup script.')
-        module_spec = importlib.util.spec_from_file_location('setup',
-                                                             os.path.join(extracted_repo_path,
-                                                                          'setup.py'))
-        module = importlib.util.module_from_spec(module_spec)
-        module_spec.loader.exec_module(module)
-        os.chdir(cwd)
-        print('Done.')
-
 setup(name='ikkuna',
       version=ikkuna.__version__,
       description='Ikkuna Neural Network Monitor',
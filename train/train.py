@@ -3,6 +3,8 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 from ikkuna.utils import create_optimizer
 from ikkuna.export import Exporter
+from ikkuna.export.process import ProcessSubscriberProxy
+from ikkuna.export.subscriber import MetricAccumulator
 
 
 class Trainer:
@@ -25,6 +27,8 @@ class Trainer:
                     loader for the training dataset
     _optimizer  : torch.optim.Optimizer
     _scheduler  :   torch.optim.lr_scheduler._LRScheduler
+    _subscribers    :   list(ikkuna.export.subscriber.Subscriber)
+                        Subscribers added with :meth:`add_subscriber()`
     '''
 
     def __init__(self, dataset_meta, **kwargs):
@@ -60,6 +64,7 @@ class Trainer:
         self._global_counter    = 0
         self._epoch             = 0
         self._scheduler         = None
+        self._subscribers       = []
         self._create_graph      = kwargs.get('create_graph', False)
 
         # we use these to peek one step ahead in the data iterator to know an epoch has ended
@@ -73,6 +78,9 @@ class Trainer:
 
     @property
     def create_graph(self):
+        '''bool: Build the graph of the gradients in every backward pass. Otherwise, it is only
+        built on steps for which a subscriber declares the need via
+        :meth:`~ikkuna.export.subscriber.Subscriber.needs_create_graph()`.'''
         return self._create_graph
 
     @create_graph.setter
@@ -109,27 +117,67 @@ class Trainer:
         '''torch.optim.Optimizer: Optimizer in use, if set'''
         return self._optimizer
 
-    def add_subscriber(self, subscriber):
+    def add_subscriber(self, subscriber, executor=None, **kwargs):
         '''Add a subscriber.
 
         Parameters
         ----------
         subscriber  :   ikkuna.export.subscriber.Subscriber
+        executor    :   str or None
+                        ``'process'`` runs the subscriber in a separate process via a
+                        :class:`~ikkuna.export.process.ProcessSubscriberProxy`. ``None`` runs it
+                        on the message bus directly.
+        **kwargs
+            Passed on to the :class:`~ikkuna.export.process.ProcessSubscriberProxy`
+
+        Returns
+        -------
+        ikkuna.export.subscriber.Subscriber
+            The subscriber which was registered, i.e. the proxy if one was created
 
+        Raises
+        ------
+        ValueError
+            If the executor is unknown
         '''
+        if executor == 'process':
+            subscriber = ProcessSubscriberProxy(subscriber,
+                                                named_modules=self._exporter.named_modules,
+                                                **kwargs)
+        elif executor is not None:
+            raise ValueError(f'Unknown executor "{executor}"')
         self._exporter.message_bus.register_subscriber(subscriber)
-
-    def optimize(self, name='Adam', **kwargs):
+        self._subscribers.append(subscriber)
+        return subscriber
+
+    def close(self):
+        '''Finish training. Subscribers which have a ``close()`` method are closed, so that they
+        publish the results of work still pending (e.g. background evaluations) and stop their
+        workers. Then all messages and values still waiting to be plotted are delivered.'''
+        for subscriber in self._subscribers:
+            if hasattr(subscriber, 'close'):
+                subscriber.close()
+        message_bus = self._exporter.message_bus
+        if hasattr(message_bus, 'flush'):
+            message_bus.flush()
+        MetricAccumulator.for_bus(message_bus).flush()
+
+    def optimize(self, name='Adam', hook_optimizer=False, **kwargs):
         '''Set the optimizer.
 
         Parameters
         ----------
         name    :   str
                     Name of the optimizer (must exist in :mod:`torch.optim`)
+        hook_optimizer  :   bool
+                            Let the exporter hook the optimizer's ``step()`` for computing weight
+                            and bias updates (see :meth:`~ikkuna.export.Exporter.set_optimizer()`)
         **kwargs
             All other kwargs are forwarded to the optimizer constructor
         '''
         self._optimizer = create_optimizer(self._model, name, **kwargs)
+        if hook_optimizer:
+            self._exporter.set_optimizer(self._optimizer)
         print(f'Using {self._optimizer.__class__.__name__} optimizer')
 
     def initialize(self, init):
@@ -193,11 +241,12 @@ class Trainer:
         X, Y         = self._next_X, self._next_Y
         data, labels = X, Y
         if torch.cuda.is_available():
-            data, labels = data.cuda(async=True), labels.cuda(async=True)
+            data, labels = data.cuda(non_blocking=True), labels.cuda(non_blocking=True)
         self._optimizer.zero_grad()
         output       = self._model(data)
         loss         = self._loss_function(output, labels)
-        loss.backward(create_graph=self._create_graph)
+        create_graph = self._create_graph or self._exporter.needs_create_graph()
+        loss.backward(create_graph=create_graph)
         self._optimizer.step()
 
         try: